@@ -4,9 +4,9 @@ from typing import Annotated, Optional
 
 import vtk
 
+import time
+
 import numpy as np
-import copy
-import math
 
 import qt
 
@@ -22,6 +22,12 @@ from slicer.parameterNodeWrapper import (
 
 from slicer import vtkMRMLScalarVolumeNode
 
+from MirrorOrbitReconLib.MirrorOrbitReconCore import (
+    DEFAULT_PARAMETERS,
+    MirrorOrbitReconCore,
+    RegistrationCancelled,
+)
+
 
 #
 # MirrorOrbitRecon
@@ -146,6 +152,34 @@ class MirrorOrbitReconWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         self.logic = None
         self._parameterNode = None
         self._parameterNodeGuiTag = None
+        # Run registrations in a worker thread with a progress dialog instead of blocking the GUI
+        self.runInBackground = True
+        self._backgroundTask = None
+        # Show the UI right away and import/warm up ITK, FPFH and cpdalp in a worker thread.
+        # The registration buttons stay disabled until that is done.
+        self.lazyWarmUp = True
+        self.dependenciesReady = False
+        self.warmUpSeconds = None
+        self._pendingRegistrationButtons = []
+        # Re-run ICP (at most every incrementalUpdateInterval ms) while the mirror plane is dragged
+        # after the skull rigid registration, see onPlaneAdjustCheckBox
+        # Keep the mirror as a 4x4 reflection about the plane instead of a mirrored copy of the skull:
+        # only the subsampled points are reflected for the registration, and the rigid model is shown
+        # through transforms until its geometry is needed (see materializeMirroredRigidModel)
+        self.analyticMirror = False
+        self.mirroredSkullRigidNode = None
+        # True while the rigid mirrored model shares the original points and is shown through transforms
+        self._mirroredRigidShared = False
+        # Cut only the selected side of both skulls with MirrorOrbitReconCore.planeCutPolyData instead of
+        # two Dynamic Modeler plane cuts that make both halves of each
+        self.vectorizedPlaneCut = True
+        # Register the half models with ICP on the plane-cut subsampled clouds of the skull registration
+        self.halfRegistrationOnPoints = False
+        self.cutSide = None
+        self.rigidLogic = None
+        self.incrementalRegistration = None
+        self.incrementalUpdateInterval = 250
+        self._planeObservation = None
 
     def setup(self) -> None:
         """Called when the user opens the module the first time and the widget is initialized."""
@@ -157,62 +191,51 @@ class MirrorOrbitReconWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         self.layout.addWidget(uiWidget)
         self.ui = slicer.util.childWidgetVariables(uiWidget)
 
+        # Analytic mirror options, not in the .ui file
+        self.analyticMirrorCheckBox = qt.QCheckBox("Mirror analytically (no mirrored mesh copy)")
+        self.analyticMirrorCheckBox.toolTip = (
+            "Register the skull against its reflection about the plane without building the mirrored mesh."
+            " The mirrored geometry is only created when it is needed or requested."
+        )
+        self.analyticMirrorCheckBox.checked = self.analyticMirror
+        self.layout.addWidget(self.analyticMirrorCheckBox)
+        self.createMirroredModelButton = qt.QPushButton("Create mirrored model geometry")
+        self.createMirroredModelButton.toolTip = "Build the mirrored (and rigid mirrored) models, to view or export them"
+        self.createMirroredModelButton.enabled = False
+        self.layout.addWidget(self.createMirroredModelButton)
+
         # Set scene in MRML widgets. Make sure that in Qt designer the top-level qMRMLWidget's
         # "mrmlSceneChanged(vtkMRMLScene*)" signal in is connected to each MRML widget's.
         # "setMRMLScene(vtkMRMLScene*)" slot.
         uiWidget.setMRMLScene(slicer.mrmlScene)
 
         #install itk rigid registration and pycpd packages
-        needInstall = False
-        try:
-            from itk import Fpfh
-            import cpdalp
-        except ModuleNotFoundError:
-            needInstall = True
+        if self.dependenciesMissing():
+            self.installDependencies()
 
-        if needInstall:
+        # Create logic class. Logic implements all computations that should be possible to run
+        # in batch mode, without a graphical user interface.
+        self.logic = MirrorOrbitReconLogic()
+
+        if self.lazyWarmUp:
+            self.startDependencyWarmUp()
+        else:
             progressDialog = slicer.util.createProgressDialog(
-                windowTitle="Installing...",
-                labelText="Installing Python dependencies. This may take a minute...",
+                windowTitle="Importing...",
+                labelText="Importing Python packages. This may take few seconds...",
                 maximum=0,
             )
             slicer.app.processEvents()
-            try:
-                slicer.util.pip_install(["itk~=5.4.0"])
-                slicer.util.pip_install(["scikit-learn"])
-                slicer.util.pip_install(["itk-fpfh~=0.2.0"])
-                slicer.util.pip_install(["itk-ransac~=0.2.1"])
-                slicer.util.pip_install(f"cpdalp")
-            except:
-                slicer.util.infoDisplay("Issue while installing the ITK Python packages")
-                progressDialog.close()
-            import itk
-
-            fpfh = itk.Fpfh.PointFeature.MF3MF3.New()
+            with slicer.util.WaitCursor():
+                stepStart = time.perf_counter()
+                try:
+                    timings = self.logic.warmUpDependencies()
+                except ModuleNotFoundError:
+                    print("Module Not found. Please restart Slicer to load packages.")
+                    timings = None
             progressDialog.close()
-
-        try:
-            import cpdalp
-            import itk
-            from itk import Fpfh
-            from itk import Ransac
-        except ModuleNotFoundError as e:
-            print("Module Not found. Please restart Slicer to load packages.")
-
-
-        progressDialog = slicer.util.createProgressDialog(
-            windowTitle="Importing...",
-            labelText="Importing Python packages. This may take few seconds...",
-            maximum=0,
-        )
-        slicer.app.processEvents()
-        with slicer.util.WaitCursor():
-            fpfh = itk.Fpfh.PointFeature.MF3MF3.New()
-        progressDialog.close()
-
-        # Create logic class. Logic implements all computations that should be possible to run
-        # in batch mode, without a graphical user interface.
-        self.logic = MirrorOrbitReconLogic()
+            if timings is not None:
+                self.onDependenciesReady(timings, time.perf_counter() - stepStart)
 
         # Connections
 
@@ -232,6 +255,8 @@ class MirrorOrbitReconWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
 
         # Mirror the skull
         self.ui.createMirrorPushButton.connect("clicked(bool)", self.onCreateMirrorPushButton)
+        self.analyticMirrorCheckBox.connect("toggled(bool)", self.onAnalyticMirrorCheckBox)
+        self.createMirroredModelButton.connect("clicked(bool)", self.onCreateMirroredModelButton)
 
         # Rigid registration
         self.ui.skullRigidRegistrationPushButton.connect("clicked(bool)", self.onSkullRigidRegistrationPushButton)
@@ -300,10 +325,83 @@ class MirrorOrbitReconWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
             displayNode = self.mirrorPlaneNode.GetDisplayNode()
             displayNode.SetHandlesInteractive(True)
             displayNode.SetRotationHandleVisibility(True)
+            if self.rigidLogic is not None and self.ui.planeCutPushButton.enabled:
+                self.startIncrementalRegistration()
+        elif self.incrementalRegistration is not None:
+            self.stopIncrementalRegistration()
+
+    def planeOriginNormal(self):
+        """Origin and normal of the mirror plane, in world coordinates."""
+        origin = [0.0, 0.0, 0.0]
+        normal = [0.0, 0.0, 0.0]
+        self.mirrorPlaneNode.GetOriginWorld(origin)
+        self.mirrorPlaneNode.GetNormalWorld(normal)
+        return np.array(origin), np.array(normal)
+
+    def planeReflectionMatrix(self):
+        """4x4 reflection about the current mirror plane."""
+        return MirrorOrbitReconCore.reflectionMatrix(*self.planeOriginNormal())
+
+    def startIncrementalRegistration(self):
+        """Follow the mirror plane with ICP only, starting from the skull rigid registration."""
+        self.materializeMirroredRigidModel()
+        self.incrementalRegistration = self.rigidLogic.startIncrementalMirrorRegistration(
+            self.mirrorReflection, self.parameterDictionary, self.incrementalUpdateInterval / 1000.0
+        )
+        self.liveRigidTransformNode = slicer.mrmlScene.AddNewNodeByClass(
+            "vtkMRMLTransformNode", "live_rigid_correction"
+        )
+        self.liveRigidMatrix = np.identity(4)
+        self.mirroredSkullRigidNode.SetAndObserveTransformNodeID(self.liveRigidTransformNode.GetID())
+        self.mirrorPlaneNode.GetDisplayNode().SetVisibility(True)
+        self._planeUpdateTimer = qt.QTimer()
+        self._planeUpdateTimer.setSingleShot(True)
+        self._planeUpdateTimer.setInterval(self.incrementalUpdateInterval)
+        self._planeUpdateTimer.connect("timeout()", self.updateIncrementalRegistration)
+        self._planeObservation = self.mirrorPlaneNode.AddObserver(
+            slicer.vtkMRMLMarkupsNode.PointModifiedEvent, self.onMirrorPlaneModified
+        )
+
+    def onMirrorPlaneModified(self, caller, event):
+        # Coalesce the drag events: at most one update per timer interval, and always one for the last position
+        if not self._planeUpdateTimer.isActive():
+            self._planeUpdateTimer.start()
+
+    def updateIncrementalRegistration(self):
+        result = self.incrementalRegistration.update(self.planeReflectionMatrix(), force=True)
+        self.liveRigidMatrix = result["correction"] @ self.liveRigidMatrix
+        slicer.util.updateTransformMatrixFromArray(self.liveRigidTransformNode, self.liveRigidMatrix)
+        self.sourcePoints = result["sourcePoints"]
+        slicer.util.showStatusMessage(
+            f"Mirror plane: fitness {result['fitness']:.4f}, RMSE {result['rmse']:.4f} "
+            f"({result['seconds'] * 1000:.0f} ms)",
+            3000,
+        )
+
+    def stopIncrementalRegistration(self):
+        """Apply the last plane position and harden the live correction on the rigid model."""
+        self.mirrorPlaneNode.RemoveObserver(self._planeObservation)
+        self._planeObservation = None
+        self._planeUpdateTimer.stop()
+        # No ICP pass if the plane has not moved since the last update
+        if not np.allclose(self.planeReflectionMatrix(), self.incrementalRegistration.reflection):
+            self.updateIncrementalRegistration()
+        self.incrementalRegistration.finish()
+        self.mirrorReflection = self.incrementalRegistration.reflection
+        slicer.vtkSlicerTransformLogic().hardenTransform(self.mirroredSkullRigidNode)
+        slicer.mrmlScene.RemoveNode(self.liveRigidTransformNode)
+        self.incrementalRegistration = None
 
     def onCreateMirrorPushButton(self):
         self.originalSkullModelNode = self.ui.originalModelSelector.currentNode()
         self.mirroredSkullModelNode = self.ui.mirroredModelSelector.currentNode()
+        self.analyticMirrorCheckBox.enabled = False
+        if self.analyticMirror:
+            self.mirrorReflection = self.planeReflectionMatrix()
+            self.createMirroredModelButton.enabled = True
+            self.enableRegistrationButton(self.ui.skullRigidRegistrationPushButton)
+            self.ui.resetPushButton.enabled = True
+            return
         mirrorFunction = slicer.vtkSlicerDynamicModelerMirrorTool()
         dynamicModelerNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLDynamicModelerNode")
         dynamicModelerNode.SetToolName("Mirror")
@@ -311,23 +409,19 @@ class MirrorOrbitReconWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         dynamicModelerNode.SetNodeReferenceID("Mirror.InputPlane", self.mirrorPlaneNode.GetID())
         dynamicModelerNode.SetNodeReferenceID("Mirror.OutputModel", self.mirroredSkullModelNode.GetID())
         slicer.modules.dynamicmodeler.logic().RunDynamicModelerTool(dynamicModelerNode)
+        self.mirrorReflection = self.planeReflectionMatrix()
         # self.mirroredSkullModelNode.SetName(self.originalSkullModelNode.GetName() + "_mirror")
         # self.ui.createMirrorPushButton.enabled=False
         self.mirroredSkullModelNode.GetDisplayNode().SetVisibility(True)
-        self.ui.skullRigidRegistrationPushButton.enabled = True
+        self.enableRegistrationButton(self.ui.skullRigidRegistrationPushButton)
         self.ui.resetPushButton.enabled = True
 
     def onSkullRigidRegistrationPushButton(self):
         #rigid registration
-        self.parameterDictionary = {
-            "pointDensity": 1.00,
-            "normalSearchRadius": 2.00,
-            "FPFHNeighbors": int(100),
-            "FPFHSearchRadius": 5.00,
-            "distanceThreshold": 3.00,
-            "maxRANSAC": int(1000000),
-            "ICPDistanceThreshold": float(1.50)
-        }
+        self.parameterDictionary = dict(DEFAULT_PARAMETERS)
+        if self.analyticMirror:
+            self.registerAnalyticMirror()
+            return
         #Clone the mirrored model
         shNode = slicer.vtkMRMLSubjectHierarchyNode.GetSubjectHierarchyNode(slicer.mrmlScene)
         itemIDToClone = shNode.GetItemByDataNode(self.mirroredSkullModelNode)
@@ -337,22 +431,92 @@ class MirrorOrbitReconWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
 
         #Perfrom itk rigid registration
         logic = MirrorOrbitReconLogic()
-        self.sourcePoints, self.targetPoints, scalingTransformNode, ICPTransformNode = logic.ITKRegistration(self.mirroredSkullRigidNode,
-                                                                                                   self.originalSkullModelNode,
-                                                                                                   scalingOption=False,
-                                                                                                   parameterDictionary=self.parameterDictionary,
-                                                                                                   usePoisson=False)
-        self.mirroredSkullModelNode.GetDisplayNode().SetVisibility(False)
-        self.mirrorPlaneNode.GetDisplayNode().SetVisibility(False)
-        self.ui.createMirrorPushButton.enabled=False
-        self.ui.skullRigidRegistrationPushButton.enabled = False
-        self.ui.showRigidModelCheckbox.enabled = True
-        self.ui.showRigidModelCheckbox.checked = 1
-        self.ui.skullAffineRegistrationPushButton.enabled = True
-        self.ui.planeCutPushButton.enabled = True
+        sourceMesh = self.copyPolyData(self.mirroredSkullRigidNode)
+        targetMesh = self.copyPolyData(self.originalSkullModelNode)
+
+        def register():
+            return logic.rigidRegistration(sourceMesh, targetMesh, False, self.parameterDictionary, False)
+
+        def onDone(result):
+            self.sourcePoints, self.targetPoints, scaling, ICPTransform, similarityFlag = result
+            logic.applyRigidRegistration(self.mirroredSkullRigidNode, self.originalSkullModelNode,
+                                         scaling, ICPTransform, similarityFlag)
+            # Keeps the subsampled clouds for the incremental re-registration while the plane is adjusted
+            self.rigidLogic = logic
+            self.mirroredSkullModelNode.GetDisplayNode().SetVisibility(False)
+            self.mirrorPlaneNode.GetDisplayNode().SetVisibility(False)
+            self.ui.createMirrorPushButton.enabled=False
+            self.ui.skullRigidRegistrationPushButton.enabled = False
+            self.ui.showRigidModelCheckbox.enabled = True
+            self.ui.showRigidModelCheckbox.checked = 1
+            self.enableRegistrationButton(self.ui.skullAffineRegistrationPushButton)
+            self.ui.planeCutPushButton.enabled = True
+
+        self.runLogic(logic, register, onDone, "Rigid registration")
+
+    def registerAnalyticMirror(self):
+        """Rigid registration of the reflected skull onto itself, without a mirrored copy of the mesh."""
+        logic = MirrorOrbitReconLogic()
+        # Source and target are the same mesh, the reflection is applied to the source subsample only.
+        # The registration only reads it, so the original skull's polydata is passed as is.
+        targetMesh = self.originalSkullModelNode.GetPolyData()
+
+        def register():
+            return logic.rigidRegistration(targetMesh, targetMesh, False, self.parameterDictionary, False,
+                                           sourceTransform=self.mirrorReflection)
+
+        def onDone(result):
+            self.sourcePoints, self.targetPoints, scaling, ICPTransform, similarityFlag = result
+            self.mirroredSkullRigidNode = logic.applyMirroredRigidRegistration(
+                self.originalSkullModelNode, self.mirrorReflection, ICPTransform, similarityFlag,
+                self.mirroredSkullModelNode.GetName() + "_rigid",
+            )
+            self._mirroredRigidShared = True
+            self.rigidLogic = logic
+            self.mirrorPlaneNode.GetDisplayNode().SetVisibility(False)
+            self.ui.createMirrorPushButton.enabled=False
+            self.ui.skullRigidRegistrationPushButton.enabled = False
+            self.ui.showRigidModelCheckbox.enabled = True
+            self.ui.showRigidModelCheckbox.checked = 1
+            self.enableRegistrationButton(self.ui.skullAffineRegistrationPushButton)
+            self.ui.planeCutPushButton.enabled = True
+
+        self.runLogic(logic, register, onDone, "Rigid registration")
+
+    def materializeMirroredRigidModel(self):
+        """Give the rigid mirrored model its own hardened geometry, if it is still shown through transforms."""
+        if not self._mirroredRigidShared:
+            return
+        matrix = slicer.util.arrayFromTransformMatrix(
+            self.mirroredSkullRigidNode.GetParentTransformNode(), toWorld=True
+        )
+        logic = MirrorOrbitReconLogic()
+        self.mirroredSkullRigidNode.SetAndObserveTransformNodeID(None)
+        self.mirroredSkullRigidNode.SetAndObservePolyData(
+            logic.mirrorPolyData(self.originalSkullModelNode.GetPolyData(), matrix)
+        )
+        self._mirroredRigidShared = False
+
+    def showMirroredModel(self):
+        """Fill the mirrored model selector's node with the mirrored skull (analytic mirror mode), e.g. to export it."""
+        logic = MirrorOrbitReconLogic()
+        self.mirroredSkullModelNode.SetAndObservePolyData(
+            logic.mirrorPolyData(self.originalSkullModelNode.GetPolyData(), self.mirrorReflection)
+        )
+        self.mirroredSkullModelNode.CreateDefaultDisplayNodes()
+        self.mirroredSkullModelNode.GetDisplayNode().SetVisibility(True)
+
+    def onAnalyticMirrorCheckBox(self, checked):
+        self.analyticMirror = checked
+
+    def onCreateMirroredModelButton(self):
+        """Build the mirrored geometry on request: the mirrored model and, once registered, the rigid mirrored model."""
+        self.showMirroredModel()
+        self.materializeMirroredRigidModel()
 
 
     def onSkullAffineRegistrationPushButton(self):
+        self.materializeMirroredRigidModel()
         #Clone the rigid registered model again for affine
         shNode = slicer.vtkMRMLSubjectHierarchyNode.GetSubjectHierarchyNode(slicer.mrmlScene)
         itemIDToClone = shNode.GetItemByDataNode(self.mirroredSkullRigidNode)
@@ -363,24 +527,35 @@ class MirrorOrbitReconWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         # self.mirroredSkullAffineNode.GetDisplayNode().SetShading(True)
         #Affine deformable registration
         logic = MirrorOrbitReconLogic()
-        transformation, translation = logic.CPDAffineTransform(self.mirroredSkullAffineNode, self.sourcePoints, self.targetPoints)
-        matrix_vtk = vtk.vtkMatrix4x4()
-        for i in range(3):
-            for j in range(3):
-                matrix_vtk.SetElement(i, j, transformation[j][i])
-        for i in range(3):
-            matrix_vtk.SetElement(i, 3, translation[i])
-        affineTransform = vtk.vtkTransform()
-        affineTransform.SetMatrix(matrix_vtk)
-        affineTransformNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLTransformNode', "Affine_transform_matrix")
-        affineTransformNode.SetAndObserveTransformToParent(affineTransform)
-        affineNodeName = self.originalSkullModelNode.GetName() + "_affine"
-        affineTransformNode.SetName(affineNodeName)
-        # self.mirroredSkullRigidNode.GetDisplayNode().SetVisibility(False)
-        self.ui.showRigidModelCheckbox.checked = 0
-        self.ui.showAffineModelCheckbox.enabled = True
-        self.ui.showAffineModelCheckbox.checked = 1
-        self.ui.skullAffineRegistrationPushButton.enabled = False
+        affinePolyData = self.copyPolyData(self.mirroredSkullAffineNode, deep=True)
+
+        def register():
+            return logic.CPDAffinePolyData(
+                affinePolyData, self.sourcePoints, self.targetPoints, self.parameterDictionary
+            )
+
+        def onDone(result):
+            transformation, translation, _ = result
+            self.mirroredSkullAffineNode.SetAndObservePolyData(affinePolyData)
+            matrix_vtk = vtk.vtkMatrix4x4()
+            for i in range(3):
+                for j in range(3):
+                    matrix_vtk.SetElement(i, j, transformation[j][i])
+            for i in range(3):
+                matrix_vtk.SetElement(i, 3, translation[i])
+            affineTransform = vtk.vtkTransform()
+            affineTransform.SetMatrix(matrix_vtk)
+            affineTransformNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLTransformNode', "Affine_transform_matrix")
+            affineTransformNode.SetAndObserveTransformToParent(affineTransform)
+            affineNodeName = self.originalSkullModelNode.GetName() + "_affine"
+            affineTransformNode.SetName(affineNodeName)
+            # self.mirroredSkullRigidNode.GetDisplayNode().SetVisibility(False)
+            self.ui.showRigidModelCheckbox.checked = 0
+            self.ui.showAffineModelCheckbox.enabled = True
+            self.ui.showAffineModelCheckbox.checked = 1
+            self.ui.skullAffineRegistrationPushButton.enabled = False
+
+        self.runLogic(logic, register, onDone, "Affine registration")
 
 
     def onShowRigidModelCheckbox(self):
@@ -403,6 +578,16 @@ class MirrorOrbitReconWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
 
 
     def onPlaneCutPushButton(self):
+        if self.incrementalRegistration is not None:
+            self.ui.planeAdjustCheckBox.checked = 0
+        self.materializeMirroredRigidModel()
+        if self.vectorizedPlaneCut:
+            self.cutSelectedSide()
+            self.ui.showRigidModelCheckbox.checked = 0
+            self.ui.showAffineModelCheckbox.checked = 0
+            self.ui.planeCutPushButton.enabled = False
+            self.ui.keepHalfPushButton.enabled = True
+            return
         planeCutFunction = slicer.vtkSlicerDynamicModelerPlaneCutTool()
         dynamicModelerNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLDynamicModelerNode")
         dynamicModelerNode.SetToolName("Plane cut")
@@ -439,7 +624,40 @@ class MirrorOrbitReconWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         self.ui.keepHalfPushButton.enabled = True
 
 
+    def selectedSide(self):
+        return "positive" if self.ui.leftSideRadioButton.checked == 1 else "negative"
+
+    def cutSelectedSide(self):
+        """Cut the selected half of the rigid mirrored and of the original skull, if not done for that side yet."""
+        side = self.selectedSide()
+        if side == self.cutSide:
+            return
+        logic = MirrorOrbitReconLogic()
+        origin, normal = self.planeOriginNormal()
+        if self.cutSide is not None:
+            slicer.mrmlScene.RemoveNode(self.halfModelRigidNode)
+            slicer.mrmlScene.RemoveNode(self.halfOriginalNode)
+        self.halfModelRigidNode = slicer.modules.models.logic().AddModel(
+            logic.planeCutPolyData(self.mirroredSkullRigidNode.GetPolyData(), origin, normal, side)
+        )
+        self.halfModelRigidNode.SetName(side + "_half_mirror")
+        if side == "positive":
+            self.halfModelRigidNode.GetDisplayNode().SetColor(0.5, 0, 0)
+        else:
+            self.halfModelRigidNode.GetDisplayNode().SetColor(0, 0, 0.5)
+        self.halfOriginalNode = slicer.modules.models.logic().AddModel(
+            logic.planeCutPolyData(self.originalSkullModelNode.GetPolyData(), origin, normal, side)
+        )
+        self.halfOriginalNode.SetName(side + "_half_original")
+        self.halfOriginalNode.GetDisplayNode().SetVisibility(False)
+        self.cutSide = side
+
     def onKeepHalfPushButton(self):
+        if self.vectorizedPlaneCut:
+            self.cutSelectedSide()
+            self.halfModelRigidNode.GetDisplayNode().SetVisibility(True)
+            self.enableRegistrationButton(self.ui.rigidMirroredHalfButton)
+            return
         if self.ui.leftSideRadioButton.checked == 1:
             self.negativeHalfModelNode.GetDisplayNode().SetVisibility(False)
             self.positiveHalfModelNode.GetDisplayNode().SetVisibility(True)
@@ -450,25 +668,45 @@ class MirrorOrbitReconWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
             self.positiveHalfModelNode.GetDisplayNode().SetVisibility(False)
             self.halfModelRigidNode = self.negativeHalfModelNode
             self.halfOriginalNode = self.negativeHalfOriginalModel
-        self.ui.rigidMirroredHalfButton.enabled = True
+        self.enableRegistrationButton(self.ui.rigidMirroredHalfButton)
 
 
     def onRigidMirroredHalfButton(self):
         #Perfrom itk rigid registration
         self.halfModelRigidNode.SetName(self.mirroredSkullModelNode.GetName() + "_half_rigid")
         logic = MirrorOrbitReconLogic()
-        self.sourcePointsHalf, self.targetPointsHalf, halfScalingTransformNode, halfICPTransformNode = logic.ITKRegistration(self.halfModelRigidNode,
-                                                                                                   self.halfOriginalNode,
-                                                                                                   scalingOption=False,
-                                                                                                   parameterDictionary=self.parameterDictionary,
-                                                                                                   usePoisson=False)
-        self.halfModelRigidNode.GetDisplayNode().SetColor(1, 0.67, 0)
-        # self.halfModelRigidNode.GetDisplayNode.SetShading(True)
-        self.mirrorPlaneNode.GetDisplayNode().SetVisibility(False)
-        self.ui.rigidMirroredHalfButton.enabled = False
-        self.ui.showRigidHalfModelCheckBox.enabled = True
-        self.ui.showRigidHalfModelCheckBox.checked= 1
-        self.ui.affineMirroredHalfButton.enabled = True
+        if self.halfRegistrationOnPoints and self.rigidLogic is not None:
+            voxelSize = self.rigidLogic.lastRegistration["voxelSize"]
+            origin, normal = self.planeOriginNormal()
+            side = self.cutSide or self.selectedSide()
+
+            def register():
+                # The subsampled clouds of the skull registration are cut instead of the meshes
+                return logic.halfRigidRegistration(self.sourcePoints, self.targetPoints, voxelSize,
+                                                   origin, normal, side, self.parameterDictionary)
+        else:
+            sourceMesh = self.copyPolyData(self.halfModelRigidNode)
+            targetMesh = self.copyPolyData(self.halfOriginalNode)
+
+            def register():
+                # The half model was cut from the hardened full-skull rigid result, so it is already
+                # aligned: warm start ICP from identity instead of running FPFH and RANSAC again
+                return logic.rigidRegistration(sourceMesh, targetMesh, False, self.parameterDictionary, False,
+                                               initialTransform=np.identity(4))
+
+        def onDone(result):
+            self.sourcePointsHalf, self.targetPointsHalf, scaling, ICPTransform, similarityFlag = result
+            logic.applyRigidRegistration(self.halfModelRigidNode, self.halfOriginalNode,
+                                         scaling, ICPTransform, similarityFlag)
+            self.halfModelRigidNode.GetDisplayNode().SetColor(1, 0.67, 0)
+            # self.halfModelRigidNode.GetDisplayNode.SetShading(True)
+            self.mirrorPlaneNode.GetDisplayNode().SetVisibility(False)
+            self.ui.rigidMirroredHalfButton.enabled = False
+            self.ui.showRigidHalfModelCheckBox.enabled = True
+            self.ui.showRigidHalfModelCheckBox.checked= 1
+            self.enableRegistrationButton(self.ui.affineMirroredHalfButton)
+
+        self.runLogic(logic, register, onDone, "Half model rigid registration")
 
 
     def onShowRigidHalfModelCheckBox(self):
@@ -492,24 +730,35 @@ class MirrorOrbitReconWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         # self.halfModelaffineNode.GetDisplayNode().SetShading(True)
         #Affine deformable registration
         logic = MirrorOrbitReconLogic()
-        transformation, translation = logic.CPDAffineTransform(self.halfModelaffineNode, self.sourcePoints, self.targetPoints)
-        matrix_vtk = vtk.vtkMatrix4x4()
-        for i in range(3):
-            for j in range(3):
-                matrix_vtk.SetElement(i, j, transformation[j][i])
-        for i in range(3):
-            matrix_vtk.SetElement(i, 3, translation[i])
-        affineTransform = vtk.vtkTransform()
-        affineTransform.SetMatrix(matrix_vtk)
-        affineTransformNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLTransformNode', "Affine_transform_matrix")
-        affineTransformNode.SetAndObserveTransformToParent(affineTransform)
-        affineNodeName = self.mirroredSkullModelNode.GetName() + "half_affine"
-        affineTransformNode.SetName(affineNodeName)
+        affinePolyData = self.copyPolyData(self.halfModelaffineNode, deep=True)
 
-        self.ui.affineMirroredHalfButton.enabled = False
-        self.ui.showRigidHalfModelCheckBox.checked = 0
-        self.ui.showAffineHalfModelCheckbox.enabled = True
-        self.ui.showAffineHalfModelCheckbox.checked = 1
+        def register():
+            return logic.CPDAffinePolyData(
+                affinePolyData, self.sourcePoints, self.targetPoints, self.parameterDictionary
+            )
+
+        def onDone(result):
+            transformation, translation, _ = result
+            self.halfModelaffineNode.SetAndObservePolyData(affinePolyData)
+            matrix_vtk = vtk.vtkMatrix4x4()
+            for i in range(3):
+                for j in range(3):
+                    matrix_vtk.SetElement(i, j, transformation[j][i])
+            for i in range(3):
+                matrix_vtk.SetElement(i, 3, translation[i])
+            affineTransform = vtk.vtkTransform()
+            affineTransform.SetMatrix(matrix_vtk)
+            affineTransformNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLTransformNode', "Affine_transform_matrix")
+            affineTransformNode.SetAndObserveTransformToParent(affineTransform)
+            affineNodeName = self.mirroredSkullModelNode.GetName() + "half_affine"
+            affineTransformNode.SetName(affineNodeName)
+
+            self.ui.affineMirroredHalfButton.enabled = False
+            self.ui.showRigidHalfModelCheckBox.checked = 0
+            self.ui.showAffineHalfModelCheckbox.enabled = True
+            self.ui.showAffineHalfModelCheckbox.checked = 1
+
+        self.runLogic(logic, register, onDone, "Half model affine registration")
 
     def onShowAffineHalfModelCheckbox(self):
         try:
@@ -520,7 +769,124 @@ class MirrorOrbitReconWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         except:
             pass
 
+    def copyPolyData(self, modelNode, deep=False):
+        """
+        Copy of a model's polydata, so the logic can work on it outside the main thread.
+        The registrations only read their meshes and the progress dialog is modal while they run,
+        so a shallow copy (sharing the points and cells) is enough for them. CPDAffinePolyData moves
+        the points in place, so its mesh needs deep=True to stay off the displayed node until onDone.
+        """
+        polyData = vtk.vtkPolyData()
+        if deep:
+            polyData.DeepCopy(modelNode.GetPolyData())
+        else:
+            polyData.ShallowCopy(modelNode.GetPolyData())
+        return polyData
+
+    def runLogic(self, logic, function, onDone, title):
+        """
+        Run function() and pass its result to onDone().
+        With runInBackground the function runs in a worker thread while a progress dialog
+        shows the logic's stage and allows cancelling; onDone still runs on the main thread.
+        """
+        if not self.runInBackground:
+            with slicer.util.WaitCursor():
+                onDone(function())
+            return
+        self._backgroundTask = BackgroundTask(logic, function, onDone, title)
+        self._backgroundTask.start()
+
+    def startDependencyWarmUp(self):
+        """Run logic.warmUpDependencies in a worker thread and poll for it from a QTimer."""
+        import threading
+
+        self._warmUpStart = time.perf_counter()
+        self._warmUpResult = None
+
+        def warmUp():
+            try:
+                self._warmUpResult = self.logic.warmUpDependencies()
+            except Exception as e:
+                self._warmUpResult = e
+
+        self._warmUpThread = threading.Thread(target=warmUp, daemon=True)
+        self._warmUpThread.start()
+        self._warmUpTimer = qt.QTimer()
+        self._warmUpTimer.setInterval(100)
+        self._warmUpTimer.connect("timeout()", self._pollDependencyWarmUp)
+        self._warmUpTimer.start()
+
+    def dependenciesMissing(self):
+        # Only look for the installed distributions here, importing them is left to the warm-up
+        import importlib.metadata
+
+        for distribution in ("itk-fpfh", "itk-ransac", "cpdalp"):
+            try:
+                importlib.metadata.version(distribution)
+            except importlib.metadata.PackageNotFoundError:
+                return True
+        return False
+
+    def installDependencies(self):
+        progressDialog = slicer.util.createProgressDialog(
+            windowTitle="Installing...",
+            labelText="Installing Python dependencies. This may take a minute...",
+            maximum=0,
+        )
+        slicer.app.processEvents()
+        try:
+            slicer.util.pip_install(["itk~=5.4.0"])
+            slicer.util.pip_install(["scikit-learn"])
+            slicer.util.pip_install(["itk-fpfh~=0.2.0"])
+            slicer.util.pip_install(["itk-ransac~=0.2.1"])
+            slicer.util.pip_install(f"cpdalp")
+        except:
+            slicer.util.infoDisplay("Issue while installing the ITK Python packages")
+        progressDialog.close()
+
+    def _pollDependencyWarmUp(self):
+        if self._warmUpThread.is_alive():
+            return
+        self._warmUpTimer.stop()
+        if isinstance(self._warmUpResult, Exception):
+            print(f"Loading Python packages failed: {self._warmUpResult}")
+            if slicer.util.confirmYesNoDisplay(
+                "Python packages could not be loaded. Reinstall them and try loading again?\n"
+                "If this keeps failing, please restart Slicer to load packages."
+            ):
+                self.installDependencies()
+                self.startDependencyWarmUp()
+            return
+        self.onDependenciesReady(self._warmUpResult, time.perf_counter() - self._warmUpStart)
+
+    def onDependenciesReady(self, timings, seconds):
+        """Record the warm-up time and enable the registration buttons that were waiting for it."""
+        self.dependenciesReady = True
+        self.warmUpSeconds = seconds
+        details = ", ".join(f"{name} {t:.2f} s" for name, t in timings.items())
+        print(f"Python packages ready in {seconds:.2f} s ({details})")
+        slicer.util.showStatusMessage(f"MirrorOrbitRecon: Python packages ready in {seconds:.1f} s", 5000)
+        for button in self._pendingRegistrationButtons:
+            button.enabled = True
+        self._pendingRegistrationButtons = []
+
+    def enableRegistrationButton(self, button):
+        """Enable a button that needs ITK/cpdalp, or once the dependency warm-up has finished."""
+        if self.dependenciesReady:
+            button.enabled = True
+        elif button not in self._pendingRegistrationButtons:
+            self._pendingRegistrationButtons.append(button)
+
     def onResetPushButton(self):
+        self._pendingRegistrationButtons = []
+        if self.incrementalRegistration is not None:
+            self.stopIncrementalRegistration()
+        self.rigidLogic = None
+        self.cutSide = None
+        self.mirroredSkullRigidNode = None
+        self._mirroredRigidShared = False
+        self.analyticMirrorCheckBox.enabled = True
+        self.createMirroredModelButton.enabled = False
         self.ui.originalModelSelector.setCurrentNode(None)
         self.ui.planeLmSelector.setCurrentNode(None)
         self.ui.mirroredModelSelector.setCurrentNode(None)
@@ -568,13 +934,92 @@ class MirrorOrbitReconWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         #     self.initializeParameterNode()
 
 
+#
+# BackgroundTask
+#
+
+
+class BackgroundTask:
+    """Runs a logic call in a worker thread while the main thread shows its progress.
+
+    The logic's progressCallback only records the latest (stage, fraction); a QTimer on the
+    main thread polls it, updates a progress dialog and, when the dialog is cancelled, sets
+    logic.cancelRequested so the worker stops at its next checkpoint. onDone is called with
+    the result on the main thread, so all MRML scene changes happen there.
+    """
+
+    # Progress bar range (percent) covered by each pipeline stage
+    stageRanges = {
+        "subsample": (0, 10),
+        "FPFH": (10, 25),
+        "RANSAC": (25, 60),
+        "ICP": (60, 100),
+        "CPD": (0, 100),
+    }
+
+    def __init__(self, logic, function, onDone, title):
+        self.logic = logic
+        self.function = function
+        self.onDone = onDone
+        self.title = title
+        self.progress = ("subsample", 0.0)
+        self.result = None
+        self.error = None
+        self.thread = None
+
+    def start(self):
+        import threading
+
+        self.logic.progressCallback = self._setProgress
+        self.logic.cancelRequested = False
+        self.progressDialog = slicer.util.createProgressDialog(
+            windowTitle=self.title, labelText=self.title + "...", maximum=100
+        )
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        self.timer = qt.QTimer()
+        self.timer.setInterval(100)
+        self.timer.connect("timeout()", self._poll)
+        self.timer.start()
+
+    def cancel(self):
+        self.logic.cancelRequested = True
+
+    def _setProgress(self, stage, fraction):
+        self.progress = (stage, fraction)
+
+    def _run(self):
+        try:
+            self.result = self.function()
+        except Exception as e:
+            self.error = e
+
+    def _poll(self):
+        if self.progressDialog.wasCanceled:
+            self.cancel()
+        stage, fraction = self.progress
+        low, high = self.stageRanges.get(stage, (0, 100))
+        self.progressDialog.labelText = f"{self.title}: {stage}"
+        self.progressDialog.value = int(low + (high - low) * min(max(fraction, 0.0), 1.0))
+        if self.thread.is_alive():
+            return
+        self.timer.stop()
+        self.progressDialog.close()
+        self.logic.progressCallback = None
+        if isinstance(self.error, RegistrationCancelled):
+            print(f"{self.title} cancelled during {self.error}")
+        elif self.error is not None:
+            slicer.util.errorDisplay(f"{self.title} failed: {self.error}")
+        else:
+            self.onDone(self.result)
+
 
 #
 # MirrorOrbitReconLogic
 #
 
 
-class MirrorOrbitReconLogic(ScriptedLoadableModuleLogic):
+class MirrorOrbitReconLogic(ScriptedLoadableModuleLogic, MirrorOrbitReconCore):
     """This class should implement all the actual
     computation done by your module.  The interface
     should be such that other python code can import
@@ -583,35 +1028,40 @@ class MirrorOrbitReconLogic(ScriptedLoadableModuleLogic):
     Uses ScriptedLoadableModuleLogic base class, available at:
     https://github.com/Slicer/Slicer/blob/main/Base/Python/slicer/ScriptedLoadableModule.py
 
-    The rigid and cpd registration functions are reused from the ALPACA and FastModelAlign modules of SlicerMorph (https://github.com/SlicerMorph/SlicerMorph/tree/master)
+    The registration pipeline itself is in MirrorOrbitReconCore (MirrorOrbitReconLib/MirrorOrbitReconCore.py),
+    this class only adds the MRML scene handling.
     """
 
     def __init__(self) -> None:
         """Called when the logic class is instantiated. Can be used for initializing member variables."""
         ScriptedLoadableModuleLogic.__init__(self)
+        MirrorOrbitReconCore.__init__(self)
 
     def getParameterNode(self):
         return MirrorOrbitReconParameterNode(super().getParameterNode())
 
-    def ITKRegistration(self, sourceModelNode, targetModelNode, scalingOption, parameterDictionary, usePoisson):
+    def ITKRegistration(self, sourceModelNode, targetModelNode, scalingOption, parameterDictionary, usePoisson, initialTransform=None):
         #This function is reused from the ALPACA module of SlicerMorph (https://github.com/SlicerMorph/SlicerMorph/tree/master)
         # import ALPACA
         # logic = ALPACA.ALPACALogic()
-        (
-            sourcePoints,
-            targetPoints,
-            sourceFeatures,
-            targetFeatures,
-            voxelSize,
-            scaling,
-        ) = self.runSubsample(
+        # initialTransform (4x4 numpy matrix) enables the warm start: FPFH and RANSAC are skipped unless
+        # its fitness is below parameterDictionary["warmStartFitnessThreshold"]
+        sourcePoints, targetPoints, scaling, ICPTransform_similarity, similarityFlag = self.rigidRegistration(
             sourceModelNode,
             targetModelNode,
             scalingOption,
             parameterDictionary,
             usePoisson,
+            initialTransform=initialTransform,
+        )
+        scalingTransformNode, ICPTransformNode = self.applyRigidRegistration(
+            sourceModelNode, targetModelNode, scaling, ICPTransform_similarity, similarityFlag
         )
+        return sourcePoints, targetPoints, scalingTransformNode, ICPTransformNode
+
 
+    def applyRigidRegistration(self, sourceModelNode, targetModelNode, scaling, ICPTransform_similarity, similarityFlag):
+        """Create the scaling and rigid transform nodes of a rigidRegistration result and harden it on the source model."""
         #Scaling transform
         print("scaling factor for the source is: " + str(scaling))
         scalingMatrix_vtk = vtk.vtkMatrix4x4()
@@ -626,17 +1076,6 @@ class MirrorOrbitReconLogic(ScriptedLoadableModuleLogic):
         scalingTransformNode.SetAndObserveTransformToParent(scalingTransform)
 
 
-        ICPTransform_similarity, similarityFlag = self.estimateTransform(
-            sourcePoints,
-            targetPoints,
-            sourceFeatures,
-            targetFeatures,
-            voxelSize,
-            scalingOption,
-            parameterDictionary,
-        )
-
-
         vtkSimilarityTransform = self.itkToVTKTransform(
             ICPTransform_similarity, similarityFlag
         )
@@ -644,6 +1083,10 @@ class MirrorOrbitReconLogic(ScriptedLoadableModuleLogic):
         ICPTransformNode = self.convertMatrixToTransformNode(
             vtkSimilarityTransform, ("Rigid Transformation Matrix")
         )
+        # rigidRegistration leaves the source mesh unscaled, so the scaling is hardened before the rigid transform
+        if scaling != 1:
+            sourceModelNode.SetAndObserveTransformNodeID(scalingTransformNode.GetID())
+            slicer.vtkSlicerTransformLogic().hardenTransform(sourceModelNode)
         sourceModelNode.SetAndObserveTransformNodeID(ICPTransformNode.GetID())
         slicer.vtkSlicerTransformLogic().hardenTransform(sourceModelNode)
         sourceModelNode.GetDisplayNode().SetVisibility(True)
@@ -652,911 +1095,43 @@ class MirrorOrbitReconLogic(ScriptedLoadableModuleLogic):
         # sourceModelNode.GetDisplayNode().SetShading(True)
         targetModelNode.GetDisplayNode().SetVisibility(True)
 
-        sourcePoints = self.transform_numpy_points(sourcePoints, ICPTransform_similarity)
-
 
         #Put scaling transform under ICP transform = rigid transform after scaling
         scalingTransformNode.SetAndObserveTransformNodeID(ICPTransformNode.GetID())
 
-        return sourcePoints, targetPoints, scalingTransformNode, ICPTransformNode
-
-
-    def runSubsample(
-        self,
-        sourceModel,
-        targetModel,
-        scalingOption,
-        parameters,
-        usePoissonSubsample=False,
-    ):
-        # This function is reused from the ALPACA module of SlicerMorph (https://github.com/SlicerMorph/SlicerMorph/tree/master)
-        print("parameters are ", parameters)
-        print(":: Loading point clouds and downsampling")
-
-        sourceModelMesh = sourceModel.GetMesh()
-        targetModelMesh = targetModel.GetMesh()
+        return scalingTransformNode, ICPTransformNode
 
-        # Scale the mesh and the landmark points
-        fixedBoxLengths, fixedlength = self.getBoxLengths(targetModelMesh)
-        movingBoxLengths, movinglength = self.getBoxLengths(sourceModelMesh)
 
-        # Sub-Sample the points for rigid refinement and deformable registration
-        point_density = parameters["pointDensity"]
-
-        # Voxel size is the diagonal length of cuboid in the voxelGrid
-        voxel_size = np.sqrt(np.sum(np.square(np.array(fixedBoxLengths)))) / (
-            55 * point_density
-        )
-
-        print("Scale length are  ", fixedlength, movinglength)
-        print("Voxel Size is ", voxel_size)
-
-        scalingFactor = fixedlength / movinglength
-        if scalingOption is False:
-            scalingFactor = 1
-        print("Scaling factor is ", scalingFactor)
-
-        sourceFullMesh_vtk = self.scale_vtk_point_coordinates(sourceModelMesh, scalingFactor)
-        targetFullMesh_vtk = targetModelMesh
-
-        if usePoissonSubsample:
-            print("Using Poisson Point Subsampling Method")
-            sourceMesh_vtk = self.subsample_points_poisson(
-                sourceFullMesh_vtk, radius=voxel_size
-            )
-            targetMesh_vtk = self.subsample_points_poisson(
-                targetFullMesh_vtk, radius=voxel_size
-            )
-        else:
-            sourceMesh_vtk = self.subsample_points_voxelgrid_polydata(
-                sourceFullMesh_vtk, radius=voxel_size
-            )
-            targetMesh_vtk = self.subsample_points_voxelgrid_polydata(
-                targetFullMesh_vtk, radius=voxel_size
-            )
-
-        movingMeshPoints, movingMeshPointNormals = self.extract_pca_normal(
-            sourceMesh_vtk, 30
-        )
-        fixedMeshPoints, fixedMeshPointNormals = self.extract_pca_normal(
-            targetMesh_vtk, 30
-        )
-
-        print("------------------------------------------------------------")
-        print("movingMeshPoints.shape ", movingMeshPoints.shape)
-        print("movingMeshPointNormals.shape ", movingMeshPointNormals.shape)
-        print("fixedMeshPoints.shape ", fixedMeshPoints.shape)
-        print("fixedMeshPointNormals.shape ", fixedMeshPointNormals.shape)
-        print("------------------------------------------------------------")
-
-        fpfh_radius = parameters["FPFHSearchRadius"] * voxel_size
-        fpfh_neighbors = parameters["FPFHNeighbors"]
-        # New FPFH Code
-        pcS = np.expand_dims(fixedMeshPoints, -1)
-        normal_np_pcl = fixedMeshPointNormals
-        target_fpfh = self.get_fpfh_feature(
-            pcS, normal_np_pcl, fpfh_radius, fpfh_neighbors
-        )
-        # print(f"target_fpfh {target_fpfh.shape}: {target_fpfh}")
-
-        pcS = np.expand_dims(movingMeshPoints, -1)
-        normal_np_pcl = movingMeshPointNormals
-        source_fpfh = self.get_fpfh_feature(
-            pcS, normal_np_pcl, fpfh_radius, fpfh_neighbors
-        )
-        # print(f"source_fpfh {source_fpfh.shape}: {source_fpfh}")
-
-        target_down = fixedMeshPoints
-        source_down = movingMeshPoints
-        return source_down, target_down, source_fpfh, target_fpfh, voxel_size, scalingFactor
-
-
-    def getBoxLengths(self, inputMesh):
-        # This function is reused from the ALPACA module of SlicerMorph (https://github.com/SlicerMorph/SlicerMorph/tree/master)
-        import vtk
-
-        box_filter = vtk.vtkBoundingBox()
-        box_filter.SetBounds(inputMesh.GetBounds())
-        diagonalLength = box_filter.GetDiagonalLength()
-        fixedLengths = [0.0, 0.0, 0.0]
-        box_filter.GetLengths(fixedLengths)
-        return fixedLengths, diagonalLength
-
-
-    def get_fpfh_feature(self, points_np, normals_np, radius, neighbors):
-        # This function is reused from the ALPACA module of SlicerMorph (https://github.com/SlicerMorph/SlicerMorph/tree/master)
-        import itk
-
-        pointset = itk.PointSet[itk.F, 3].New()
-        pointset.SetPoints(
-            itk.vector_container_from_array(points_np.flatten().astype("float32"))
-        )
-
-        normalset = itk.PointSet[itk.F, 3].New()
-        normalset.SetPoints(
-            itk.vector_container_from_array(normals_np.flatten().astype("float32"))
-        )
-        fpfh = itk.Fpfh.PointFeature.MF3MF3.New()
-        fpfh.ComputeFPFHFeature(pointset, normalset, float(radius), int(neighbors))
-        result = fpfh.GetFpfhFeature()
-
-        fpfh_feats = itk.array_from_vector_container(result)
-        fpfh_feats = np.reshape(fpfh_feats, [33, pointset.GetNumberOfPoints()]).T
-        return fpfh_feats
-
-
-    def scale_vtk_point_coordinates(self, vtk_polydata, scalingFactor):
-        # This function is reused from the ALPACA module of SlicerMorph (https://github.com/SlicerMorph/SlicerMorph/tree/master)
-        from vtk.util import numpy_support
-
-        points = vtk_polydata.GetPoints()
-        pointdata = points.GetData()
-        points_as_numpy = numpy_support.vtk_to_numpy(pointdata)
-        points_as_numpy = points_as_numpy * scalingFactor
-        self.set_numpy_points_in_vtk(vtk_polydata, points_as_numpy)
-
-        return vtk_polydata
-
-    def set_numpy_points_in_vtk(self, vtk_polydata, points_as_numpy):
-        """
-        Sets the numpy points to a vtk_polydata
-        """
-        # This function is reused from the ALPACA module of SlicerMorph (https://github.com/SlicerMorph/SlicerMorph/tree/master)
-        import vtk
-        from vtk.util import numpy_support
-
-        vtk_data_array = numpy_support.numpy_to_vtk(
-            num_array=points_as_numpy, deep=True, array_type=vtk.VTK_FLOAT
-        )
-        points2 = vtk.vtkPoints()
-        points2.SetData(vtk_data_array)
-        vtk_polydata.SetPoints(points2)
-        return
-
-
-    def subsample_points_poisson(self, inputMesh, radius):
+    def applyMirroredRigidRegistration(self, originalModelNode, reflection, ICPTransform_similarity, similarityFlag, name):
         """
-        Return sub-sampled points as numpy array.
-        The radius might need to be tuned as per the requirements.
+        Model node showing the original model reflected by the 4x4 reflection and moved by the
+        rigidRegistration result. Its polydata shares the original points, with the cell order
+        reversed so the reflected surface is not inside-out, and is displayed through a
+        reflection transform under the rigid transform node, so no mesh points are copied.
+        Do not harden it in place, that would move the original points too (see
+        MirrorOrbitReconWidget.materializeMirroredRigidModel).
         """
-        # This function is reused from the ALPACA module of SlicerMorph (https://github.com/SlicerMorph/SlicerMorph/tree/master)
-        import vtk
-        from vtk.util import numpy_support
-
-        f = vtk.vtkPoissonDiskSampler()
-        f.SetInputData(inputMesh)
-        f.SetRadius(radius)
-        f.Update()
-
-        sampled_points = f.GetOutput()
-        return sampled_points
-
-    def subsample_points_voxelgrid_polydata(self, inputMesh, radius):
-        # This function is reused from the ALPACA module of SlicerMorph (https://github.com/SlicerMorph/SlicerMorph/tree/master)
-        subsample = vtk.vtkVoxelGrid()
-        subsample.SetInputData(inputMesh)
-        subsample.SetConfigurationStyleToLeafSize()
-
-        subsample.SetLeafSize(radius, radius, radius)
-        subsample.Update()
-        points = subsample.GetOutput()
-        return points
-
-
-    def extract_pca_normal(self, mesh, normalNeighbourCount):
-        # This function is reused from the ALPACA module of SlicerMorph (https://github.com/SlicerMorph/SlicerMorph/tree/master)
-        import vtk
-        from vtk.util import numpy_support
-
-        normals = vtk.vtkPCANormalEstimation()
-        normals.SetSampleSize(normalNeighbourCount)
-        # normals.SetFlipNormals(True)
-        normals.SetNormalOrientationToPoint()
-        # normals.SetNormalOrientationToGraphTraversal()
-        normals.SetInputData(mesh)
-        normals.Update()
-        out1 = normals.GetOutput()
-        normal_array = numpy_support.vtk_to_numpy(out1.GetPointData().GetNormals())
-        point_array = numpy_support.vtk_to_numpy(mesh.GetPoints().GetData())
-        return point_array, normal_array
-
-
-    def estimateTransform(
-        self,
-        sourcePoints,
-        targetPoints,
-        sourceFeatures,
-        targetFeatures,
-        voxelSize,
-        scalingOption,
-        parameters,
-    ):
-        # This function is reused from the ALPACA module of SlicerMorph (https://github.com/SlicerMorph/SlicerMorph/tree/master)
-
-        import itk
-
-        similarityFlag = False
-        # Establish correspondences by nearest neighbour search in feature space
-        corrs_A, corrs_B = self.find_correspondences(
-            targetFeatures, sourceFeatures, mutual_filter=True
-        )
-
-        targetPoints = targetPoints.T
-        sourcePoints = sourcePoints.T
-
-        fixed_corr = targetPoints[:, corrs_A]  # np array of size 3 by num_corrs
-        moving_corr = sourcePoints[:, corrs_B]  # np array of size 3 by num_corrs
-
-        num_corrs = fixed_corr.shape[1]
-        print(f"FPFH generates {num_corrs} putative correspondences.")
-
-        targetPoints = targetPoints.T
-        sourcePoints = sourcePoints.T
-
-        # Check corner case when both meshes are same
-        if np.allclose(fixed_corr, moving_corr):
-            print("Same meshes therefore returning Identity Transform")
-            transform = itk.VersorRigid3DTransform[itk.D].New()
-            transform.SetIdentity()
-            return [transform, transform]
-
-        import time
-
-        bransac = time.time()
-
-        maxAttempts = 1
-        attempt = 0
-        best_fitness = -1
-        best_rmse = np.inf
-        while attempt < maxAttempts:
-            # Perform Initial alignment using Ransac parallel iterations with no scaling
-            transform_matrix, fitness, rmse = self.ransac_using_package(
-                movingMeshPoints=sourcePoints,
-                fixedMeshPoints=targetPoints,
-                movingMeshFeaturePoints=moving_corr.T,
-                fixedMeshFeaturePoints=fixed_corr.T,
-                number_of_iterations=parameters["maxRANSAC"],
-                number_of_ransac_points=3,
-                inlier_value=float(parameters["distanceThreshold"]) * voxelSize,
-                scalingOption=False,
-                check_edge_length=True,
-                correspondence_distance=0.9,
-            )
-
-            transform = itk.transform_from_dict(transform_matrix)
-            fitness_forward, rmse_forward = self.get_fitness(
-                sourcePoints,
-                targetPoints,
-                float(parameters["distanceThreshold"]) * voxelSize,
-                transform,
-            )
-
-            mean_fitness = fitness_forward
-            mean_rmse = rmse_forward
-            print(
-                "Non-Scaling Attempt = ",
-                attempt,
-                " Fitness = ",
-                mean_fitness,
-                " RMSE is ",
-                mean_rmse,
-            )
-
-            if mean_fitness > 0.99:
-                # Only compare RMSE if mean_fitness is greater than 0.99
-                if mean_rmse < best_rmse:
-                    best_fitness = mean_fitness
-                    best_rmse = mean_rmse
-                    best_transform = transform_matrix
-            else:
-                if mean_fitness > best_fitness:
-                    best_fitness = mean_fitness
-                    best_rmse = mean_rmse
-                    best_transform = transform_matrix
-
-            # Rigid Transform is un-fit for this use-case so perform scaling based RANSAC
-            # if mean_fitness < 0.9:
-            #  break
-            attempt = attempt + 1
-
-        print("Best Fitness without Scaling ", best_fitness, " RMSE is ", best_rmse)
-
-        if scalingOption:
-            maxAttempts = 10
-            attempt = 0
-
-            correspondence_distance = 0.9
-            ransac_points = 3
-            ransac_iterations = int(parameters["maxRANSAC"])
-
-            while mean_fitness < 0.99 and attempt < maxAttempts:
-                transform_matrix, fitness, rmse = self.ransac_using_package(
-                    movingMeshPoints=sourcePoints,
-                    fixedMeshPoints=targetPoints,
-                    movingMeshFeaturePoints=moving_corr.T,
-                    fixedMeshFeaturePoints=fixed_corr.T,
-                    number_of_iterations=ransac_iterations,
-                    number_of_ransac_points=ransac_points,
-                    inlier_value=float(parameters["distanceThreshold"]) * voxelSize,
-                    scalingOption=True,
-                    check_edge_length=False,
-                    correspondence_distance=correspondence_distance,
-                )
-
-                transform = itk.transform_from_dict(transform_matrix)
-                fitness_forward, rmse_forward = self.get_fitness(
-                    sourcePoints,
-                    targetPoints,
-                    float(parameters["distanceThreshold"]) * voxelSize,
-                    transform,
-                )
-
-                mean_fitness = fitness_forward
-                mean_rmse = rmse_forward
-                print(
-                    "Scaling Attempt = ",
-                    attempt,
-                    " Fitness = ",
-                    mean_fitness,
-                    " RMSE = ",
-                    mean_rmse,
-                )
-
-                if (mean_fitness > best_fitness) or (
-                    mean_fitness == best_fitness and mean_rmse < best_rmse
-                ):
-                    best_fitness = mean_fitness
-                    best_rmse = mean_rmse
-                    best_transform = transform_matrix
-                    similarityFlag = True
-                attempt = attempt + 1
-
-        aransac = time.time()
-        print("RANSAC Duraction ", aransac - bransac)
-        print("Best Fitness after scaling ", best_fitness)
-
-        first_transform = itk.transform_from_dict(best_transform)
-        sourcePoints = self.transform_numpy_points(sourcePoints, first_transform)
-
-        print("-----------------------------------------------------------")
-        print(parameters)
-        print("Starting Rigid Refinement")
-        distanceThreshold = parameters["ICPDistanceThreshold"] * voxelSize
-        inlier, rmse = self.get_fitness(sourcePoints, targetPoints, distanceThreshold)
-        print("Before Inlier = ", inlier, " RMSE = ", rmse)
-        _, second_transform = self.final_iteration_icp(
-            targetPoints,
-            sourcePoints,
-            distanceThreshold,
-            float(parameters["normalSearchRadius"] * voxelSize),
-        )
-
-        final_mesh_points = self.transform_numpy_points(sourcePoints, second_transform)
-        inlier, rmse = self.get_fitness(
-            final_mesh_points, targetPoints, distanceThreshold
-        )
-        print("After Inlier = ", inlier, " RMSE = ", rmse)
-        first_transform.Compose(second_transform)
-        return first_transform, similarityFlag
-
-
-
-    def find_correspondences(self, feats0, feats1, mutual_filter=True):
-        """
-        This function is reused from the ALPACA module of SlicerMorph (https://github.com/SlicerMorph/SlicerMorph/tree/master)
-        Using the FPFH features find noisy corresspondes.
-        These corresspondes will be used inside the RANSAC.
-        """
-        nns01, dists1 = self.find_knn_cpu(feats0, feats1, knn=1, return_distance=True)
-        corres01_idx0 = np.arange(len(nns01))
-        corres01_idx1 = nns01
-
-        if not mutual_filter:
-            return corres01_idx0, corres01_idx1
-
-        nns10, dists2 = self.find_knn_cpu(feats1, feats0, knn=1, return_distance=True)
-        corres10_idx1 = np.arange(len(nns10))
-        corres10_idx0 = nns10
-
-        mutual_filter = corres10_idx0[corres01_idx1] == corres01_idx0
-        corres_idx0 = corres01_idx0[mutual_filter]
-        corres_idx1 = corres01_idx1[mutual_filter]
-
-        return corres_idx0, corres_idx1
-
-
-    def find_knn_cpu(self, feat0, feat1, knn=1, return_distance=False):
-        from scipy.spatial import cKDTree
-
-        feat1tree = cKDTree(feat1)
-        dists, nn_inds = feat1tree.query(feat0, k=knn)
-        if return_distance:
-            return nn_inds, dists
-        else:
-            return nn_inds
-
-    def get_fitness(
-        self, movingMeshPoints, fixedMeshPoints, distanceThrehold, transform=None
-    ):
-        import itk
-
-        movingPointSet = itk.Mesh.F3.New()
-        movingPointSet.SetPoints(
-            itk.vector_container_from_array(
-                movingMeshPoints.flatten().astype("float32")
-            )
-        )
-
-        fixedPointSet = itk.Mesh.F3.New()
-        fixedPointSet.SetPoints(
-            itk.vector_container_from_array(fixedMeshPoints.flatten().astype("float32"))
-        )
-
-        if transform is not None:
-            movingPointSet = itk.transform_mesh_filter(
-                movingPointSet, transform=transform
-            )
-
-        PointType = itk.Point[itk.F, 3]
-        PointsContainerType = itk.VectorContainer[itk.IT, PointType]
-        pointsLocator = itk.PointsLocator[PointsContainerType].New()
-        pointsLocator.SetPoints(fixedPointSet.GetPoints())
-        pointsLocator.Initialize()
-
-        fitness = 0
-        inlier_rmse = 0
-        for i in range(movingPointSet.GetNumberOfPoints()):
-            closestPoint = pointsLocator.FindClosestPoint(movingPointSet.GetPoint(i))
-            distance = (
-                fixedPointSet.GetPoint(closestPoint) - movingPointSet.GetPoint(i)
-            ).GetNorm()
-            if distance < distanceThrehold:
-                fitness = fitness + 1
-                inlier_rmse = inlier_rmse + distance
-
-        return fitness / movingPointSet.GetNumberOfPoints(), inlier_rmse / fitness
-
-
-    def ransac_using_package(
-        self,
-        movingMeshPoints,
-        fixedMeshPoints,
-        movingMeshFeaturePoints,
-        fixedMeshFeaturePoints,
-        number_of_iterations,
-        number_of_ransac_points,
-        inlier_value,
-        scalingOption,
-        check_edge_length,
-        correspondence_distance,
-    ):
-        # This function is reused from the ALPACA module of SlicerMorph (https://github.com/SlicerMorph/SlicerMorph/tree/master)
-        import itk
-
-        def GenerateData(data, agreeData):
-            """
-            In current implementation the agreedata contains two corresponding
-            points from moving and fixed mesh. However, after the subsampling step the
-            number of points need not be equal in those meshes. So we randomly sample
-            the points from larger mesh.
-            """
-            data.reserve(movingMeshFeaturePoints.shape[0])
-            for i in range(movingMeshFeaturePoints.shape[0]):
-                point1 = movingMeshFeaturePoints[i]
-                point2 = fixedMeshFeaturePoints[i]
-                input_data = [
-                    point1[0],
-                    point1[1],
-                    point1[2],
-                    point2[0],
-                    point2[1],
-                    point2[2],
-                ]
-                input_data = [float(x) for x in input_data]
-                data.push_back(input_data)
-
-            count_min = int(
-                np.min([movingMeshPoints.shape[0], fixedMeshPoints.shape[0]])
-            )
-
-            mesh1_points = copy.deepcopy(movingMeshPoints)
-            mesh2_points = copy.deepcopy(fixedMeshPoints)
-
-            np.random.seed(0)
-            np.random.shuffle(mesh1_points)
-            np.random.seed(0)
-            np.random.shuffle(mesh2_points)
-
-            agreeData.reserve(count_min)
-            for i in range(count_min):
-                point1 = mesh1_points[i]
-                point2 = mesh2_points[i]
-                input_data = [
-                    point1[0],
-                    point1[1],
-                    point1[2],
-                    point2[0],
-                    point2[1],
-                    point2[2],
-                ]
-                input_data = [float(x) for x in input_data]
-                agreeData.push_back(input_data)
-            return
-
-        data = itk.vector[itk.Point[itk.D, 6]]()
-        agreeData = itk.vector[itk.Point[itk.D, 6]]()
-        GenerateData(data, agreeData)
-
-        transformParameters = itk.vector.D()
-        bestTransformParameters = itk.vector.D()
-
-        itk.MultiThreaderBase.SetGlobalDefaultThreader(
-            itk.MultiThreaderBase.ThreaderTypeFromString("POOL")
-        )
-        maximumDistance = inlier_value
-        if not scalingOption:
-            print("Rigid Reg, no scaling")
-            TransformType = itk.VersorRigid3DTransform[itk.D]
-            RegistrationEstimatorType = itk.Ransac.LandmarkRegistrationEstimator[
-                6, TransformType
-            ]
-        else:
-            print("NonRigid Reg, with scaling")
-            TransformType = itk.Similarity3DTransform[itk.D]
-            RegistrationEstimatorType = itk.Ransac.LandmarkRegistrationEstimator[
-                6, TransformType
-            ]
-        registrationEstimator = RegistrationEstimatorType.New()
-        registrationEstimator.SetMinimalForEstimate(number_of_ransac_points)
-        registrationEstimator.SetAgreeData(agreeData)
-        registrationEstimator.SetDelta(maximumDistance)
-        registrationEstimator.LeastSquaresEstimate(data, transformParameters)
-
-        maxThreadCount = int(
-            itk.MultiThreaderBase.New().GetMaximumNumberOfThreads() / 2
-        )
-
-        desiredProbabilityForNoOutliers = 0.99
-        RANSACType = itk.RANSAC[itk.Point[itk.D, 6], itk.D, TransformType]
-        ransacEstimator = RANSACType.New()
-        ransacEstimator.SetData(data)
-        ransacEstimator.SetAgreeData(agreeData)
-        ransacEstimator.SetCheckCorresspondenceDistance(check_edge_length)
-        if correspondence_distance > 0:
-            ransacEstimator.SetCheckCorrespondenceEdgeLength(correspondence_distance)
-        ransacEstimator.SetMaxIteration(int(number_of_iterations / maxThreadCount))
-        ransacEstimator.SetNumberOfThreads(maxThreadCount)
-        ransacEstimator.SetParametersEstimator(registrationEstimator)
-
-        percentageOfDataUsed = ransacEstimator.Compute(
-            transformParameters, desiredProbabilityForNoOutliers
-        )
-
-        transform = TransformType.New()
-        p = transform.GetParameters()
-        f = transform.GetFixedParameters()
-        for i in range(p.GetSize()):
-            p.SetElement(i, transformParameters[i])
-        counter = 0
-        totalParameters = p.GetSize() + f.GetSize()
-        for i in range(p.GetSize(), totalParameters):
-            f.SetElement(counter, transformParameters[i])
-            counter = counter + 1
-        transform.SetParameters(p)
-        transform.SetFixedParameters(f)
-        return (
-            itk.dict_from_transform(transform),
-            percentageOfDataUsed[0],
-            percentageOfDataUsed[1],
-        )
-
-
-    def itkToVTKTransform(self, itkTransform, similarityFlag=False):
-        matrix = itkTransform.GetMatrix()
-        offset = itkTransform.GetOffset()
-
-        matrix_vtk = vtk.vtkMatrix4x4()
-        for i in range(3):
-            for j in range(3):
-                matrix_vtk.SetElement(i, j, matrix(i, j))
-        for i in range(3):
-            matrix_vtk.SetElement(i, 3, offset[i])
-
-        transform = vtk.vtkTransform()
-        transform.SetMatrix(matrix_vtk)
-        return transform
-
-
-    def transform_numpy_points(self, points_np, transform):
-        import itk
-
-        mesh = itk.Mesh[itk.F, 3].New()
-        mesh.SetPoints(
-            itk.vector_container_from_array(points_np.flatten().astype("float32"))
-        )
-        transformed_mesh = itk.transform_mesh_filter(mesh, transform=transform)
-        points_tranformed = itk.array_from_vector_container(
-            transformed_mesh.GetPoints()
-        )
-        points_tranformed = np.reshape(points_tranformed, [-1, 3])
-        return points_tranformed
-
-
-    def final_iteration_icp(
-        self, fixedPoints, movingPoints, distanceThreshold, normalSearchRadius
-    ):
-        import itk
-        fixedPointsNormal = self.extract_pca_normal_scikit(
-            fixedPoints, normalSearchRadius
-        )
-        movingPointsNormal = self.extract_pca_normal_scikit(
-            movingPoints, normalSearchRadius
-        )
-
-        _, (T, R, t) = self.point_to_plane_icp(
-            movingPoints,
-            fixedPoints,
-            movingPointsNormal,
-            fixedPointsNormal,
-            distanceThreshold,
+        ICPTransformNode = self.convertMatrixToTransformNode(
+            self.itkToVTKTransform(ICPTransform_similarity, similarityFlag), "Rigid Transformation Matrix"
         )
-
-        transform = itk.Rigid3DTransform.D.New()
-        transform.SetMatrix(itk.matrix_from_array(R), 0.000001)
-        transform.SetTranslation([t[0], t[1], t[2]])
-        return movingPoints, transform
-
-    def point_to_plane_icp(
-        self,
-        src_pts,
-        dst_pts,
-        src_pt_normals,
-        dst_pt_normals,
-        dist_threshold=np.inf,
-        max_iterations=30,
-        tolerance=0.000001,
-    ):
-        """
-            The Iterative Closest Point method: finds best-fit transform that
-                maps points A on to points B
-            Input:
-                A: Nxm numpy array of source mD points
-                B: Nxm numpy array of destination mD point
-                max_iterations: exit algorithm after max_iterations
-                tolerance: convergence criteria
-            Output:
-                T: final homogeneous transformation that maps A on to B
-                MeanError: list, report each iteration's distance mean error
-        """
-        A = src_pts
-        A_normals = src_pt_normals
-        B = dst_pts
-        B_normals = dst_pt_normals
-
-        # get number of dimensions
-        m = A.shape[1]
-
-        # make points homogeneous, copy them to maintain the originals
-        src = np.ones((m + 1, A.shape[0]))
-        dst = np.ones((m + 1, B.shape[0]))
-        src[:m, :] = np.copy(A.T)
-        dst[:m, :] = np.copy(B.T)
-
-        prev_error = 0
-        MeanError = []
-
-        finalT = np.identity(4)
-
-        for i in range(max_iterations):
-            # find the nearest neighbors between the current source and destination points
-            distances, indices = self.nearest_neighbor(src[:m, :].T, dst[:m, :].T)
-
-            # match each point of source-set to closest point of destination-set,
-            matched_src_pts = src[:m, :].T.copy()
-            matched_dst_pts = dst[:m, indices].T
-
-            # compute angle between 2 matched vertexs' normals
-            matched_src_pt_normals = A_normals.copy()
-            matched_dst_pt_normals = B_normals[indices, :]
-            angles = np.zeros(matched_src_pt_normals.shape[0])
-            for k in range(matched_src_pt_normals.shape[0]):
-                v1 = matched_src_pt_normals[k, :]
-                v2 = matched_dst_pt_normals[k, :]
-                cos_angle = v1.dot(v2) / (np.linalg.norm(v1) * np.linalg.norm(v2))
-                angles[k] = np.arccos(cos_angle) / np.pi * 180
-
-            # and reject the bad corresponding
-            # dist_threshold = np.inf
-            dist_bool_flag = distances < dist_threshold
-            angle_threshold = 20
-            angle_bool_flag = angles < angle_threshold
-            reject_part_flag = dist_bool_flag  # * angle_bool_flag
-
-            # get matched vertices and dst_vertexes' normals
-            matched_src_pts = matched_src_pts[reject_part_flag, :]
-            matched_dst_pts = matched_dst_pts[reject_part_flag, :]
-            matched_dst_pt_normals = matched_dst_pt_normals[reject_part_flag, :]
-
-            # compute the transformation between the current source and nearest destination points
-            T, _, _ = self.best_fit_transform_point2plane(
-                matched_src_pts, matched_dst_pts, matched_dst_pt_normals
-            )
-
-            finalT = np.dot(T, finalT)
-
-            # update the current source
-            src = np.dot(T, src)
-
-            # print iteration
-            # print('\ricp iteration: %d/%d ...' % (i+1, max_iterations), end='', flush=True)
-
-            # check error
-            mean_error = np.mean(distances[reject_part_flag])
-            MeanError.append(mean_error)
-            if tolerance is not None:
-                if np.abs(prev_error - mean_error) < tolerance:
-                    break
-            prev_error = mean_error
-        print("Refinement took ", i, " iterations")
-        # calculate final transformation
-        # T, R, t = self.best_fit_transform_point2point(A, src[:m, :].T)
-        # return MeanError, (T, R, t)
-        return MeanError, (finalT, finalT[:3, :3], finalT[:, 3])
-
-
-    def nearest_neighbor(self, src, dst):
-        """
-        Find the nearest (Euclidean) neighbor in dst for each point in src
-        Input:
-            src: Nxm array of points
-            dst: Nxm array of points
-        Output:
-            distances: Euclidean distances of the nearest neighbor
-            indices: dst indices of the nearest neighbor
-        """
-            # assert src.shape == dst.shape
-        from sklearn.neighbors import NearestNeighbors
-        neigh = NearestNeighbors(n_neighbors=1, algorithm="kd_tree")
-        neigh.fit(dst)
-        distances, indices = neigh.kneighbors(src, return_distance=True)
-        return distances.ravel(), indices.ravel()
-
-
-    def best_fit_transform_point2plane(self, A, B, normals):
-        """
-            reference: https://www.comp.nus.edu.sg/~lowkl/publications/lowk_point-to-plane_icp_techrep.pdf
-            Input:
-            A: Nx3 numpy array of corresponding points
-            B: Nx3 numpy array of corresponding points
-            normals: Nx3 numpy array of B's normal vectors
-            Returns:
-            T: (m+1)x(m+1) homogeneous transformation matrix that maps A on to B
-            R: mxm rotation matrix
-            t: mx1 translation vector
-        """
-        assert A.shape == B.shape
-        assert A.shape == normals.shape
-
-        H = []
-        b = []
-        for i in range(A.shape[0]):
-            dx = B[i, 0]
-            dy = B[i, 1]
-            dz = B[i, 2]
-            nx = normals[i, 0]
-            ny = normals[i, 1]
-            nz = normals[i, 2]
-            sx = A[i, 0]
-            sy = A[i, 1]
-            sz = A[i, 2]
-
-            _a1 = (nz * sy) - (ny * sz)
-            _a2 = (nx * sz) - (nz * sx)
-            _a3 = (ny * sx) - (nx * sy)
-
-            _a = np.array([_a1, _a2, _a3, nx, ny, nz])
-            _b = (nx * dx) + (ny * dy) + (nz * dz) - (nx * sx) - (ny * sy) - (nz * sz)
-
-            H.append(_a)
-            b.append(_b)
-
-        H = np.array(H)
-        b = np.array(b)
-
-        tr = np.dot(np.linalg.pinv(H), b)
-        T = self.euler_matrix(tr[0], tr[1], tr[2])
-        T[0, 3] = tr[3]
-        T[1, 3] = tr[4]
-        T[2, 3] = tr[5]
-
-        R = T[:3, :3]
-        t = T[:3, 3]
-
-        return T, R, t
-
-
-    def euler_matrix(self, ai, aj, ak):
-        """Return homogeneous rotation matrix from Euler angles and axis sequence.
-        ai, aj, ak : Euler's roll, pitch and yaw angles
-        axes : One of 24 axis sequences as string or encoded tuple
-        >>> R = euler_matrix(1, 2, 3, 'syxz')
-        >>> numpy.allclose(numpy.sum(R[0]), -1.34786452)
-        True
-        >>> R = euler_matrix(1, 2, 3, (0, 1, 0, 1))
-        """
-
-        firstaxis, parity, repetition, frame = (0, 0, 0, 0)
-        _NEXT_AXIS = [1, 2, 0, 1]
-
-        i = firstaxis
-        j = _NEXT_AXIS[i + parity]
-        k = _NEXT_AXIS[i - parity + 1]
-
-        if frame:
-            ai, ak = ak, ai
-        if parity:
-            ai, aj, ak = -ai, -aj, -ak
-
-        si, sj, sk = math.sin(ai), math.sin(aj), math.sin(ak)
-        ci, cj, ck = math.cos(ai), math.cos(aj), math.cos(ak)
-        cc, cs = ci * ck, ci * sk
-        sc, ss = si * ck, si * sk
-
-        M = np.identity(4)
-        if repetition:
-            M[i, i] = cj
-            M[i, j] = sj * si
-            M[i, k] = sj * ci
-            M[j, i] = sj * sk
-            M[j, j] = -cj * ss + cc
-            M[j, k] = -cj * cs - sc
-            M[k, i] = -sj * ck
-            M[k, j] = cj * sc + cs
-            M[k, k] = cj * cc - ss
-        else:
-            M[i, i] = cj * ck
-            M[i, j] = sj * sc - cs
-            M[i, k] = sj * cc + ss
-            M[j, i] = cj * sk
-            M[j, j] = sj * ss + cc
-            M[j, k] = sj * cs - sc
-            M[k, i] = -sj
-            M[k, j] = cj * si
-            M[k, k] = cj * ci
-        return M
-
-
-    def extract_pca_normal_scikit(self, inputPoints, searchRadius):
-        from sklearn.neighbors import KDTree
-        from sklearn.decomposition import PCA
-
-        data = inputPoints
-        tree = KDTree(data, metric="minkowski")  # minkowki is p2 (euclidean)
-
-        # Get indices and distances:
-        ind, dist = tree.query_radius(data, r=searchRadius, return_distance=True)
-
-        def PCA_unit_vector(array, pca=PCA(n_components=3)):
-            pca.fit(array)
-            eigenvalues = pca.explained_variance_
-            return pca.components_[np.argmin(eigenvalues)]
-
-        def calc_angle_with_xy(vectors):
-            l = np.sum(vectors[:, :2] ** 2, axis=1) ** 0.5
-            return np.arctan2(vectors[:, 2], l)
-
-        normals2 = []
-        for i in range(data.shape[0]):
-            if len(ind[i]) < 3:
-                normal_vector = np.identity(3)
-            else:
-                normal_vector = data[ind[i]]
-            normals2.append(PCA_unit_vector(normal_vector))
-
-        n = np.array(normals2)
-        n[calc_angle_with_xy(n) < 0] *= -1
-        return n
-
+        reflectionNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLTransformNode", "mirror_reflection")
+        slicer.util.updateTransformMatrixFromArray(reflectionNode, reflection)
+        reflectionNode.SetAndObserveTransformNodeID(ICPTransformNode.GetID())
+
+        reverse = vtk.vtkReverseSense()
+        reverse.SetInputData(originalModelNode.GetPolyData())
+        reverse.ReverseCellsOn()
+        reverse.ReverseNormalsOn()
+        reverse.Update()
+
+        modelNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLModelNode", name)
+        modelNode.SetAndObservePolyData(reverse.GetOutput())
+        modelNode.CreateDefaultDisplayNodes()
+        modelNode.SetAndObserveTransformNodeID(reflectionNode.GetID())
+        modelNode.GetDisplayNode().SetColor(1, 0, 0)
+        modelNode.GetDisplayNode().SetVisibility(True)
+        originalModelNode.GetDisplayNode().SetVisibility(True)
+        return modelNode
 
     def convertMatrixToTransformNode(self, vtkTransform, transformName):
         transformNode = slicer.mrmlScene.AddNewNodeByClass(
@@ -1566,24 +1141,8 @@ class MirrorOrbitReconLogic(ScriptedLoadableModuleLogic):
         return transformNode
 
 
-    def CPDAffineTransform(self, sourceModelNode, sourcePoints, targetPoints):
-       from cpdalp import AffineRegistration
-       import vtk.util.numpy_support as nps
-
-       polyData = sourceModelNode.GetPolyData()
-       points = polyData.GetPoints()
-       numpyModel = nps.vtk_to_numpy(points.GetData())
-
-       reg = AffineRegistration(**{'X': targetPoints, 'Y': sourcePoints, 'low_rank':True})
-       reg.register()
-       TY = reg.transform_point_cloud(numpyModel)
-       vtkArray = nps.numpy_to_vtk(TY)
-       points.SetData(vtkArray)
-       polyData.Modified()
-
-       affine_matrix, translation = reg.get_registration_parameters()
-
-       return affine_matrix, translation
+    def CPDAffineTransform(self, sourceModelNode, sourcePoints, targetPoints, parameters=None):
+       return self.CPDAffinePolyData(sourceModelNode.GetPolyData(), sourcePoints, targetPoints, parameters)
 
 
 #
@@ -1608,48 +1167,44 @@ class MirrorOrbitReconTest(ScriptedLoadableModuleTest):
         self.test_MirrorOrbitRecon1()
 
     def test_MirrorOrbitRecon1(self):
-        """Ideally you should have several levels of tests.  At the lowest level
-        tests should exercise the functionality of the logic with different inputs
-        (both valid and invalid).  At higher levels your tests should emulate the
-        way the user would interact with your code and confirm that it still works
-        the way you intended.
-        One of the most important features of the tests is that it should alert other
-        developers when their changes will have an impact on the behavior of your
-        module.  For example, if a developer removes a feature that you depend on,
-        your test should break so they know that the feature is needed.
+        """Register a rigidly perturbed and an affinely perturbed synthetic skull back onto the original,
+        through model nodes as the widget does, and check that the known perturbation is undone.
         """
 
         self.delayDisplay("Starting the test")
 
-        # Get/create input data
-
-        import SampleData
-
-        registerSampleData()
-        inputVolume = SampleData.downloadSample("MirrorOrbitRecon1")
-        self.delayDisplay("Loaded test data set")
-
-        inputScalarRange = inputVolume.GetImageData().GetScalarRange()
-        self.assertEqual(inputScalarRange[0], 0)
-        self.assertEqual(inputScalarRange[1], 695)
-
-        outputVolume = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLScalarVolumeNode")
-        threshold = 100
-
-        # Test the module logic
+        from MirrorOrbitReconLib.MirrorOrbitReconBenchmark import makePerturbation, makeSyntheticSkull, meanVertexError
+        from MirrorOrbitReconLib.MirrorOrbitReconBatch import transformPolyData
 
+        targetPolyData = makeSyntheticSkull(20000)
+        targetNode = slicer.modules.models.logic().AddModel(targetPolyData)
         logic = MirrorOrbitReconLogic()
-
-        # Test algorithm with non-inverted threshold
-        logic.process(inputVolume, outputVolume, threshold, True)
-        outputScalarRange = outputVolume.GetImageData().GetScalarRange()
-        self.assertEqual(outputScalarRange[0], inputScalarRange[0])
-        self.assertEqual(outputScalarRange[1], threshold)
-
-        # Test algorithm with inverted threshold
-        logic.process(inputVolume, outputVolume, threshold, False)
-        outputScalarRange = outputVolume.GetImageData().GetScalarRange()
-        self.assertEqual(outputScalarRange[0], inputScalarRange[0])
-        self.assertEqual(outputScalarRange[1], inputScalarRange[1])
+        parameters = dict(DEFAULT_PARAMETERS)
+        parameters["useFeatureCache"] = False
+
+        # Rigid registration of the full skull
+        perturbation = makePerturbation("rigid")
+        sourcePolyData = transformPolyData(targetPolyData, perturbation)
+        sourceNode = slicer.modules.models.logic().AddModel(sourcePolyData)
+        _, _, _, transform, _ = logic.rigidRegistration(sourceNode, targetNode, False, parameters, False)
+        matrix = logic.itk_transform_to_matrix(transform)
+        self.assertLess(meanVertexError(sourcePolyData, matrix, targetPolyData), 0.5)
+        self.assertLess(np.abs(matrix @ perturbation - np.identity(4)).max(), 0.01)
+        self.delayDisplay("Rigid registration passed")
+
+        # Similarity then affine registration, applied in place to the model node
+        perturbation = makePerturbation("affine")
+        sourcePolyData = transformPolyData(targetPolyData, perturbation)
+        sourceNode.SetAndObservePolyData(sourcePolyData)
+        originalPoints = slicer.util.arrayFromModelPoints(sourceNode).copy()
+        sourcePoints, targetPoints, scaling, transform, _ = logic.rigidRegistration(
+            sourceNode, targetNode, True, parameters, False
+        )
+        # The scaling is applied to the subsampled points only
+        self.assertTrue(np.array_equal(slicer.util.arrayFromModelPoints(sourceNode), originalPoints))
+        matrix = logic.itk_transform_to_matrix(transform) @ np.diag([scaling, scaling, scaling, 1.0])
+        sourceNode.SetAndObservePolyData(transformPolyData(sourcePolyData, matrix))
+        logic.CPDAffineTransform(sourceNode, sourcePoints, targetPoints)
+        self.assertLess(meanVertexError(sourceNode.GetPolyData(), np.identity(4), targetPolyData), 1.0)
 
         self.delayDisplay("Test passed")
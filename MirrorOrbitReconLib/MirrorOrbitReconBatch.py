@@ -0,0 +1,257 @@
+"""
+Headless batch processing for MirrorOrbitRecon.
+
+Runs the widget workflow (mirror, rigid, plane cut, half rigid, half affine) for every
+case of a manifest, without building a MRML scene, and spreads the cases over a
+process pool.
+
+The manifest is a CSV file with the columns
+    id              case name, used for the output folder
+    skull           path of the skull mesh (.vtk, .vtp, .stl, .ply, .obj)
+    planeLandmarks  path of the three mirror plane landmarks (.fcsv or .mrk.json)
+    side            half to keep, "positive" (left side in the widget) or "negative"
+Relative paths are resolved against the manifest folder. Coordinates are used as
+stored, so the landmark files must use the same coordinate system as the meshes.
+
+For every case, <output>/<id>/ receives rigid.vtp, half_rigid.vtp and half_affine.vtp,
+the 4x4 matrices rigid_transform.txt, half_rigid_transform.txt and affine_transform.txt,
+and summary.json.
+
+Only MirrorOrbitReconCore is used, so this runs from plain Python (or PythonSlicer) as long
+as vtk, itk (with itk-fpfh and itk-ransac), scikit-learn, scipy and cpdalp are installed.
+Run it as a module from the folder that holds MirrorOrbitRecon.py.
+
+Usage:
+    python -m MirrorOrbitReconLib.MirrorOrbitReconBatch manifest.csv output --workers 4
+"""
+
+import argparse
+import csv
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+
+def readPolyData(path):
+    import vtk
+
+    extension = os.path.splitext(path)[1].lower()
+    readers = {
+        ".vtk": vtk.vtkPolyDataReader,
+        ".vtp": vtk.vtkXMLPolyDataReader,
+        ".stl": vtk.vtkSTLReader,
+        ".ply": vtk.vtkPLYReader,
+        ".obj": vtk.vtkOBJReader,
+    }
+    if extension not in readers:
+        raise ValueError(f"Unsupported mesh format: {path}")
+    reader = readers[extension]()
+    reader.SetFileName(path)
+    reader.Update()
+    return reader.GetOutput()
+
+
+def writePolyData(polyData, path):
+    import vtk
+
+    writer = vtk.vtkXMLPolyDataWriter()
+    writer.SetFileName(path)
+    writer.SetInputData(polyData)
+    writer.Write()
+
+
+def readPlaneLandmarks(path):
+    """Return the first three control points of a .fcsv or .mrk.json file as a 3x3 array."""
+    if path.lower().endswith(".json"):
+        with open(path) as f:
+            markups = json.load(f)["markups"][0]
+        points = [controlPoint["position"] for controlPoint in markups["controlPoints"]]
+    else:
+        points = []
+        with open(path) as f:
+            for line in f:
+                if line.startswith("#") or not line.strip():
+                    continue
+                fields = line.split(",")
+                points.append([float(x) for x in fields[1:4]])
+    if len(points) < 3:
+        raise ValueError(f"Need three plane landmarks in {path}")
+    return np.array(points[:3], dtype=np.float64)
+
+
+def planeFromLandmarks(landmarks):
+    """Origin and unit normal of the plane through three points, as a 3-point markups plane defines them."""
+    origin = landmarks[0]
+    normal = np.cross(landmarks[1] - landmarks[0], landmarks[2] - landmarks[0])
+    return origin, normal / np.linalg.norm(normal)
+
+
+def transformPolyData(polyData, matrix):
+    """Return a copy of polyData transformed by a 4x4 numpy matrix."""
+    import vtk
+
+    transform = vtk.vtkTransform()
+    transform.SetMatrix(matrix.ravel().tolist())
+    transformFilter = vtk.vtkTransformPolyDataFilter()
+    transformFilter.SetInputData(polyData)
+    transformFilter.SetTransform(transform)
+    transformFilter.Update()
+    return transformFilter.GetOutput()
+
+
+def planeCutPolyData(polyData, origin, normal, side):
+    """Keep the part of polyData on the given side ("positive" or "negative") of the plane."""
+    from MirrorOrbitReconLib.MirrorOrbitReconCore import MirrorOrbitReconCore
+
+    return MirrorOrbitReconCore().planeCutPolyData(polyData, origin, normal, side)
+
+
+def affineMatrix(transformation, translation):
+    """4x4 matrix of a CPD affine result, laid out as in the widget's affine transform node."""
+    matrix = np.identity(4)
+    matrix[:3, :3] = np.asarray(transformation).T
+    matrix[:3, 3] = translation
+    return matrix
+
+
+def processCase(case, parameters, outputDirectory):
+    """Run mirror, rigid, cut, half rigid and half affine for one manifest row."""
+    from MirrorOrbitReconLib.MirrorOrbitReconCore import MirrorOrbitReconCore, RunMetrics
+
+    start = time.perf_counter()
+    caseDirectory = os.path.join(outputDirectory, case["id"])
+    os.makedirs(caseDirectory, exist_ok=True)
+    logic = MirrorOrbitReconCore()
+
+    originalSkull = readPolyData(case["skull"])
+    origin, normal = planeFromLandmarks(readPlaneLandmarks(case["planeLandmarks"]))
+    side = case.get("side") or "positive"
+
+    # Full skull rigid registration of the mirror, reflecting only the subsampled points;
+    # the mirrored mesh is built once, already registered
+    reflection = MirrorOrbitReconCore.reflectionMatrix(origin, normal)
+    sourcePoints, targetPoints, _, rigidTransform, _ = logic.rigidRegistration(
+        originalSkull, originalSkull, False, parameters, False, sourceTransform=reflection
+    )
+    rigidMatrix = logic.itk_transform_to_matrix(rigidTransform)
+    metrics = {"rigid": logic.metrics.asDict()}
+    mirroredSkullRigid = logic.mirrorPolyData(originalSkull, rigidMatrix @ reflection)
+
+    # Cut both skulls and register the kept halves, starting from the full skull result
+    halfRigid = planeCutPolyData(mirroredSkullRigid, origin, normal, side)
+    halfOriginal = planeCutPolyData(originalSkull, origin, normal, side)
+    _, _, _, halfTransform, _ = logic.rigidRegistration(
+        halfRigid, halfOriginal, False, parameters, False, initialTransform=np.identity(4)
+    )
+    halfMatrix = logic.itk_transform_to_matrix(halfTransform)
+    metrics["halfRigid"] = logic.metrics.asDict()
+    halfRigid = transformPolyData(halfRigid, halfMatrix)
+
+    # Affine registration of the half model, as onAffineMirroredHalfButton does
+    import vtk
+
+    halfAffine = vtk.vtkPolyData()
+    halfAffine.DeepCopy(halfRigid)
+    transformation, translation, _ = logic.CPDAffinePolyData(
+        halfAffine, sourcePoints, targetPoints, parameters
+    )
+    metrics["halfAffine"] = logic.metrics.asDict()
+
+    writePolyData(mirroredSkullRigid, os.path.join(caseDirectory, "rigid.vtp"))
+    writePolyData(halfRigid, os.path.join(caseDirectory, "half_rigid.vtp"))
+    writePolyData(halfAffine, os.path.join(caseDirectory, "half_affine.vtp"))
+    np.savetxt(os.path.join(caseDirectory, "rigid_transform.txt"), rigidMatrix)
+    np.savetxt(os.path.join(caseDirectory, "half_rigid_transform.txt"), halfMatrix)
+    np.savetxt(
+        os.path.join(caseDirectory, "affine_transform.txt"), affineMatrix(transformation, translation)
+    )
+
+    summary = {
+        "id": case["id"],
+        "side": side,
+        "seconds": time.perf_counter() - start,
+        "metrics": metrics,
+    }
+    with open(os.path.join(caseDirectory, "summary.json"), "w") as f:
+        json.dump(summary, f, indent=2, default=RunMetrics._jsonValue)
+    return summary
+
+
+def readManifest(path):
+    manifestDirectory = os.path.dirname(os.path.abspath(path))
+    with open(path, newline="") as f:
+        cases = list(csv.DictReader(f))
+    for case in cases:
+        for column in ("skull", "planeLandmarks"):
+            case[column] = os.path.join(manifestDirectory, case[column])
+    return cases
+
+
+def runBatch(cases, outputDirectory, parameters, workers=1):
+    """Process all cases, in parallel if workers > 1. Returns one summary per case."""
+    os.makedirs(outputDirectory, exist_ok=True)
+    summaries = []
+    if workers <= 1:
+        for case in cases:
+            summaries.append(_runSafely(case, parameters, outputDirectory))
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [
+                executor.submit(_runSafely, case, parameters, outputDirectory) for case in cases
+            ]
+            for future in as_completed(futures):
+                summaries.append(future.result())
+    return summaries
+
+
+def _runSafely(case, parameters, outputDirectory):
+    try:
+        summary = processCase(case, parameters, outputDirectory)
+        print(f"{case['id']}: done in {summary['seconds']:.1f} s")
+        return summary
+    except Exception as e:
+        print(f"{case['id']}: failed: {e}")
+        return {"id": case["id"], "error": str(e)}
+
+
+def main(argv=None):
+    from MirrorOrbitReconLib.MirrorOrbitReconCore import DEFAULT_PARAMETERS, RunMetrics
+
+    parser = argparse.ArgumentParser(description="Batch mirror-based orbit reconstruction")
+    parser.add_argument("manifest", help="CSV manifest with id, skull, planeLandmarks, side columns")
+    parser.add_argument("output", help="output folder, one sub-folder per case")
+    parser.add_argument("--workers", type=int, default=1, help="number of worker processes")
+    parser.add_argument(
+        "--threads",
+        type=int,
+        help="threads per worker process for ITK, VTK, BLAS and the nearest neighbour queries "
+        "(default: the cores divided by the number of workers)",
+    )
+    parser.add_argument(
+        "--parameters", help="JSON file overriding entries of the default registration parameters"
+    )
+    args = parser.parse_args(argv)
+
+    parameters = dict(DEFAULT_PARAMETERS)
+    if args.parameters:
+        with open(args.parameters) as f:
+            parameters.update(json.load(f))
+    # Workers share the node, so each one gets its own slice of the cores
+    if args.threads:
+        parameters["threads"] = args.threads
+    elif not parameters.get("threads"):
+        parameters["threads"] = max(1, (os.cpu_count() or 1) // max(1, args.workers))
+
+    summaries = runBatch(readManifest(args.manifest), args.output, parameters, args.workers)
+    with open(os.path.join(args.output, "batch_summary.json"), "w") as f:
+        json.dump(summaries, f, indent=2, default=RunMetrics._jsonValue)
+    failed = [s["id"] for s in summaries if "error" in s]
+    print(f"{len(summaries) - len(failed)} cases done, {len(failed)} failed")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,200 @@
+"""
+Benchmark of the MirrorOrbitRecon registration pipeline on synthetic meshes.
+
+A skull-like closed surface (a bumpy ellipsoid) is generated at several vertex counts.
+A copy of it is perturbed by a known rigid, similarity or affine transform and registered
+back onto the original. Every logic stage (subsampling, normals, FPFH, correspondences,
+RANSAC, ICP and, for affine cases, CPD) is timed through the logic's run metrics, and the
+recovered transform is compared with the known one. With --matchers, the FPFH feature
+matchers are also compared for speed and recall against exact brute force matching.
+
+No Slicer GUI or MRML scene is needed, only vtk, itk (with itk-fpfh and itk-ransac),
+scikit-learn, scipy and cpdalp. Run it as a module from the folder that holds MirrorOrbitRecon.py.
+
+Usage:
+    python -m MirrorOrbitReconLib.MirrorOrbitReconBenchmark --sizes 20000 80000 --perturbations rigid affine --output bench.json
+"""
+
+import argparse
+import json
+import time
+
+import numpy as np
+
+from MirrorOrbitReconLib.MirrorOrbitReconBatch import transformPolyData
+
+
+def makeSyntheticSkull(numberOfPoints=20000, seed=0):
+    """Bumpy ellipsoid surface of roughly numberOfPoints vertices, with skull-like dimensions in mm."""
+    import vtk
+    from vtk.util import numpy_support
+
+    resolution = max(8, int(np.sqrt(numberOfPoints)))
+    sphere = vtk.vtkSphereSource()
+    sphere.SetThetaResolution(resolution)
+    sphere.SetPhiResolution(resolution)
+    sphere.SetRadius(1.0)
+    sphere.Update()
+    polyData = vtk.vtkPolyData()
+    polyData.DeepCopy(sphere.GetOutput())
+
+    points = numpy_support.vtk_to_numpy(polyData.GetPoints().GetData()).astype(np.float64)
+    theta = np.arctan2(points[:, 1], points[:, 0])
+    phi = np.arccos(np.clip(points[:, 2], -1, 1))
+    # Random low frequency bumps break the symmetries of the ellipsoid
+    rng = np.random.default_rng(seed)
+    bumps = np.zeros(points.shape[0])
+    for _ in range(6):
+        a, b = rng.integers(1, 5, 2)
+        bumps += rng.uniform(0.02, 0.06) * np.sin(a * theta + rng.uniform(0, np.pi)) * np.cos(b * phi)
+    points = points * (1 + bumps)[:, None] * np.array([90.0, 70.0, 60.0])
+
+    polyData.GetPoints().SetData(numpy_support.numpy_to_vtk(points, deep=True))
+    return polyData
+
+
+def makePerturbation(kind, seed=0):
+    """Known 4x4 transform of the given kind ("rigid", "similarity" or "affine")."""
+    from scipy.spatial.transform import Rotation
+
+    rng = np.random.default_rng(seed)
+    matrix = np.identity(4)
+    matrix[:3, :3] = Rotation.from_rotvec(rng.normal(size=3) * 0.3).as_matrix()
+    matrix[:3, 3] = rng.uniform(-10, 10, 3)
+    if kind == "similarity":
+        matrix[:3, :3] *= rng.uniform(0.9, 1.1)
+    elif kind == "affine":
+        matrix[:3, :3] = matrix[:3, :3] @ (np.identity(3) + rng.uniform(-0.05, 0.05, (3, 3)))
+    elif kind != "rigid":
+        raise ValueError(f"Unknown perturbation: {kind}")
+    return matrix
+
+
+def meanVertexError(polyData, matrix, reference):
+    """Mean distance between the vertices of polyData moved by matrix and the reference vertices."""
+    from vtk.util import numpy_support
+
+    points = numpy_support.vtk_to_numpy(polyData.GetPoints().GetData()).astype(np.float64)
+    referencePoints = numpy_support.vtk_to_numpy(reference.GetPoints().GetData())
+    moved = points @ matrix[:3, :3].T + matrix[:3, 3]
+    return float(np.mean(np.linalg.norm(moved - referencePoints, axis=1)))
+
+
+def runCase(logic, numberOfPoints, kind, parameters, seed=0):
+    """Register a perturbed copy of a synthetic skull back onto it. Returns timings and errors."""
+    target = makeSyntheticSkull(numberOfPoints, seed)
+    perturbation = makePerturbation(kind, seed)
+    source = transformPolyData(target, perturbation)
+
+    start = time.perf_counter()
+    sourcePoints, targetPoints, scaling, transform, _ = logic.rigidRegistration(
+        source, target, kind != "rigid", parameters, False
+    )
+    result = {
+        "vertices": target.GetNumberOfPoints(),
+        "perturbation": kind,
+        "rigidSeconds": time.perf_counter() - start,
+        "rigidMetrics": logic.metrics.asDict(),
+    }
+    # The source scaling is applied before the rigid/similarity transform
+    matrix = logic.itk_transform_to_matrix(transform) @ np.diag([scaling, scaling, scaling, 1.0])
+    result["rigidVertexError"] = meanVertexError(source, matrix, target)
+    result["rigidMatrixError"] = float(np.abs(matrix @ perturbation - np.identity(4)).max())
+
+    if kind == "affine":
+        registered = transformPolyData(source, matrix)
+        start = time.perf_counter()
+        logic.CPDAffinePolyData(registered, sourcePoints, targetPoints, parameters)
+        result["affineSeconds"] = time.perf_counter() - start
+        result["affineMetrics"] = logic.metrics.asDict()
+        result["affineVertexError"] = meanVertexError(registered, np.identity(4), target)
+    return result
+
+
+def runMatcherCase(logic, numberOfPoints, parameters, methods, seed=0):
+    """Time every FeatureMatcher method on the FPFH features of a synthetic skull pair, with recall against brute force."""
+    from MirrorOrbitReconLib.MirrorOrbitReconCore import FeatureMatcher
+
+    target = makeSyntheticSkull(numberOfPoints, seed)
+    source = transformPolyData(target, makePerturbation("rigid", seed))
+    _, _, sourceFeatures, targetFeatures, _, _ = logic.runSubsample(source, target, False, parameters)
+    _, exactIndices = FeatureMatcher(sourceFeatures, "brute").query(targetFeatures)
+
+    result = {"vertices": target.GetNumberOfPoints(), "features": targetFeatures.shape[0], "matchers": {}}
+    for method in methods:
+        matcher = FeatureMatcher(sourceFeatures, method, **(parameters.get("featureMatcherOptions") or {}))
+        _, indices = matcher.query(targetFeatures)
+        result["matchers"][method] = {
+            "buildSeconds": matcher.buildTime,
+            "querySeconds": matcher.queryTime,
+            "recall": FeatureMatcher.recall(indices, exactIndices),
+        }
+    return result
+
+
+def summarize(results):
+    print(f"{'vertices':>9} {'kind':>10} {'stage':>20} {'seconds':>9}")
+    for result in results:
+        if "matchers" in result:
+            for method, timing in result["matchers"].items():
+                print(
+                    f"{result['vertices']:>9} {'matcher':>10} {method:>20} "
+                    f"{timing['buildSeconds'] + timing['querySeconds']:>9.3f} recall {timing['recall']:.4f}"
+                )
+            continue
+        for run in ("rigidMetrics", "affineMetrics"):
+            if run not in result:
+                continue
+            for stage, seconds in result[run]["totalSeconds"].items():
+                print(f"{result['vertices']:>9} {result['perturbation']:>10} {stage:>20} {seconds:>9.3f}")
+        errors = ", ".join(f"{k} {v:.4f}" for k, v in result.items() if k.endswith("Error"))
+        print(f"{result['vertices']:>9} {result['perturbation']:>10} {'errors':>20} {errors}")
+
+
+def main(argv=None):
+    from MirrorOrbitReconLib.MirrorOrbitReconCore import DEFAULT_PARAMETERS, MirrorOrbitReconCore
+
+    parser = argparse.ArgumentParser(description="Benchmark the MirrorOrbitRecon registration pipeline")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[20000, 80000], help="approximate vertex counts")
+    parser.add_argument(
+        "--perturbations",
+        nargs="+",
+        default=["rigid", "similarity", "affine"],
+        choices=["rigid", "similarity", "affine"],
+    )
+    parser.add_argument(
+        "--matchers",
+        nargs="*",
+        default=[],
+        choices=["brute", "tree", "projection"],
+        help="also compare these FPFH feature matchers (timing and recall against brute force)",
+    )
+    parser.add_argument("--repeat", type=int, default=1, help="runs per case, with different seeds")
+    parser.add_argument("--parameters", help="JSON file overriding entries of the default registration parameters")
+    parser.add_argument("--output", help="write all results to this JSON file")
+    args = parser.parse_args(argv)
+
+    parameters = dict(DEFAULT_PARAMETERS)
+    if args.parameters:
+        with open(args.parameters) as f:
+            parameters.update(json.load(f))
+    # Every case must pay for its own features
+    parameters["useFeatureCache"] = False
+
+    logic = MirrorOrbitReconCore()
+    results = []
+    for size in args.sizes:
+        for kind in args.perturbations:
+            for seed in range(args.repeat):
+                results.append(runCase(logic, size, kind, parameters, seed))
+        if args.matchers:
+            results.append(runMatcherCase(logic, size, parameters, args.matchers))
+    summarize(results)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2, default=str)
+    return results
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,2750 @@
+"""
+Scene independent registration pipeline of MirrorOrbitRecon.
+
+Subsampling, FPFH features, correspondences, RANSAC, ICP, affine CPD and the transform
+math, without any slicer or qt dependency, so batch jobs and worker processes can use it
+from plain Python. vtk, itk, scipy, scikit-learn and cpdalp are only imported by the
+methods that need them. MirrorOrbitReconLogic (MirrorOrbitRecon.py) adds the MRML scene
+handling on top of MirrorOrbitReconCore.
+"""
+
+import contextlib
+import json
+import math
+import os
+import time
+
+import numpy as np
+
+
+# Registration parameters used by the widget, the batch runner and the benchmark
+DEFAULT_PARAMETERS = {
+    "pointDensity": 1.00,
+    "normalSearchRadius": 2.00,
+    "FPFHNeighbors": int(100),
+    "FPFHSearchRadius": 5.00,
+    "distanceThreshold": 3.00,
+    "maxRANSAC": int(1000000),
+    "ICPDistanceThreshold": float(1.50)
+}
+
+
+#
+# RunMetrics
+#
+
+
+class RunMetrics:
+    """Per-stage timing and metrics of one registration run.
+
+    Every call to record() appends one stage entry (stage name, wall time and any
+    counts, fitness/RMSE or iteration numbers). asDict()/toJSON() give the whole run,
+    appendToLog() writes it as one JSON line so runs can be compared across cases.
+    """
+
+    def __init__(self, label=""):
+        self.label = label
+        self.started = time.time()
+        self.stages = []
+
+    def record(self, stage, seconds=None, **values):
+        entry = {"stage": stage}
+        if seconds is not None:
+            entry["seconds"] = seconds
+        entry.update(values)
+        self.stages.append(entry)
+        return entry
+
+    def asDict(self):
+        totals = {}
+        for entry in self.stages:
+            if "seconds" in entry:
+                totals[entry["stage"]] = totals.get(entry["stage"], 0.0) + entry["seconds"]
+        return {
+            "label": self.label,
+            "started": self.started,
+            "stages": self.stages,
+            "totalSeconds": totals,
+        }
+
+    def toJSON(self, **kwargs):
+        return json.dumps(self.asDict(), default=RunMetrics._jsonValue, **kwargs)
+
+    def appendToLog(self, path):
+        with open(path, "a") as f:
+            f.write(self.toJSON() + "\n")
+
+    @staticmethod
+    def _jsonValue(value):
+        if isinstance(value, np.generic):
+            return value.item()
+        if isinstance(value, np.ndarray):
+            return value.tolist()
+        return str(value)
+
+
+#
+# RegistrationCancelled
+#
+
+
+class RegistrationCancelled(Exception):
+    """Raised by MirrorOrbitReconCore.reportProgress when a cancellation was requested."""
+
+
+#
+# NearestNeighborIndex
+#
+
+
+class NearestNeighborIndex:
+    """Persistent nearest-neighbour index over a fixed point set.
+
+    The KD-tree is built once and reused for every query, e.g. across all ICP
+    iterations and the fitness checks around them. Queries are spread over
+    `workers` threads (-1 uses all cores). Build and query times are accumulated
+    separately so they can be reported independently.
+    """
+
+    def __init__(self, points, workers=-1):
+        from scipy.spatial import cKDTree
+
+        self.points = np.asarray(points, dtype=np.float64)
+        self.workers = workers
+        self.queryTime = 0.0
+        self.queryCount = 0
+        start = time.perf_counter()
+        self.tree = cKDTree(self.points)
+        self.buildTime = time.perf_counter() - start
+
+    def query(self, queryPoints, k=1, distanceUpperBound=np.inf):
+        """Return (distances, indices) of the k nearest indexed points of each query point."""
+        start = time.perf_counter()
+        distances, indices = self.tree.query(
+            np.asarray(queryPoints, dtype=np.float64),
+            k=k,
+            distance_upper_bound=distanceUpperBound,
+            workers=self.workers,
+        )
+        self.queryTime += time.perf_counter() - start
+        self.queryCount += 1
+        return distances, indices
+
+    def report(self, label="Nearest neighbour index"):
+        print(
+            f"{label}: {self.points.shape[0]} points, build {self.buildTime:.4f} s, "
+            f"{self.queryCount} queries {self.queryTime:.4f} s"
+        )
+
+
+#
+# FeatureCache
+#
+
+
+class FeatureCache:
+    """Content-addressed cache for subsampled points, normals and FPFH features.
+
+    Entries are keyed by a hash of the mesh points and the parameters that affect the
+    result (see makeKey). The in-memory tier keeps the `maxEntries` most recently used
+    entries. If `cacheDirectory` is set, entries are also written there as .npz files,
+    and the least recently used files are removed once they exceed `maxDiskBytes`.
+    Cached arrays are made read-only, since every hit returns the same arrays; copy them
+    before changing them in place.
+    """
+
+    def __init__(self, maxEntries=8, cacheDirectory=None, maxDiskBytes=1024**3):
+        import collections
+
+        self.maxEntries = maxEntries
+        self.cacheDirectory = cacheDirectory
+        self.maxDiskBytes = maxDiskBytes
+        self._memory = collections.OrderedDict()
+        self.memoryHits = 0
+        self.diskHits = 0
+        self.misses = 0
+
+    @staticmethod
+    def makeKey(points, **parameters):
+        """Hash of the point coordinates and the given keyword parameters."""
+        import hashlib
+
+        points = np.ascontiguousarray(points)
+        digest = hashlib.blake2b(digest_size=20)
+        digest.update(str((points.shape, points.dtype.str)).encode())
+        digest.update(points.tobytes())
+        digest.update(repr(sorted(parameters.items())).encode())
+        return digest.hexdigest()
+
+    def _diskPath(self, key):
+        return os.path.join(self.cacheDirectory, key + ".npz")
+
+    def get(self, key):
+        """Return the cached dict of arrays for key, or None."""
+        if key in self._memory:
+            self._memory.move_to_end(key)
+            self.memoryHits += 1
+            return self._memory[key]
+        if self.cacheDirectory is not None and os.path.exists(self._diskPath(key)):
+            with np.load(self._diskPath(key)) as npz:
+                value = {name: npz[name] for name in npz.files}
+            # refresh the modification time so disk eviction is least recently used
+            os.utime(self._diskPath(key))
+            self._putMemory(key, value)
+            self.diskHits += 1
+            return value
+        self.misses += 1
+        return None
+
+    def put(self, key, value):
+        """Store a dict of numpy arrays under key."""
+        self._putMemory(key, value)
+        if self.cacheDirectory is not None:
+            os.makedirs(self.cacheDirectory, exist_ok=True)
+            np.savez(self._diskPath(key), **value)
+            self._evictDisk()
+
+    def _putMemory(self, key, value):
+        for array in value.values():
+            array.setflags(write=False)
+        self._memory[key] = value
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.maxEntries:
+            self._memory.popitem(last=False)
+
+    def _evictDisk(self):
+        files = [
+            os.path.join(self.cacheDirectory, name)
+            for name in os.listdir(self.cacheDirectory)
+            if name.endswith(".npz")
+        ]
+        files.sort(key=os.path.getmtime)
+        totalBytes = sum(os.path.getsize(f) for f in files)
+        while files and totalBytes > self.maxDiskBytes:
+            oldest = files.pop(0)
+            totalBytes -= os.path.getsize(oldest)
+            os.remove(oldest)
+
+    def clear(self):
+        """Empty the in-memory tier. Files on disk are kept."""
+        self._memory.clear()
+
+    def stats(self):
+        return {
+            "memoryHits": self.memoryHits,
+            "diskHits": self.diskHits,
+            "misses": self.misses,
+            "entries": len(self._memory),
+        }
+
+
+#
+# FeatureMatcher
+#
+
+
+class FeatureMatcher:
+    """Nearest-neighbour search in FPFH feature space.
+
+    FPFH features have 33 dimensions, where KD-trees prune little. Three methods are offered:
+      "brute"       exact; squared distances |x|^2 - 2 q.x (+ |q|^2) computed block by block as
+                    matrix products, so BLAS does the work with its own threads and at most
+                    maxBlockElements distances are held at once
+      "tree"        exact; cKDTree queried with `workers` threads (-1 uses all cores)
+      "projection"  approximate; cKDTree over a random orthonormal projection to
+                    projectionDimension dimensions, whose `candidates` nearest neighbours are
+                    re-ranked by their full distance
+    Build and query times are accumulated as in NearestNeighborIndex.
+    """
+
+    methods = ("brute", "tree", "projection")
+
+    def __init__(
+        self,
+        features,
+        method="tree",
+        workers=-1,
+        maxBlockElements=2**20,
+        projectionDimension=8,
+        candidates=16,
+        seed=0,
+    ):
+        from scipy.spatial import cKDTree
+
+        if method not in self.methods:
+            raise ValueError(f"Unknown feature matcher: {method}")
+        self.features = np.ascontiguousarray(features, dtype=np.float64)
+        self.method = method
+        self.workers = workers
+        self.maxBlockElements = maxBlockElements
+        self.candidates = max(1, min(candidates, self.features.shape[0]))
+        self.queryTime = 0.0
+        self.queryCount = 0
+        start = time.perf_counter()
+        if method == "brute":
+            self.squaredNorms = np.einsum("ij,ij->i", self.features, self.features)
+        elif method == "tree":
+            self.tree = cKDTree(self.features)
+        else:
+            rng = np.random.default_rng(seed)
+            dimension = min(projectionDimension, self.features.shape[1])
+            self.projection, _ = np.linalg.qr(rng.normal(size=(self.features.shape[1], dimension)))
+            self.tree = cKDTree(self.features @ self.projection)
+        self.buildTime = time.perf_counter() - start
+
+    def query(self, queryFeatures, k=1):
+        """
+        Return (distances, indices) of the k nearest indexed features of each query feature,
+        shaped (N,) for k=1 and (N, k) otherwise, as cKDTree.query does.
+        """
+        start = time.perf_counter()
+        queryFeatures = np.ascontiguousarray(queryFeatures, dtype=np.float64)
+        k = min(k, self.features.shape[0])
+        if self.method == "brute":
+            distances, indices = self._queryBrute(queryFeatures, k)
+        elif self.method == "tree":
+            distances, indices = self.tree.query(queryFeatures, k=k, workers=self.workers)
+        else:
+            distances, indices = self._queryProjection(queryFeatures, k)
+        if k == 1:
+            distances, indices = distances.reshape(-1), indices.reshape(-1)
+        self.queryTime += time.perf_counter() - start
+        self.queryCount += 1
+        return distances, indices
+
+    @staticmethod
+    def _smallest(values, k):
+        """Column indices of the k smallest values of every row, in increasing order."""
+        if k == 1:
+            return np.argmin(values, axis=1)[:, None]
+        columns = np.argpartition(values, k - 1, axis=1)[:, :k]
+        order = np.argsort(np.take_along_axis(values, columns, axis=1), axis=1)
+        return np.take_along_axis(columns, order, axis=1)
+
+    def _queryBrute(self, queryFeatures, k):
+        count = queryFeatures.shape[0]
+        blockRows = max(1, self.maxBlockElements // max(1, self.features.shape[0]))
+        distances = np.empty((count, k))
+        indices = np.empty((count, k), dtype=np.intp)
+        for start in range(0, count, blockRows):
+            block = queryFeatures[start : start + blockRows]
+            # |q|^2 is the same for a whole row, so it is only added for the winning distances
+            partial = block @ self.features.T
+            partial *= -2.0
+            partial += self.squaredNorms
+            best = self._smallest(partial, k)
+            squared = np.take_along_axis(partial, best, axis=1) + np.einsum("ij,ij->i", block, block)[:, None]
+            distances[start : start + blockRows] = np.sqrt(np.maximum(squared, 0.0))
+            indices[start : start + blockRows] = best
+        return distances, indices
+
+    def _queryProjection(self, queryFeatures, k):
+        _, candidates = self.tree.query(
+            queryFeatures @ self.projection, k=max(k, self.candidates), workers=self.workers
+        )
+        candidates = candidates.reshape(queryFeatures.shape[0], -1)
+        count = queryFeatures.shape[0]
+        blockRows = max(1, self.maxBlockElements // (candidates.shape[1] * self.features.shape[1]))
+        distances = np.empty((count, k))
+        indices = np.empty((count, k), dtype=np.intp)
+        for start in range(0, count, blockRows):
+            blockCandidates = candidates[start : start + blockRows]
+            difference = self.features[blockCandidates] - queryFeatures[start : start + blockRows, None, :]
+            squared = np.einsum("ijk,ijk->ij", difference, difference)
+            best = self._smallest(squared, k)
+            distances[start : start + blockRows] = np.sqrt(np.take_along_axis(squared, best, axis=1))
+            indices[start : start + blockRows] = np.take_along_axis(blockCandidates, best, axis=1)
+        return distances, indices
+
+    @staticmethod
+    def recall(indices, exactIndices):
+        """Fraction of queries whose match is the exact nearest neighbour."""
+        return float(np.mean(np.asarray(indices) == np.asarray(exactIndices)))
+
+    def report(self, label="Feature matcher"):
+        print(
+            f"{label} ({self.method}): {self.features.shape[0]} features, build {self.buildTime:.4f} s, "
+            f"{self.queryCount} queries {self.queryTime:.4f} s"
+        )
+
+
+#
+# ChunkedAffineCPD
+#
+
+
+class ChunkedAffineCPD:
+    """Affine coherent point drift with a memory-bounded E-step.
+
+    Same model, updates and stopping rule as cpdalp.AffineRegistration, but the M x N
+    responsibility matrix is never stored: the E-step runs over blocks of target points
+    and only accumulates the sums the M-step needs (P1, Pt1, PX). A block holds at most
+    memoryBudget bytes of kernel values, so peak memory grows with M + N instead of M * N.
+    X (N x D) are the target points and Y (M x D) the source points, as in cpdalp.
+
+    Unlike cpdalp, B and t (TY = Y B + t) may be any initial affine transform and, besides
+    the absolute objective tolerance, registration also stops once the relative change of
+    the objective falls below relativeTolerance or the relative change of sigma2 below
+    sigma2Tolerance. Every iteration appends its objective and sigma2 to trace.
+    """
+
+    def __init__(
+        self,
+        X,
+        Y,
+        memoryBudget=256 * 1024**2,
+        sigma2=None,
+        max_iterations=100,
+        tolerance=0.001,
+        w=0.0,
+        B=None,
+        t=None,
+        relativeTolerance=None,
+        sigma2Tolerance=None,
+    ):
+        self.X = np.asarray(X, dtype=np.float64)
+        self.Y = np.asarray(Y, dtype=np.float64)
+        (self.N, self.D) = self.X.shape
+        (self.M, _) = self.Y.shape
+        self.memoryBudget = memoryBudget
+        self.max_iterations = max_iterations
+        self.tolerance = tolerance
+        self.relativeTolerance = relativeTolerance
+        self.sigma2Tolerance = sigma2Tolerance
+        self.w = w
+        self.B = np.eye(self.D) if B is None else np.asarray(B, dtype=np.float64)
+        self.t = np.zeros((1, self.D)) if t is None else np.asarray(t, dtype=np.float64).reshape(1, self.D)
+        self.TY = self.Y
+        self.iteration = 0
+        self.diff = np.inf
+        self.q = np.inf
+        self.trace = []
+        self.stopReason = None
+        if sigma2 is None:
+            # Mean squared distance over all M x N pairs, without forming them
+            sigma2 = (
+                self.M * np.sum(self.X**2)
+                + self.N * np.sum(self.Y**2)
+                - 2 * np.dot(self.X.sum(axis=0), self.Y.sum(axis=0))
+            ) / (self.D * self.M * self.N)
+        self.sigma2 = sigma2
+
+    def register(self, callback=lambda **kwargs: None):
+        self.transform_point_cloud()
+        while self.stopReason is None:
+            previousSigma2 = self.sigma2
+            self.expectation()
+            self.maximization()
+            self.iteration += 1
+            relativeChange = self.diff / max(abs(self.q), np.finfo(float).tiny)
+            sigma2Change = abs(self.sigma2 - previousSigma2) / previousSigma2
+            self.trace.append(
+                {
+                    "iteration": self.iteration,
+                    "objective": float(self.q),
+                    "sigma2": float(self.sigma2),
+                    "relativeChange": float(relativeChange),
+                }
+            )
+            if self.iteration >= self.max_iterations:
+                self.stopReason = "maxIterations"
+            elif self.diff <= self.tolerance:
+                self.stopReason = "tolerance"
+            elif self.relativeTolerance is not None and relativeChange < self.relativeTolerance:
+                self.stopReason = "relativeTolerance"
+            elif self.sigma2Tolerance is not None and sigma2Change < self.sigma2Tolerance:
+                self.stopReason = "sigma2Tolerance"
+            if callable(callback):
+                callback(iteration=self.iteration, error=self.q, X=self.X, Y=self.TY)
+        return self.TY, self.get_registration_parameters()
+
+    def expectation(self):
+        c = (2 * np.pi * self.sigma2) ** (self.D / 2) * self.w / (1 - self.w) * self.M / self.N
+        # kernel block, its squared distances and one temporary
+        blockColumns = max(1, int(self.memoryBudget // (3 * 8 * self.M)))
+        squaredTY = np.einsum("ij,ij->i", self.TY, self.TY)
+        self.Pt1 = np.empty(self.N)
+        self.P1 = np.zeros(self.M)
+        self.PX = np.zeros((self.M, self.D))
+        for start in range(0, self.N, blockColumns):
+            block = self.X[start : start + blockColumns]
+            kernel = self.TY @ block.T
+            kernel *= -2.0
+            kernel += squaredTY[:, None]
+            kernel += np.einsum("ij,ij->i", block, block)[None, :]
+            np.maximum(kernel, 0.0, out=kernel)
+            kernel *= -1.0 / (2 * self.sigma2)
+            np.exp(kernel, out=kernel)
+            denominator = kernel.sum(axis=0)
+            denominator[denominator == 0] = np.finfo(float).eps
+            denominator += c
+            kernel /= denominator
+            self.Pt1[start : start + blockColumns] = kernel.sum(axis=0)
+            self.P1 += kernel.sum(axis=1)
+            self.PX += kernel @ block
+        self.Np = np.sum(self.P1)
+
+    def maximization(self):
+        muX = self.PX.sum(axis=0) / self.Np
+        muY = self.P1 @ self.Y / self.Np
+        self.X_hat = self.X - muX
+        Y_hat = self.Y - muY
+        # X_hat^T P^T Y_hat, with P X_hat = PX - P1 muX^T
+        self.A = (self.PX - np.outer(self.P1, muX)).T @ Y_hat
+        self.YPY = (Y_hat * self.P1[:, None]).T @ Y_hat
+        self.B = np.linalg.solve(self.YPY.T, self.A.T)
+        self.t = np.atleast_2d(muX - self.B.T @ muY)
+        self.transform_point_cloud()
+
+        qprev = self.q
+        trAB = np.trace(self.A @ self.B)
+        xPx = self.Pt1 @ np.einsum("ij,ij->i", self.X_hat, self.X_hat)
+        trBYPYP = np.trace(self.B @ self.YPY @ self.B)
+        self.q = (xPx - 2 * trAB + trBYPYP) / (2 * self.sigma2) + self.D * self.Np / 2 * np.log(self.sigma2)
+        self.diff = np.abs(self.q - qprev)
+        self.sigma2 = (xPx - trAB) / (self.Np * self.D)
+        if self.sigma2 <= 0:
+            self.sigma2 = self.tolerance / 10
+
+    def transform_point_cloud(self, Y=None):
+        if Y is None:
+            self.TY = self.Y @ self.B + self.t
+            return
+        return Y @ self.B + self.t
+
+    def get_registration_parameters(self):
+        return self.B, self.t
+
+
+#
+# ThreadBudget
+#
+
+
+class ThreadBudget:
+    """One thread count for every library the registration pipeline uses.
+
+    apply() sets it up once: the ITK pool threader and its global thread counts, the VTK
+    SMP tools, the BLAS/OpenMP pools (through threadpoolctl if it is installed, and the
+    usual environment variables for libraries loaded later or child processes) and the
+    worker count of the nearest-neighbour queries, see threadsFor. stageThreads overrides
+    the count per stage ("subsample", "FPFH", "matching", "RANSAC", "ICP", "CPD"); limit()
+    applies such an override to ITK and BLAS for the duration of a stage.
+    threads=None uses all cores and leaves the BLAS/OpenMP settings alone.
+    """
+
+    blasVariables = ("OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS")
+
+    def __init__(self, threads=None, stageThreads=None):
+        self.requested = (threads, dict(stageThreads or {}))
+        self.explicit = threads is not None
+        self.threads = max(1, int(threads)) if threads is not None else (os.cpu_count() or 1)
+        self.stageThreads = dict(stageThreads or {})
+        self._blasLimits = None
+        self._savedVariables = {}
+
+    def threadsFor(self, stage=None):
+        return max(1, int(self.stageThreads.get(stage, self.threads)))
+
+    def apply(self):
+        if self.explicit:
+            self._savedVariables = {name: os.environ.get(name) for name in self.blasVariables}
+            for name in self.blasVariables:
+                os.environ[name] = str(self.threads)
+            try:
+                from threadpoolctl import threadpool_limits
+
+                self._blasLimits = threadpool_limits(limits=self.threads)
+            except ImportError:
+                pass
+        try:
+            import itk
+
+            itk.MultiThreaderBase.SetGlobalDefaultThreader(
+                itk.MultiThreaderBase.ThreaderTypeFromString("POOL")
+            )
+            itk.MultiThreaderBase.SetGlobalMaximumNumberOfThreads(self.threads)
+            itk.MultiThreaderBase.SetGlobalDefaultNumberOfThreads(self.threads)
+        except ImportError:
+            pass
+        try:
+            import vtk
+
+            vtk.vtkSMPTools.Initialize(self.threads)
+        except ImportError:
+            pass
+
+    def release(self):
+        """Undo the BLAS/OpenMP limits and environment variables of apply(), before another budget replaces this one."""
+        if self._blasLimits is not None:
+            self._blasLimits.restore_original_limits()
+            self._blasLimits = None
+        if self.explicit:
+            for name in self.blasVariables:
+                if self._savedVariables.get(name) is None:
+                    os.environ.pop(name, None)
+                else:
+                    os.environ[name] = self._savedVariables[name]
+
+    @contextlib.contextmanager
+    def limit(self, stage):
+        """Apply the stage's thread count to ITK and BLAS while the block runs."""
+        threads = self.threadsFor(stage)
+        if threads == self.threads:
+            yield threads
+            return
+        import sys
+
+        itk = sys.modules.get("itk")
+        if itk is not None:
+            itk.MultiThreaderBase.SetGlobalDefaultNumberOfThreads(threads)
+        blasLimits = None
+        try:
+            from threadpoolctl import threadpool_limits
+
+            blasLimits = threadpool_limits(limits=threads)
+        except ImportError:
+            pass
+        try:
+            yield threads
+        finally:
+            if blasLimits is not None:
+                blasLimits.restore_original_limits()
+            if itk is not None:
+                itk.MultiThreaderBase.SetGlobalDefaultNumberOfThreads(self.threads)
+
+
+#
+# IncrementalMirrorRegistration
+#
+
+
+class IncrementalMirrorRegistration:
+    """Live rigid re-registration of the mirrored skull while the mirror plane is adjusted.
+
+    Reflecting about the old plane and then about the new one is a rigid map, so the mirrored
+    source for a new plane is the old one moved by it. update() only moves the cached
+    subsampled source points by that map, reuses the target subsample with its neighbour
+    index and normals, and runs ICP (iterations from parameters["incrementalICPIterations"],
+    default 10) starting from the previous result carried over to the new plane. No
+    subsampling, FPFH or RANSAC is repeated. Calls closer than minInterval seconds to the
+    previous update return None, so it can be driven directly by plane modified events.
+    """
+
+    def __init__(self, logic, sourcePoints, targetPoints, voxelSize, transform, reflection, parameters, minInterval=0.25):
+        self.logic = logic
+        # Subsampled mirrored source for the current plane, before registration
+        self.sourcePoints = np.asarray(sourcePoints, dtype=np.float64)
+        self.targetPoints = np.asarray(targetPoints, dtype=np.float64)
+        self.voxelSize = voxelSize
+        self.transform = np.asarray(transform, dtype=np.float64)
+        self.reflection = np.asarray(reflection, dtype=np.float64)
+        self.parameters = dict(parameters)
+        if self.parameters.get("ICPPyramidLevels") is None:
+            self.parameters["ICPPyramidLevels"] = ((1, int(self.parameters.get("incrementalICPIterations", 10))),)
+        self.minInterval = minInterval
+        self.lastUpdate = None
+        self.targetIndex = NearestNeighborIndex(self.targetPoints, workers=logic.stageThreads("ICP"))
+        self.targetNormals = logic.extract_pca_normal_batched(
+            self.targetPoints, float(parameters["normalSearchRadius"] * voxelSize)
+        )
+
+    def update(self, reflection, force=False):
+        """
+        Re-register for the mirror given by the 4x4 reflection matrix. Returns a dict with the
+        new registration transform, the rigid change of the registered source since the previous
+        update ("correction"), the registered source points, fitness, RMSE and seconds,
+        or None if rate limited.
+        """
+        import itk
+
+        now = time.perf_counter()
+        if not force and self.lastUpdate is not None and now - self.lastUpdate < self.minInterval:
+            return None
+        reflection = np.asarray(reflection, dtype=np.float64)
+        # Old mirror back to the original skull, then mirrored about the new plane
+        planeChange = reflection @ self.reflection
+        sourcePoints = self.sourcePoints @ planeChange[:3, :3].T + planeChange[:3, 3]
+        initialTransform = self.transform @ np.linalg.inv(planeChange)
+
+        self.logic.startMetricsRun("incrementalMirrorRegistration")
+        firstTransform = itk.transform_from_dict(
+            self.logic.matrix_to_itk_transform_dict(initialTransform, False)
+        )
+        transform = self.logic.itk_transform_to_matrix(
+            self.logic.refine_transform(
+                sourcePoints,
+                self.targetPoints,
+                firstTransform,
+                self.voxelSize,
+                self.parameters,
+                self.targetIndex,
+                targetNormals=self.targetNormals,
+            )
+        )
+        registeredPoints = sourcePoints @ transform[:3, :3].T + transform[:3, 3]
+        fitness, rmse = self.logic.get_fitness(
+            registeredPoints,
+            self.targetPoints,
+            float(self.parameters["ICPDistanceThreshold"]) * self.voxelSize,
+            targetIndex=self.targetIndex,
+        )
+        correction = transform @ planeChange @ np.linalg.inv(self.transform)
+
+        self.sourcePoints, self.reflection, self.transform = sourcePoints, reflection, transform
+        self.lastUpdate = time.perf_counter()
+        self.logic.metrics.record(
+            "incrementalMirrorRegistration", self.lastUpdate - now, fitness=fitness, rmse=rmse
+        )
+        self.logic.finishMetricsRun()
+        return {
+            "transform": transform,
+            "correction": correction,
+            "sourcePoints": registeredPoints,
+            "fitness": fitness,
+            "rmse": rmse,
+            "seconds": self.lastUpdate - now,
+        }
+
+    def finish(self):
+        """
+        Write the subsampled source and the transform for the current plane back to
+        logic.lastRegistration, so a later incremental registration (started with the current
+        reflection) continues from them instead of from the first plane.
+        """
+        self.logic.lastRegistration["sourcePoints"] = self.sourcePoints
+        self.logic.lastRegistration["transform"] = self.transform
+
+
+#
+# MirrorOrbitReconCore
+#
+
+
+class MirrorOrbitReconCore:
+    """Numerical registration pipeline, independent of the MRML scene.
+
+    Models are passed as vtkPolyData (or anything with GetMesh()) and point clouds as
+    numpy arrays. The rigid and cpd registration functions are reused from the ALPACA and FastModelAlign modules of SlicerMorph (https://github.com/SlicerMorph/SlicerMorph/tree/master)
+    """
+
+    # Shared by all instances, so features survive between button clicks.
+    # Replace with FeatureCache(cacheDirectory=...) to also keep them on disk, or None to disable.
+    featureCache = FeatureCache()
+
+    # Process wide, like the library thread pools it configures; see setThreadBudget
+    threadBudget = None
+
+    def __init__(self) -> None:
+        # progressCallback(stage, fraction) is called at every stage checkpoint, see reportProgress
+        self.progressCallback = None
+        self.cancelRequested = False
+        # Stage timings and metrics of the current run; appended as JSON lines to metricsLogPath if set
+        self.metrics = RunMetrics()
+        self.metricsLogPath = None
+        # Subsampled inputs and result of the last rigidRegistration, see startIncrementalMirrorRegistration
+        self.lastRegistration = None
+
+    def startMetricsRun(self, label):
+        self.metrics = RunMetrics(label)
+
+    def finishMetricsRun(self):
+        """Return the current run metrics as a dict, appending them to metricsLogPath if set."""
+        if self.metricsLogPath:
+            self.metrics.appendToLog(self.metricsLogPath)
+        return self.metrics.asDict()
+
+    def reportProgress(self, stage, fraction=0.0):
+        """
+        Checkpoint between pipeline steps: forwards the stage ("subsample", "FPFH", "RANSAC",
+        "ICP" or "CPD") and the fraction done within it to progressCallback, and raises
+        RegistrationCancelled if cancelRequested was set (e.g. from another thread).
+        """
+        if self.cancelRequested:
+            raise RegistrationCancelled(stage)
+        if self.progressCallback is not None:
+            self.progressCallback(stage, fraction)
+
+    def setThreadBudget(self, threads=None, stageThreads=None):
+        """
+        Set up the thread pools of ITK, VTK, BLAS/OpenMP and the nearest-neighbour queries for
+        `threads` threads (None uses all cores), with optional per-stage overrides, see
+        ThreadBudget. Nothing is re-applied if the budget does not change.
+        """
+        budget = MirrorOrbitReconCore.threadBudget
+        if budget is not None and budget.requested == (threads, dict(stageThreads or {})):
+            return budget
+        if budget is not None:
+            budget.release()
+        budget = ThreadBudget(threads, stageThreads)
+        budget.apply()
+        MirrorOrbitReconCore.threadBudget = budget
+        print(f"Thread budget: {budget.threads} threads, stage overrides {budget.stageThreads}")
+        return budget
+
+    def getThreadBudget(self):
+        """The current thread budget, setting up the default (all cores) on first use."""
+        if MirrorOrbitReconCore.threadBudget is None:
+            self.setThreadBudget()
+        return MirrorOrbitReconCore.threadBudget
+
+    def stageThreads(self, stage):
+        return self.getThreadBudget().threadsFor(stage)
+
+    def applyThreadParameters(self, parameters):
+        """Use parameters["threads"] and parameters["stageThreads"] as the thread budget, if given."""
+        if parameters.get("threads") or parameters.get("stageThreads"):
+            self.setThreadBudget(parameters.get("threads"), parameters.get("stageThreads"))
+
+    def warmUpDependencies(self):
+        """
+        Import itk (with the FPFH and RANSAC modules), cpdalp, scipy and scikit-learn, and build
+        one FPFH filter so ITK instantiates its wrappers, so the first registration does not pay
+        for it. Safe to call from a worker thread. Returns the seconds spent per step.
+        """
+        timings = {}
+
+        stepStart = time.perf_counter()
+        import itk
+        from itk import Fpfh, Ransac  # noqa: F401
+        timings["itk"] = time.perf_counter() - stepStart
+
+        stepStart = time.perf_counter()
+        itk.Fpfh.PointFeature.MF3MF3.New()
+        timings["FPFH"] = time.perf_counter() - stepStart
+
+        stepStart = time.perf_counter()
+        import cpdalp  # noqa: F401
+        import scipy.spatial  # noqa: F401
+        import sklearn.neighbors  # noqa: F401
+        timings["cpdalp, scipy, scikit-learn"] = time.perf_counter() - stepStart
+
+        self.getThreadBudget()
+        return timings
+
+    def rigidRegistration(
+        self, sourceModel, targetModel, scalingOption, parameters, usePoisson, initialTransform=None,
+        sourceTransform=None,
+    ):
+        """
+        Scene independent part of ITKRegistration. sourceModel and targetModel are model nodes
+        or vtkPolyData. Returns the subsampled source points, the subsampled target points, the
+        source scaling factor, the ITK rigid/similarity transform and the similarity flag.
+        The source points are returned already transformed onto the target.
+        sourceTransform (4x4 matrix, e.g. a mirror reflectionMatrix) is applied to the source
+        subsample only, so the source can be the target mesh itself without a mirrored copy.
+        Stage metrics of the run are left in self.metrics.
+        """
+        self.startMetricsRun("rigidRegistration")
+        self.applyThreadParameters(parameters)
+        runStart = time.perf_counter()
+        (
+            sourcePoints,
+            targetPoints,
+            sourceFeatures,
+            targetFeatures,
+            voxelSize,
+            scaling,
+            sourceNormals,
+            targetNormals,
+        ) = self.runSubsample(
+            sourceModel,
+            targetModel,
+            scalingOption,
+            parameters,
+            usePoisson,
+            computeFeatures=initialTransform is None,
+            sourceTransform=sourceTransform,
+            returnNormals=True,
+        )
+
+        if initialTransform is not None:
+            initialTransform = np.asarray(initialTransform, dtype=np.float64)
+            fitness, rmse = self.get_fitness(
+                sourcePoints,
+                targetPoints,
+                float(parameters["distanceThreshold"]) * voxelSize,
+                initialTransform,
+            )
+            print("Warm start Fitness = ", fitness, " RMSE = ", rmse)
+            if fitness < parameters.get("warmStartFitnessThreshold", 0.9):
+                print("Warm start fitness below threshold, falling back to RANSAC")
+                initialTransform = None
+                # The subsampled points and normals are kept, only the missing features are computed
+                if sourceFeatures is None:
+                    sourceFeatures = self.compute_fpfh_features(sourcePoints, sourceNormals, voxelSize, parameters)
+                if targetFeatures is None:
+                    targetFeatures = self.compute_fpfh_features(targetPoints, targetNormals, voxelSize, parameters)
+
+        ICPTransform_similarity, similarityFlag = self.estimateTransform(
+            sourcePoints,
+            targetPoints,
+            sourceFeatures,
+            targetFeatures,
+            voxelSize,
+            scalingOption,
+            parameters,
+            initialTransform=initialTransform,
+        )
+        self.lastRegistration = {
+            "sourcePoints": sourcePoints,
+            "targetPoints": targetPoints,
+            "voxelSize": voxelSize,
+            "scaling": scaling,
+            "transform": self.itk_transform_to_matrix(ICPTransform_similarity),
+        }
+        sourcePoints = self.transform_numpy_points(sourcePoints, ICPTransform_similarity)
+        self.metrics.record("rigidRegistration", time.perf_counter() - runStart, warmStart=initialTransform is not None)
+        self.finishMetricsRun()
+        return sourcePoints, targetPoints, scaling, ICPTransform_similarity, similarityFlag
+
+
+    def startIncrementalMirrorRegistration(self, reflection, parameters, minInterval=0.25):
+        """
+        IncrementalMirrorRegistration continuing from the last rigidRegistration, whose source
+        was mirrored with the 4x4 reflection matrix (see reflectionMatrix).
+        """
+        if self.lastRegistration is None:
+            raise RuntimeError("No rigid registration to continue from")
+        if self.lastRegistration["scaling"] != 1:
+            raise ValueError("Incremental mirror registration needs an unscaled rigid registration")
+        return IncrementalMirrorRegistration(
+            self,
+            self.lastRegistration["sourcePoints"],
+            self.lastRegistration["targetPoints"],
+            self.lastRegistration["voxelSize"],
+            self.lastRegistration["transform"],
+            reflection,
+            parameters,
+            minInterval,
+        )
+
+    @staticmethod
+    def reflectionMatrix(origin, normal):
+        """4x4 matrix of the reflection about the plane through origin with the given normal."""
+        normal = np.asarray(normal, dtype=np.float64)
+        normal = normal / np.linalg.norm(normal)
+        reflection = np.identity(4)
+        reflection[:3, :3] -= 2 * np.outer(normal, normal)
+        reflection[:3, 3] = 2 * np.dot(origin, normal) * normal
+        return reflection
+
+    def mirrorPolyData(self, polyData, matrix):
+        """
+        Mirrored copy of polyData: points moved by the 4x4 matrix (a reflection, possibly
+        followed by a registration transform) and the cell ordering reversed like the Dynamic
+        Modeler Mirror tool does, so the normals still point outwards.
+        """
+        import vtk
+
+        transform = vtk.vtkTransform()
+        transform.SetMatrix(np.asarray(matrix, dtype=np.float64).ravel().tolist())
+        transformFilter = vtk.vtkTransformPolyDataFilter()
+        transformFilter.SetInputData(polyData)
+        transformFilter.SetTransform(transform)
+        reverse = vtk.vtkReverseSense()
+        reverse.SetInputConnection(transformFilter.GetOutputPort())
+        reverse.ReverseCellsOn()
+        reverse.ReverseNormalsOn()
+        reverse.Update()
+        return reverse.GetOutput()
+
+    def planeSignedDistances(self, points, origin, normal):
+        """Signed distances of Nx3 points to the plane, positive on the side the normal points to."""
+        normal = np.asarray(normal, dtype=np.float64)
+        normal = normal / np.linalg.norm(normal)
+        return (np.asarray(points, dtype=np.float64) - np.asarray(origin, dtype=np.float64)) @ normal
+
+    def planeCutPoints(self, points, origin, normal, side="positive"):
+        """The points on the given side ("positive" or "negative") of the plane."""
+        distances = self.planeSignedDistances(points, origin, normal)
+        return points[distances >= 0] if side == "positive" else points[distances <= 0]
+
+    def planeCutPolyData(self, polyData, origin, normal, side="positive"):
+        """
+        Part of polyData on the given side ("positive" or "negative") of the plane. The signed
+        distances of all vertices are computed in one numpy pass and the clip only outputs the
+        kept side, cutting the cells that cross the plane. polyData is not modified.
+        """
+        import vtk
+        from vtk.util import numpy_support
+
+        distances = self.planeSignedDistances(
+            numpy_support.vtk_to_numpy(polyData.GetPoints().GetData()), origin, normal
+        )
+        if side == "negative":
+            distances = -distances
+        inputData = vtk.vtkPolyData()
+        inputData.ShallowCopy(polyData)
+        distanceArray = numpy_support.numpy_to_vtk(distances, deep=True)
+        distanceArray.SetName("PlaneDistance")
+        inputData.GetPointData().AddArray(distanceArray)
+
+        clipper = vtk.vtkClipPolyData()
+        clipper.SetInputData(inputData)
+        clipper.SetInputArrayToProcess(0, 0, 0, vtk.vtkDataObject.FIELD_ASSOCIATION_POINTS, "PlaneDistance")
+        clipper.SetValue(0.0)
+        clipper.GenerateClippedOutputOff()
+        clipper.Update()
+        output = clipper.GetOutput()
+        output.GetPointData().RemoveArray("PlaneDistance")
+        return output
+
+    def halfRigidRegistration(self, sourcePoints, targetPoints, voxelSize, origin, normal, side, parameters):
+        """
+        Rigid registration of one half on the subsampled clouds of the full skull registration:
+        the registered source and the target points are cut at the plane and only ICP runs,
+        starting from identity, so no mesh is cut, subsampled or featurized for it.
+        Returns the same tuple as rigidRegistration.
+        """
+        import itk
+
+        self.startMetricsRun("halfRigidRegistration")
+        self.applyThreadParameters(parameters)
+        runStart = time.perf_counter()
+        sourceHalf = self.planeCutPoints(sourcePoints, origin, normal, side)
+        targetHalf = self.planeCutPoints(targetPoints, origin, normal, side)
+        self.reportProgress("ICP")
+        transform = self.refine_transform(
+            sourceHalf,
+            targetHalf,
+            itk.transform_from_dict(self.matrix_to_itk_transform_dict(np.identity(4))),
+            voxelSize,
+            parameters,
+        )
+        sourceHalf = self.transform_numpy_points(sourceHalf, transform)
+        self.metrics.record(
+            "halfRigidRegistration",
+            time.perf_counter() - runStart,
+            sourcePoints=sourceHalf.shape[0],
+            targetPoints=targetHalf.shape[0],
+        )
+        self.finishMetricsRun()
+        return sourceHalf, targetHalf, 1, transform, False
+
+    def runSubsample(
+        self,
+        sourceModel,
+        targetModel,
+        scalingOption,
+        parameters,
+        usePoissonSubsample=False,
+        computeFeatures=True,
+        sourceTransform=None,
+        returnNormals=False,
+    ):
+        # This function is reused from the ALPACA module of SlicerMorph (https://github.com/SlicerMorph/SlicerMorph/tree/master)
+        # With computeFeatures=False the FPFH features are only returned if they are already cached, otherwise None
+        # With returnNormals the source and target normals are appended to the returned tuple
+        # sourceTransform (4x4 matrix) is applied lazily to the subsampled source points, see subsample_features
+        stageStart = time.perf_counter()
+        print("parameters are ", parameters)
+        print(":: Loading point clouds and downsampling")
+
+        # Model nodes or plain vtkPolyData (batch processing)
+        sourceModelMesh = sourceModel.GetMesh() if hasattr(sourceModel, "GetMesh") else sourceModel
+        targetModelMesh = targetModel.GetMesh() if hasattr(targetModel, "GetMesh") else targetModel
+
+        # Scale the mesh and the landmark points
+        fixedBoxLengths, fixedlength = self.getBoxLengths(targetModelMesh)
+        movingBoxLengths, movinglength = self.getBoxLengths(sourceModelMesh, sourceTransform if scalingOption else None)
+
+        # Sub-Sample the points for rigid refinement and deformable registration
+        point_density = parameters["pointDensity"]
+
+        # Voxel size is the diagonal length of cuboid in the voxelGrid
+        voxel_size = np.sqrt(np.sum(np.square(np.array(fixedBoxLengths)))) / (
+            55 * point_density
+        )
+
+        print("Scale length are  ", fixedlength, movinglength)
+        print("Voxel Size is ", voxel_size)
+
+        scalingFactor = fixedlength / movinglength
+        if scalingOption is False:
+            scalingFactor = 1
+        print("Scaling factor is ", scalingFactor)
+
+        movingMeshPoints, movingMeshPointNormals, source_fpfh = self.subsample_features(
+            sourceModelMesh, scalingFactor, voxel_size, parameters, usePoissonSubsample,
+            computeFeatures, pointTransform=sourceTransform,
+        )
+        fixedMeshPoints, fixedMeshPointNormals, target_fpfh = self.subsample_features(
+            targetModelMesh, None, voxel_size, parameters, usePoissonSubsample,
+            computeFeatures,
+        )
+
+        print("------------------------------------------------------------")
+        print("movingMeshPoints.shape ", movingMeshPoints.shape)
+        print("movingMeshPointNormals.shape ", movingMeshPointNormals.shape)
+        print("fixedMeshPoints.shape ", fixedMeshPoints.shape)
+        print("fixedMeshPointNormals.shape ", fixedMeshPointNormals.shape)
+        print("------------------------------------------------------------")
+
+        target_down = fixedMeshPoints
+        source_down = movingMeshPoints
+        self.metrics.record(
+            "runSubsample",
+            time.perf_counter() - stageStart,
+            sourcePoints=movingMeshPoints.shape[0],
+            targetPoints=fixedMeshPoints.shape[0],
+            voxelSize=voxel_size,
+            scalingFactor=scalingFactor,
+        )
+        if returnNormals:
+            return (
+                source_down, target_down, source_fpfh, target_fpfh, voxel_size, scalingFactor,
+                movingMeshPointNormals, fixedMeshPointNormals,
+            )
+        return source_down, target_down, source_fpfh, target_fpfh, voxel_size, scalingFactor
+
+
+    def subsample_features(
+        self,
+        modelMesh,
+        scalingFactor,
+        voxel_size,
+        parameters,
+        usePoissonSubsample=False,
+        computeFeatures=True,
+        pointTransform=None,
+    ):
+        """
+        Subsampled points, normals and FPFH features of one mesh.
+        The subsampled points are scaled by scalingFactor unless it is None; modelMesh is not modified.
+        pointTransform (4x4 matrix) is applied to the subsampled points and normals before the
+        scaling, which stands for subsampling the transformed mesh (e.g. the mirrored skull).
+        Results are looked up in featureCache first, keyed by the mesh points and every
+        input that changes them (voxel size, scaling, point transform, subsampling method,
+        pointDensity, FPFHSearchRadius, FPFHNeighbors). Set parameters["useFeatureCache"] to
+        False to bypass it.
+        """
+        from vtk.util import numpy_support
+
+        useCache = parameters.get("useFeatureCache", True) and self.featureCache is not None
+        if useCache:
+            key = self.featureCache.makeKey(
+                numpy_support.vtk_to_numpy(modelMesh.GetPoints().GetData()),
+                voxelSize=voxel_size,
+                scalingFactor=scalingFactor,
+                pointTransform=None if pointTransform is None else np.asarray(pointTransform).tolist(),
+                usePoissonSubsample=bool(usePoissonSubsample),
+                pointDensity=parameters["pointDensity"],
+                FPFHSearchRadius=parameters["FPFHSearchRadius"],
+                FPFHNeighbors=parameters["FPFHNeighbors"],
+            )
+            cached = self.featureCache.get(key)
+            if cached is not None:
+                print("Feature cache hit ", self.featureCache.stats())
+                self.metrics.record("featureCache", hit=True, points=cached["points"].shape[0])
+                return cached["points"], cached["normals"], cached["fpfh"]
+
+        self.reportProgress("subsample")
+        stageStart = time.perf_counter()
+        # The mesh itself is never scaled: subsampling it with voxel_size / scale and scaling the
+        # subsampled points gives the same points, and the PCA normals do not change with scale.
+        scale = 1.0 if scalingFactor is None else float(scalingFactor)
+        if usePoissonSubsample:
+            print("Using Poisson Point Subsampling Method")
+            mesh_vtk = self.subsample_points_poisson(modelMesh, radius=voxel_size / scale)
+        else:
+            mesh_vtk = self.subsample_points_voxelgrid_polydata(modelMesh, radius=voxel_size / scale)
+
+        meshPoints, meshPointNormals = self.extract_pca_normal(mesh_vtk, 30)
+        if pointTransform is not None:
+            pointTransform = np.asarray(pointTransform, dtype=np.float64)
+            meshPoints = meshPoints @ pointTransform[:3, :3].T + pointTransform[:3, 3]
+            meshPointNormals = meshPointNormals @ pointTransform[:3, :3].T
+            meshPointNormals /= np.linalg.norm(meshPointNormals, axis=1, keepdims=True)
+            # Same orientation rule as extract_pca_normal (towards the world origin), as if the
+            # transformed mesh had been subsampled, so the FPFH features match
+            flip = np.einsum("ij,ij->i", meshPointNormals, -meshPoints) < 0
+            meshPointNormals[flip] *= -1
+        if scale != 1.0:
+            meshPoints = meshPoints * scale
+        self.metrics.record(
+            "subsampleNormals",
+            time.perf_counter() - stageStart,
+            inputPoints=modelMesh.GetNumberOfPoints(),
+            points=meshPoints.shape[0],
+        )
+        if not computeFeatures:
+            return meshPoints, meshPointNormals, None
+
+        fpfh = self.compute_fpfh_features(meshPoints, meshPointNormals, voxel_size, parameters)
+
+        if useCache:
+            self.featureCache.put(
+                key, {"points": meshPoints, "normals": meshPointNormals, "fpfh": fpfh}
+            )
+            print("Feature cache miss ", self.featureCache.stats())
+        return meshPoints, meshPointNormals, fpfh
+
+
+    def compute_fpfh_features(self, meshPoints, meshPointNormals, voxel_size, parameters):
+        """FPFH features of subsampled points and normals, with the radius and neighbours from parameters."""
+        self.reportProgress("FPFH")
+        stageStart = time.perf_counter()
+        fpfh_radius = parameters["FPFHSearchRadius"] * voxel_size
+        fpfh_neighbors = parameters["FPFHNeighbors"]
+        # New FPFH Code
+        pcS = np.expand_dims(meshPoints, -1)
+        fpfh = self.get_fpfh_feature(pcS, meshPointNormals, fpfh_radius, fpfh_neighbors)
+        self.metrics.record("FPFH", time.perf_counter() - stageStart, points=meshPoints.shape[0])
+        return fpfh
+
+
+    def getBoxLengths(self, inputMesh, pointTransform=None):
+        # This function is reused from the ALPACA module of SlicerMorph (https://github.com/SlicerMorph/SlicerMorph/tree/master)
+        # With pointTransform (4x4 matrix) the box is the one of the transformed mesh points
+        import vtk
+
+        bounds = inputMesh.GetBounds()
+        if pointTransform is not None:
+            from vtk.util import numpy_support
+
+            pointTransform = np.asarray(pointTransform, dtype=np.float64)
+            points = numpy_support.vtk_to_numpy(inputMesh.GetPoints().GetData())
+            points = points @ pointTransform[:3, :3].T + pointTransform[:3, 3]
+            bounds = np.column_stack([points.min(axis=0), points.max(axis=0)]).ravel()
+        box_filter = vtk.vtkBoundingBox()
+        box_filter.SetBounds(bounds)
+        diagonalLength = box_filter.GetDiagonalLength()
+        fixedLengths = [0.0, 0.0, 0.0]
+        box_filter.GetLengths(fixedLengths)
+        return fixedLengths, diagonalLength
+
+
+    def get_fpfh_feature(self, points_np, normals_np, radius, neighbors):
+        # This function is reused from the ALPACA module of SlicerMorph (https://github.com/SlicerMorph/SlicerMorph/tree/master)
+        import itk
+
+        pointset = itk.PointSet[itk.F, 3].New()
+        pointset.SetPoints(
+            itk.vector_container_from_array(points_np.flatten().astype("float32"))
+        )
+
+        normalset = itk.PointSet[itk.F, 3].New()
+        normalset.SetPoints(
+            itk.vector_container_from_array(normals_np.flatten().astype("float32"))
+        )
+        # ITK objects take the global thread count when they are created, so the filter is made under the limit
+        with self.getThreadBudget().limit("FPFH"):
+            fpfh = itk.Fpfh.PointFeature.MF3MF3.New()
+            fpfh.ComputeFPFHFeature(pointset, normalset, float(radius), int(neighbors))
+        result = fpfh.GetFpfhFeature()
+
+        fpfh_feats = itk.array_from_vector_container(result)
+        fpfh_feats = np.reshape(fpfh_feats, [33, pointset.GetNumberOfPoints()]).T
+        return fpfh_feats
+
+
+    def subsample_points_poisson(self, inputMesh, radius):
+        """
+        Return sub-sampled points as numpy array.
+        The radius might need to be tuned as per the requirements.
+        """
+        # This function is reused from the ALPACA module of SlicerMorph (https://github.com/SlicerMorph/SlicerMorph/tree/master)
+        import vtk
+
+        f = vtk.vtkPoissonDiskSampler()
+        f.SetInputData(inputMesh)
+        f.SetRadius(radius)
+        f.Update()
+
+        sampled_points = f.GetOutput()
+        return sampled_points
+
+    def subsample_points_voxelgrid_polydata(self, inputMesh, radius):
+        # This function is reused from the ALPACA module of SlicerMorph (https://github.com/SlicerMorph/SlicerMorph/tree/master)
+        import vtk
+
+        subsample = vtk.vtkVoxelGrid()
+        subsample.SetInputData(inputMesh)
+        subsample.SetConfigurationStyleToLeafSize()
+
+        subsample.SetLeafSize(radius, radius, radius)
+        subsample.Update()
+        points = subsample.GetOutput()
+        return points
+
+
+    def extract_pca_normal(self, mesh, normalNeighbourCount):
+        # This function is reused from the ALPACA module of SlicerMorph (https://github.com/SlicerMorph/SlicerMorph/tree/master)
+        import vtk
+        from vtk.util import numpy_support
+
+        normals = vtk.vtkPCANormalEstimation()
+        normals.SetSampleSize(normalNeighbourCount)
+        # normals.SetFlipNormals(True)
+        normals.SetNormalOrientationToPoint()
+        # normals.SetNormalOrientationToGraphTraversal()
+        normals.SetInputData(mesh)
+        normals.Update()
+        out1 = normals.GetOutput()
+        normal_array = numpy_support.vtk_to_numpy(out1.GetPointData().GetNormals())
+        point_array = numpy_support.vtk_to_numpy(mesh.GetPoints().GetData())
+        return point_array, normal_array
+
+
+    def estimateTransform(
+        self,
+        sourcePoints,
+        targetPoints,
+        sourceFeatures,
+        targetFeatures,
+        voxelSize,
+        scalingOption,
+        parameters,
+        initialTransform=None,
+    ):
+        # This function is reused from the ALPACA module of SlicerMorph (https://github.com/SlicerMorph/SlicerMorph/tree/master)
+        # If initialTransform (4x4 numpy matrix) is given, feature matching and RANSAC are skipped
+        # and ICP refinement starts from it. ITKRegistration checks its fitness first.
+
+        import itk
+
+        similarityFlag = False
+        if initialTransform is not None:
+            print("Warm start from the initial transform, skipping feature matching and RANSAC")
+            similarityFlag = not np.isclose(abs(np.linalg.det(initialTransform[:3, :3])), 1)
+            first_transform = itk.transform_from_dict(
+                self.matrix_to_itk_transform_dict(initialTransform, similarityFlag)
+            )
+            return self.refine_transform(
+                sourcePoints, targetPoints, first_transform, voxelSize, parameters
+            ), similarityFlag
+
+        stageStart = time.perf_counter()
+        # Establish correspondences by nearest neighbour search in feature space
+        # "tree" (default), "brute" or "projection", see FeatureMatcher
+        pruning = parameters.get("correspondencePruning", False)
+        if pruning:
+            # Ratio test, top-k and mutual filter, then only the most confident ones are kept
+            corrs_A, corrs_B, confidence = self.find_scored_correspondences(
+                targetFeatures,
+                sourceFeatures,
+                ratio=parameters.get("ratioTest", 0.9),
+                topK=parameters.get("correspondenceTopK", 1),
+                matcher=parameters.get("featureMatcher", "tree"),
+                matcherOptions=parameters.get("featureMatcherOptions"),
+            )
+            maxCorrespondences = parameters.get("maxCorrespondences", 4000)
+            corrs_A, corrs_B = corrs_A[:maxCorrespondences], corrs_B[:maxCorrespondences]
+            confidence = confidence[:maxCorrespondences]
+        else:
+            corrs_A, corrs_B = self.find_correspondences(
+                targetFeatures,
+                sourceFeatures,
+                mutual_filter=True,
+                matcher=parameters.get("featureMatcher", "tree"),
+                matcherOptions=parameters.get("featureMatcherOptions"),
+                measureRecall=parameters.get("featureMatcherRecall", False),
+            )
+
+        targetPoints = targetPoints.T
+        sourcePoints = sourcePoints.T
+
+        fixed_corr = targetPoints[:, corrs_A]  # np array of size 3 by num_corrs
+        moving_corr = sourcePoints[:, corrs_B]  # np array of size 3 by num_corrs
+
+        num_corrs = fixed_corr.shape[1]
+        print(f"FPFH generates {num_corrs} putative correspondences.")
+        if pruning:
+            keep, _ = self.consistent_correspondences(
+                fixed_corr.T,
+                moving_corr.T,
+                parameters.get("consistencyThreshold", 1.0) * voxelSize,
+                confidence=confidence,
+                minScore=parameters.get("consistencyMinScore", 0.5),
+            )
+            if np.count_nonzero(keep) >= 3:
+                fixed_corr, moving_corr = fixed_corr[:, keep], moving_corr[:, keep]
+                print(f"{fixed_corr.shape[1]} correspondences are left after the consistency check.")
+            else:
+                print("Too few consistent correspondences, keeping all of them")
+        self.metrics.record(
+            "correspondences",
+            time.perf_counter() - stageStart,
+            correspondences=num_corrs,
+            consistent=fixed_corr.shape[1],
+        )
+
+        targetPoints = targetPoints.T
+        sourcePoints = sourcePoints.T
+
+        # Check corner case when both meshes are same
+        if np.allclose(fixed_corr, moving_corr):
+            print("Same meshes therefore returning Identity Transform")
+            transform = itk.VersorRigid3DTransform[itk.D].New()
+            transform.SetIdentity()
+            return [transform, transform]
+
+        bransac = time.perf_counter()
+
+        # The target points never move, so one index serves the fitness of every
+        # RANSAC attempt, the checks around ICP and every ICP iteration
+        targetIndex = NearestNeighborIndex(targetPoints, workers=self.stageThreads("ICP"))
+        # "itk" runs itk.RANSAC, "numpy" runs the batched ransac_numpy with adaptive termination
+        ransacBackend = parameters.get("RANSACBackend", "itk")
+        ransacConfidence = parameters.get("RANSACConfidence", 0.99)
+        # Likewise the ITK RANSAC input containers are built once and shared by all attempts
+        ransacData = None
+        if ransacBackend == "itk":
+            ransacData = self.build_ransac_data(
+                sourcePoints, targetPoints, moving_corr.T, fixed_corr.T
+            )
+
+        maxAttempts = 1
+        attempt = 0
+        best_fitness = -1
+        best_rmse = np.inf
+        while attempt < maxAttempts:
+            self.reportProgress("RANSAC")
+            # Perform Initial alignment using Ransac parallel iterations with no scaling
+            transform_matrix, fitness, rmse = self.run_ransac(
+                movingMeshPoints=sourcePoints,
+                fixedMeshPoints=targetPoints,
+                movingMeshFeaturePoints=moving_corr.T,
+                fixedMeshFeaturePoints=fixed_corr.T,
+                number_of_iterations=parameters["maxRANSAC"],
+                number_of_ransac_points=3,
+                inlier_value=float(parameters["distanceThreshold"]) * voxelSize,
+                scalingOption=False,
+                check_edge_length=True,
+                correspondence_distance=0.9,
+                ransacData=ransacData,
+                backend=ransacBackend,
+                confidence=ransacConfidence,
+            )
+
+            transform = itk.transform_from_dict(transform_matrix)
+            fitness_forward, rmse_forward = self.get_fitness(
+                sourcePoints,
+                targetPoints,
+                float(parameters["distanceThreshold"]) * voxelSize,
+                transform,
+                targetIndex=targetIndex,
+            )
+
+            mean_fitness = fitness_forward
+            mean_rmse = rmse_forward
+            print(
+                "Non-Scaling Attempt = ",
+                attempt,
+                " Fitness = ",
+                mean_fitness,
+                " RMSE is ",
+                mean_rmse,
+            )
+
+            if mean_fitness > 0.99:
+                # Only compare RMSE if mean_fitness is greater than 0.99
+                if mean_rmse < best_rmse:
+                    best_fitness = mean_fitness
+                    best_rmse = mean_rmse
+                    best_transform = transform_matrix
+            else:
+                if mean_fitness > best_fitness:
+                    best_fitness = mean_fitness
+                    best_rmse = mean_rmse
+                    best_transform = transform_matrix
+
+            # Rigid Transform is un-fit for this use-case so perform scaling based RANSAC
+            # if mean_fitness < 0.9:
+            #  break
+            attempt = attempt + 1
+
+        print("Best Fitness without Scaling ", best_fitness, " RMSE is ", best_rmse)
+
+        if scalingOption:
+            maxAttempts = 10
+            attempt = 0
+
+            correspondence_distance = 0.9
+            ransac_points = 3
+            ransac_iterations = int(parameters["maxRANSAC"])
+
+            while mean_fitness < 0.99 and attempt < maxAttempts:
+                self.reportProgress("RANSAC", attempt / maxAttempts)
+                transform_matrix, fitness, rmse = self.run_ransac(
+                    movingMeshPoints=sourcePoints,
+                    fixedMeshPoints=targetPoints,
+                    movingMeshFeaturePoints=moving_corr.T,
+                    fixedMeshFeaturePoints=fixed_corr.T,
+                    number_of_iterations=ransac_iterations,
+                    number_of_ransac_points=ransac_points,
+                    inlier_value=float(parameters["distanceThreshold"]) * voxelSize,
+                    scalingOption=True,
+                    check_edge_length=False,
+                    correspondence_distance=correspondence_distance,
+                    ransacData=ransacData,
+                    backend=ransacBackend,
+                    confidence=ransacConfidence,
+                )
+
+                transform = itk.transform_from_dict(transform_matrix)
+                fitness_forward, rmse_forward = self.get_fitness(
+                    sourcePoints,
+                    targetPoints,
+                    float(parameters["distanceThreshold"]) * voxelSize,
+                    transform,
+                    targetIndex=targetIndex,
+                )
+
+                mean_fitness = fitness_forward
+                mean_rmse = rmse_forward
+                print(
+                    "Scaling Attempt = ",
+                    attempt,
+                    " Fitness = ",
+                    mean_fitness,
+                    " RMSE = ",
+                    mean_rmse,
+                )
+
+                if (mean_fitness > best_fitness) or (
+                    mean_fitness == best_fitness and mean_rmse < best_rmse
+                ):
+                    best_fitness = mean_fitness
+                    best_rmse = mean_rmse
+                    best_transform = transform_matrix
+                    similarityFlag = True
+                attempt = attempt + 1
+
+        aransac = time.perf_counter()
+        print("RANSAC Duraction ", aransac - bransac)
+        print("Best Fitness after scaling ", best_fitness)
+        self.metrics.record(
+            "RANSAC",
+            aransac - bransac,
+            backend=ransacBackend,
+            correspondences=num_corrs,
+            fitness=best_fitness,
+            rmse=best_rmse,
+            similarity=similarityFlag,
+        )
+
+        first_transform = itk.transform_from_dict(best_transform)
+        return self.refine_transform(
+            sourcePoints, targetPoints, first_transform, voxelSize, parameters, targetIndex
+        ), similarityFlag
+
+
+    def refine_transform(
+        self, sourcePoints, targetPoints, first_transform, voxelSize, parameters, targetIndex=None,
+        targetNormals=None,
+    ):
+        """
+        Point-to-plane ICP refinement starting from first_transform.
+        Returns first_transform composed with the ICP correction.
+        targetNormals are reused instead of being estimated again, see final_iteration_icp.
+        """
+        stageStart = time.perf_counter()
+        if targetIndex is None:
+            targetIndex = NearestNeighborIndex(targetPoints, workers=self.stageThreads("ICP"))
+        sourcePoints = self.transform_numpy_points(sourcePoints, first_transform)
+
+        print("-----------------------------------------------------------")
+        print(parameters)
+        print("Starting Rigid Refinement")
+        distanceThreshold = parameters["ICPDistanceThreshold"] * voxelSize
+        inlier, rmse = self.get_fitness(
+            sourcePoints, targetPoints, distanceThreshold, targetIndex=targetIndex
+        )
+        print("Before Inlier = ", inlier, " RMSE = ", rmse)
+        beforeInlier, beforeRMSE = inlier, rmse
+        _, second_transform = self.final_iteration_icp(
+            targetPoints,
+            sourcePoints,
+            distanceThreshold,
+            float(parameters["normalSearchRadius"] * voxelSize),
+            targetIndex=targetIndex,
+            rejectors=parameters.get("ICPRejectors", ("distance",)),
+            angleThreshold=parameters.get("ICPAngleThreshold", 20),
+            pyramidLevels=parameters.get("ICPPyramidLevels"),
+            voxelSize=voxelSize,
+            fixedNormals=targetNormals,
+        )
+
+        final_mesh_points = self.transform_numpy_points(sourcePoints, second_transform)
+        inlier, rmse = self.get_fitness(
+            final_mesh_points, targetPoints, distanceThreshold, targetIndex=targetIndex
+        )
+        print("After Inlier = ", inlier, " RMSE = ", rmse)
+        targetIndex.report("Target index")
+        self.metrics.record(
+            "refinement",
+            time.perf_counter() - stageStart,
+            fitnessBefore=beforeInlier,
+            rmseBefore=beforeRMSE,
+            fitnessAfter=inlier,
+            rmseAfter=rmse,
+        )
+        self.metrics.record(
+            "targetIndex",
+            targetIndex.buildTime + targetIndex.queryTime,
+            buildSeconds=targetIndex.buildTime,
+            querySeconds=targetIndex.queryTime,
+            queries=targetIndex.queryCount,
+        )
+        first_transform.Compose(second_transform)
+        return first_transform
+
+
+
+    def find_correspondences(
+        self, feats0, feats1, mutual_filter=True, matcher="tree", matcherOptions=None, measureRecall=False
+    ):
+        """
+        This function is reused from the ALPACA module of SlicerMorph (https://github.com/SlicerMorph/SlicerMorph/tree/master)
+        Using the FPFH features find noisy corresspondes.
+        These corresspondes will be used inside the RANSAC.
+        matcher is a FeatureMatcher method ("tree", "brute" or "projection") and matcherOptions
+        its keyword arguments. With measureRecall the matches are also compared with exact
+        brute force ones, and the recall is recorded in the run metrics.
+        """
+        stageStart = time.perf_counter()
+        matcherOptions = dict({"workers": self.stageThreads("matching")}, **(matcherOptions or {}))
+        matcher1 = FeatureMatcher(feats1, matcher, **matcherOptions)
+        dists1, nns01 = matcher1.query(feats0)
+        corres01_idx0 = np.arange(len(nns01))
+        corres01_idx1 = nns01
+
+        matchers = [matcher1]
+        if mutual_filter:
+            matcher0 = FeatureMatcher(feats0, matcher, **matcherOptions)
+            dists2, nns10 = matcher0.query(feats1)
+            matchers.append(matcher0)
+
+        values = {
+            "method": matcher,
+            "buildSeconds": sum(m.buildTime for m in matchers),
+            "querySeconds": sum(m.queryTime for m in matchers),
+        }
+        if measureRecall:
+            _, exact01 = FeatureMatcher(feats1, "brute").query(feats0)
+            values["recall"] = FeatureMatcher.recall(nns01, exact01)
+            print(f"Feature matcher {matcher} recall {values['recall']:.4f}")
+        self.metrics.record("featureMatching", time.perf_counter() - stageStart, **values)
+
+        if not mutual_filter:
+            return corres01_idx0, corres01_idx1
+
+        corres10_idx0 = nns10
+
+        mutual_filter = corres10_idx0[corres01_idx1] == corres01_idx0
+        corres_idx0 = corres01_idx0[mutual_filter]
+        corres_idx1 = corres01_idx1[mutual_filter]
+
+        return corres_idx0, corres_idx1
+
+
+    def find_scored_correspondences(
+        self, feats0, feats1, ratio=0.9, topK=1, mutual_filter=True, matcher="tree", matcherOptions=None
+    ):
+        """
+        Putative correspondences feats0[i] <-> feats1[j] with a confidence score.
+        Every feats0 feature keeps up to topK nearest feats1 features whose distance is below
+        ratio times the distance of its (topK + 1)-th nearest one; with topK=1 this is Lowe's
+        ratio test. The confidence is 1 - distance / (topK + 1)-th distance. With mutual_filter,
+        i must also be among the topK nearest feats0 features of j.
+        Returns (indices0, indices1, confidence) sorted by decreasing confidence.
+        """
+        stageStart = time.perf_counter()
+        matcherOptions = dict({"workers": self.stageThreads("matching")}, **(matcherOptions or {}))
+        topK = max(1, min(topK, feats1.shape[0] - 1))
+        matcher1 = FeatureMatcher(feats1, matcher, **matcherOptions)
+        distances, indices = matcher1.query(feats0, k=topK + 1)
+        reference = distances[:, topK:]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            ratios = np.where(reference > 0, distances[:, :topK] / reference, 1.0)
+        passed = ratios < ratio
+        indices0 = np.broadcast_to(np.arange(feats0.shape[0])[:, None], passed.shape)[passed]
+        indices1 = indices[:, :topK][passed]
+        confidence = 1.0 - ratios[passed]
+        values = {"method": matcher, "topK": topK, "ratioPassed": indices0.shape[0]}
+
+        matchers = [matcher1]
+        if mutual_filter:
+            matcher0 = FeatureMatcher(feats0, matcher, **matcherOptions)
+            _, reverse = matcher0.query(feats1, k=topK)
+            reverse = reverse.reshape(feats1.shape[0], -1)
+            mutual = np.any(reverse[indices1] == indices0[:, None], axis=1)
+            indices0, indices1, confidence = indices0[mutual], indices1[mutual], confidence[mutual]
+            values["mutualPassed"] = indices0.shape[0]
+            matchers.append(matcher0)
+
+        order = np.argsort(-confidence, kind="stable")
+        values["buildSeconds"] = sum(m.buildTime for m in matchers)
+        values["querySeconds"] = sum(m.queryTime for m in matchers)
+        self.metrics.record("featureMatching", time.perf_counter() - stageStart, **values)
+        return indices0[order], indices1[order], confidence[order]
+
+
+    def consistent_correspondences(
+        self, fixedPoints, movingPoints, threshold, confidence=None, iterations=5, minScore=0.5, maxBlockElements=2**22
+    ):
+        """
+        Pairwise distance consistency check of correspondences fixedPoints[i] <-> movingPoints[i].
+        A rigid transform keeps distances, so correspondences i and j are consistent when
+        | |f_i - f_j| - |m_i - m_j| | < threshold. The consistency matrix is built block by block
+        and a few power iterations, started from the confidences, give every correspondence its
+        weight in the largest mutually consistent group (spectral matching). Correspondences
+        whose score is below minScore times the best are dropped.
+        Returns the boolean mask of kept correspondences and the scores.
+        """
+        from scipy.spatial.distance import cdist
+
+        count = fixedPoints.shape[0]
+        if count < 4:
+            return np.ones(count, dtype=bool), np.ones(count)
+        consistent = np.empty((count, count), dtype=np.float32)
+        blockRows = max(1, maxBlockElements // count)
+        for start in range(0, count, blockRows):
+            stop = min(start + blockRows, count)
+            difference = cdist(fixedPoints[start:stop], fixedPoints) - cdist(movingPoints[start:stop], movingPoints)
+            consistent[start:stop] = np.abs(difference) < threshold
+
+        scores = np.ones(count, dtype=np.float32) if confidence is None else np.asarray(confidence, dtype=np.float32)
+        for _ in range(iterations):
+            scores = consistent @ scores
+            scores /= max(float(scores.max()), np.finfo(np.float32).tiny)
+        return scores >= minScore, scores
+
+
+    def find_knn_cpu(self, feat0, feat1, knn=1, return_distance=False):
+        from scipy.spatial import cKDTree
+
+        feat1tree = cKDTree(feat1)
+        dists, nn_inds = feat1tree.query(feat0, k=knn)
+        if return_distance:
+            return nn_inds, dists
+        else:
+            return nn_inds
+
+    def get_fitness(
+        self,
+        movingMeshPoints,
+        fixedMeshPoints,
+        distanceThrehold,
+        transform=None,
+        targetIndex=None,
+    ):
+        """
+        Fraction of moving points with a fixed point closer than distanceThrehold and
+        the mean distance of those inliers.
+        transform is an optional ITK transform (or 4x4 matrix) applied to the moving points.
+        If targetIndex (a NearestNeighborIndex over fixedMeshPoints) is given it is
+        reused, otherwise one is built for this call.
+        """
+        if targetIndex is None:
+            targetIndex = NearestNeighborIndex(fixedMeshPoints, workers=self.stageThreads("ICP"))
+        if transform is not None and not isinstance(transform, np.ndarray):
+            transform = self.itk_transform_to_matrix(transform)
+        fitness, inlier_rmse = self.evaluate_fitness(
+            movingMeshPoints, targetIndex, distanceThrehold, transform
+        )
+        return float(fitness), float(inlier_rmse)
+
+
+    def evaluate_fitness(
+        self,
+        movingMeshPoints,
+        targetIndex,
+        distanceThrehold,
+        transforms=None,
+        maxPointsPerQuery=2000000,
+    ):
+        """
+        Vectorized fitness evaluation against a prebuilt target index.
+        Input:
+            movingMeshPoints: Nx3 numpy array of moving points
+            targetIndex: NearestNeighborIndex over the fixed points
+            distanceThrehold: a moving point is an inlier if its nearest fixed point is closer than this
+            transforms: None, a 4x4 homogeneous matrix, or a Kx4x4 stack of candidate matrices
+            maxPointsPerQuery: bound on the number of transformed points queried at once
+        Output:
+            fitness: inlier ratio, a scalar or a K array for a stack of transforms
+            inlier_rmse: mean inlier distance (same definition as get_fitness), inf if there are no inliers
+        """
+        points = np.asarray(movingMeshPoints, dtype=np.float64)
+        if transforms is None:
+            transforms = np.identity(4)
+        transforms = np.asarray(transforms, dtype=np.float64)
+        single = transforms.ndim == 2
+        transforms = transforms.reshape(-1, 4, 4)
+
+        numberOfPoints = points.shape[0]
+        fitness = np.zeros(transforms.shape[0])
+        inlier_rmse = np.full(transforms.shape[0], np.inf)
+        batchSize = max(1, int(maxPointsPerQuery // max(numberOfPoints, 1)))
+        for first in range(0, transforms.shape[0], batchSize):
+            batch = transforms[first : first + batchSize]
+            # K x N x 3 moving points under every candidate transform
+            moved = np.einsum("kij,nj->kni", batch[:, :3, :3], points) + batch[:, None, :3, 3]
+            distances, _ = targetIndex.query(moved.reshape(-1, 3))
+            distances = distances.reshape(batch.shape[0], numberOfPoints)
+            inliers = distances < distanceThrehold
+            counts = np.count_nonzero(inliers, axis=1)
+            sums = np.where(inliers, distances, 0).sum(axis=1)
+            fitness[first : first + batchSize] = counts / numberOfPoints
+            inlier_rmse[first : first + batchSize] = np.divide(
+                sums, counts, out=np.full(batch.shape[0], np.inf), where=counts > 0
+            )
+
+        if single:
+            return fitness[0], inlier_rmse[0]
+        return fitness, inlier_rmse
+
+
+    def itk_transform_to_matrix(self, itkTransform):
+        """Return the 4x4 homogeneous numpy matrix of an ITK matrix-offset transform."""
+        matrix = itkTransform.GetMatrix()
+        offset = itkTransform.GetOffset()
+        T = np.identity(4)
+        for i in range(3):
+            for j in range(3):
+                T[i, j] = matrix(i, j)
+            T[i, 3] = offset[i]
+        return T
+
+
+    def ransac_using_package(
+        self,
+        movingMeshPoints,
+        fixedMeshPoints,
+        movingMeshFeaturePoints,
+        fixedMeshFeaturePoints,
+        number_of_iterations,
+        number_of_ransac_points,
+        inlier_value,
+        scalingOption,
+        check_edge_length,
+        correspondence_distance,
+        ransacData=None,
+    ):
+        # This function is reused from the ALPACA module of SlicerMorph (https://github.com/SlicerMorph/SlicerMorph/tree/master)
+        # ransacData is the (data, agreeData) pair from build_ransac_data. It only depends on
+        # the points and correspondences, so callers can build it once and reuse it across attempts.
+        import itk
+
+        if ransacData is None:
+            ransacData = self.build_ransac_data(
+                movingMeshPoints,
+                fixedMeshPoints,
+                movingMeshFeaturePoints,
+                fixedMeshFeaturePoints,
+            )
+        data, agreeData = ransacData
+
+        transformParameters = itk.vector.D()
+        bestTransformParameters = itk.vector.D()
+
+        maximumDistance = inlier_value
+        if not scalingOption:
+            print("Rigid Reg, no scaling")
+            TransformType = itk.VersorRigid3DTransform[itk.D]
+            RegistrationEstimatorType = itk.Ransac.LandmarkRegistrationEstimator[
+                6, TransformType
+            ]
+        else:
+            print("NonRigid Reg, with scaling")
+            TransformType = itk.Similarity3DTransform[itk.D]
+            RegistrationEstimatorType = itk.Ransac.LandmarkRegistrationEstimator[
+                6, TransformType
+            ]
+        registrationEstimator = RegistrationEstimatorType.New()
+        registrationEstimator.SetMinimalForEstimate(number_of_ransac_points)
+        registrationEstimator.SetAgreeData(agreeData)
+        registrationEstimator.SetDelta(maximumDistance)
+        registrationEstimator.LeastSquaresEstimate(data, transformParameters)
+
+        # The pool threader itself is set up once by the thread budget
+        maxThreadCount = self.stageThreads("RANSAC")
+
+        desiredProbabilityForNoOutliers = 0.99
+        RANSACType = itk.RANSAC[itk.Point[itk.D, 6], itk.D, TransformType]
+        ransacEstimator = RANSACType.New()
+        ransacEstimator.SetData(data)
+        ransacEstimator.SetAgreeData(agreeData)
+        ransacEstimator.SetCheckCorresspondenceDistance(check_edge_length)
+        if correspondence_distance > 0:
+            ransacEstimator.SetCheckCorrespondenceEdgeLength(correspondence_distance)
+        ransacEstimator.SetMaxIteration(int(number_of_iterations / maxThreadCount))
+        ransacEstimator.SetNumberOfThreads(maxThreadCount)
+        ransacEstimator.SetParametersEstimator(registrationEstimator)
+
+        percentageOfDataUsed = ransacEstimator.Compute(
+            transformParameters, desiredProbabilityForNoOutliers
+        )
+
+        transform = TransformType.New()
+        p = transform.GetParameters()
+        f = transform.GetFixedParameters()
+        for i in range(p.GetSize()):
+            p.SetElement(i, transformParameters[i])
+        counter = 0
+        totalParameters = p.GetSize() + f.GetSize()
+        for i in range(p.GetSize(), totalParameters):
+            f.SetElement(counter, transformParameters[i])
+            counter = counter + 1
+        transform.SetParameters(p)
+        transform.SetFixedParameters(f)
+        return (
+            itk.dict_from_transform(transform),
+            percentageOfDataUsed[0],
+            percentageOfDataUsed[1],
+        )
+
+
+    def run_ransac(self, backend="itk", confidence=0.99, **kwargs):
+        """
+        Dispatch to the selected RANSAC backend.
+        kwargs are the ransac_using_package arguments. Both backends return
+        (itk transform dict, fitness, rmse).
+        """
+        if backend == "itk":
+            return self.ransac_using_package(**kwargs)
+        if backend == "numpy":
+            T, fitness, rmse = self.ransac_numpy(
+                movingMeshFeaturePoints=kwargs["movingMeshFeaturePoints"],
+                fixedMeshFeaturePoints=kwargs["fixedMeshFeaturePoints"],
+                number_of_iterations=kwargs["number_of_iterations"],
+                number_of_ransac_points=kwargs["number_of_ransac_points"],
+                inlier_value=kwargs["inlier_value"],
+                scalingOption=kwargs["scalingOption"],
+                check_edge_length=kwargs["check_edge_length"],
+                correspondence_distance=kwargs["correspondence_distance"],
+                confidence=confidence,
+            )
+            return self.matrix_to_itk_transform_dict(T, kwargs["scalingOption"]), fitness, rmse
+        raise ValueError(f"Unknown RANSAC backend: {backend}")
+
+
+    def ransac_numpy(
+        self,
+        movingMeshFeaturePoints,
+        fixedMeshFeaturePoints,
+        number_of_iterations,
+        number_of_ransac_points,
+        inlier_value,
+        scalingOption,
+        check_edge_length,
+        correspondence_distance,
+        confidence=0.99,
+        batch_size=1000,
+        maxScoredPairs=4000000,
+        seed=0,
+    ):
+        """
+        RANSAC over putative correspondences written in numpy.
+        Hypotheses are drawn in batches, fitted with batched SVD (rigid, or similarity if
+        scalingOption) and scored against all correspondences at once. Sampling stops once
+        the number of iterations reaches the standard bound
+        log(1 - confidence) / log(1 - w^k) for the best inlier ratio w seen so far,
+        or number_of_iterations.
+        Input:
+            movingMeshFeaturePoints, fixedMeshFeaturePoints: Nx3 corresponding points
+            number_of_iterations: maximum number of hypotheses
+            number_of_ransac_points: points per hypothesis (k)
+            inlier_value: residual threshold of an inlier correspondence
+            check_edge_length: reject samples whose edge lengths differ between the two
+                sides by more than correspondence_distance (ratio of shorter to longer edge)
+            confidence: desired probability of drawing at least one outlier free sample
+            batch_size: hypotheses per batch, further capped so that batch x N <= maxScoredPairs
+        Output:
+            T: 4x4 homogeneous matrix mapping moving onto fixed points
+            fitness: inlier ratio of the correspondences
+            rmse: root mean square residual of the inlier correspondences
+        """
+        start = time.perf_counter()
+        P = np.asarray(movingMeshFeaturePoints, dtype=np.float64)
+        Q = np.asarray(fixedMeshFeaturePoints, dtype=np.float64)
+        numberOfCorrespondences = P.shape[0]
+        k = int(number_of_ransac_points)
+        if numberOfCorrespondences < k:
+            # e.g. everything removed by the mutual filter or the pruning
+            print(f"NumPy RANSAC needs {k} correspondences, got {numberOfCorrespondences}, returning identity")
+            return np.identity(4), 0.0, np.inf
+        rng = np.random.default_rng(seed)
+        batch_size = max(1, min(int(batch_size), maxScoredPairs // max(numberOfCorrespondences, 1)))
+        pairs = [(a, b) for a in range(k) for b in range(a + 1, k)]
+
+        best_count = -1
+        best_inliers = None
+        required = int(number_of_iterations)
+        iterations = 0
+        while iterations < required:
+            samples = rng.integers(0, numberOfCorrespondences, (batch_size, k))
+            iterations += batch_size
+            Ps = P[samples]
+            Qs = Q[samples]
+
+            valid = np.ones(batch_size, dtype=bool)
+            for a, b in pairs:
+                movingEdge = np.linalg.norm(Ps[:, a] - Ps[:, b], axis=1)
+                fixedEdge = np.linalg.norm(Qs[:, a] - Qs[:, b], axis=1)
+                # repeated indices give zero-length edges and a degenerate fit
+                valid &= (movingEdge > 0) & (fixedEdge > 0)
+                if check_edge_length:
+                    valid &= np.minimum(movingEdge, fixedEdge) >= correspondence_distance * np.maximum(
+                        movingEdge, fixedEdge
+                    )
+            if not np.any(valid):
+                continue
+
+            Ts = self.estimate_transforms_batched(Ps[valid], Qs[valid], scalingOption)
+            residuals = np.linalg.norm(
+                np.einsum("kij,nj->kni", Ts[:, :3, :3], P) + Ts[:, None, :3, 3] - Q, axis=2
+            )
+            counts = np.count_nonzero(residuals < inlier_value, axis=1)
+            best = int(np.argmax(counts))
+            if counts[best] > best_count:
+                best_count = int(counts[best])
+                best_inliers = residuals[best] < inlier_value
+                w = best_count / numberOfCorrespondences
+                if w >= 1:
+                    required = 0
+                elif w > 0:
+                    bound = np.ceil(np.log(1 - confidence) / np.log(1 - w**k))
+                    required = int(min(bound, number_of_iterations))
+
+        if best_inliers is None or best_count < k:
+            print("NumPy RANSAC found no valid hypothesis, returning identity")
+            return np.identity(4), 0.0, np.inf
+
+        # Least squares refit on the consensus set
+        T = self.estimate_transforms_batched(
+            P[best_inliers][None], Q[best_inliers][None], scalingOption
+        )[0]
+        residuals = np.linalg.norm(P @ T[:3, :3].T + T[:3, 3] - Q, axis=1)
+        inliers = residuals < inlier_value
+        fitness = np.count_nonzero(inliers) / numberOfCorrespondences
+        rmse = np.sqrt(np.mean(residuals[inliers] ** 2)) if np.any(inliers) else np.inf
+        print(
+            f"NumPy RANSAC: {iterations} hypotheses in {time.perf_counter() - start:.3f} s, "
+            f"inlier ratio {fitness:.4f}"
+        )
+        return T, fitness, rmse
+
+
+    def estimate_transforms_batched(self, A, B, scalingOption=False):
+        """
+        Batched least squares rigid (or similarity if scalingOption) fit (Umeyama).
+        Input:
+            A, B: KxNx3 stacks of corresponding point sets
+        Output:
+            Kx4x4 homogeneous matrices mapping each A[k] onto B[k]
+        """
+        centroidA = A.mean(axis=1, keepdims=True)
+        centroidB = B.mean(axis=1, keepdims=True)
+        AA = A - centroidA
+        BB = B - centroidB
+        H = np.einsum("kni,knj->kij", AA, BB)
+        U, S, Vt = np.linalg.svd(H)
+        # special reflection case
+        d = np.sign(np.linalg.det(np.einsum("kji,klj->kil", Vt, U)))
+        d[d == 0] = 1
+        D = np.ones((A.shape[0], 3))
+        D[:, 2] = d
+        R = np.einsum("kji,kj,klj->kil", Vt, D, U)
+        if scalingOption:
+            scale = np.sum(S * D, axis=1) / np.sum(AA**2, axis=(1, 2))
+        else:
+            scale = np.ones(A.shape[0])
+        T = np.tile(np.identity(4), (A.shape[0], 1, 1))
+        T[:, :3, :3] = scale[:, None, None] * R
+        T[:, :3, 3] = centroidB[:, 0] - np.einsum("kij,kj->ki", T[:, :3, :3], centroidA[:, 0])
+        return T
+
+
+    def matrix_to_itk_transform_dict(self, T, scalingOption=False):
+        """Convert a 4x4 rigid/similarity matrix to the transform dict returned by ransac_using_package."""
+        import itk
+
+        if scalingOption:
+            transform = itk.Similarity3DTransform[itk.D].New()
+        else:
+            transform = itk.VersorRigid3DTransform[itk.D].New()
+        transform.SetMatrix(itk.matrix_from_array(np.ascontiguousarray(T[:3, :3])), 0.000001)
+        transform.SetTranslation([float(T[0, 3]), float(T[1, 3]), float(T[2, 3])])
+        return itk.dict_from_transform(transform)
+
+
+    def build_ransac_data(
+        self,
+        movingMeshPoints,
+        fixedMeshPoints,
+        movingMeshFeaturePoints,
+        fixedMeshFeaturePoints,
+    ):
+        """
+        Build the 6-D RANSAC data and agree-data containers from numpy arrays, stacked in bulk.
+        data holds the moving/fixed feature correspondences. In current implementation the
+        agreedata contains two corresponding points from moving and fixed mesh. However,
+        after the subsampling step the number of points need not be equal in those meshes.
+        So we randomly sample the points from larger mesh, using the same seeded
+        permutations as the previous per-element shuffle.
+        """
+        import itk
+
+        PointVectorType = itk.vector[itk.Point[itk.D, 6]]
+
+        dataArray = np.hstack(
+            (
+                np.asarray(movingMeshFeaturePoints, dtype=np.float64),
+                np.asarray(fixedMeshFeaturePoints, dtype=np.float64),
+            )
+        )
+
+        count_min = int(np.min([movingMeshPoints.shape[0], fixedMeshPoints.shape[0]]))
+        np.random.seed(0)
+        movingOrder = np.random.permutation(movingMeshPoints.shape[0])[:count_min]
+        np.random.seed(0)
+        fixedOrder = np.random.permutation(fixedMeshPoints.shape[0])[:count_min]
+        agreeArray = np.hstack(
+            (
+                np.asarray(movingMeshPoints, dtype=np.float64)[movingOrder],
+                np.asarray(fixedMeshPoints, dtype=np.float64)[fixedOrder],
+            )
+        )
+
+        # ITK wraps no bulk numpy path for std::vector<Point<double, 6>> (no VectorContainer of
+        # 6-D points, vector_container_from_array is 1-D only), and the vector constructor does not
+        # take nested lists. Filling a reserved vector with plain list rows is the cheapest way in.
+        data = PointVectorType()
+        data.reserve(dataArray.shape[0])
+        for row in dataArray.tolist():
+            data.push_back(row)
+        agreeData = PointVectorType()
+        agreeData.reserve(agreeArray.shape[0])
+        for row in agreeArray.tolist():
+            agreeData.push_back(row)
+        return data, agreeData
+
+
+    def itkToVTKTransform(self, itkTransform, similarityFlag=False):
+        import vtk
+
+        matrix = itkTransform.GetMatrix()
+        offset = itkTransform.GetOffset()
+
+        matrix_vtk = vtk.vtkMatrix4x4()
+        for i in range(3):
+            for j in range(3):
+                matrix_vtk.SetElement(i, j, matrix(i, j))
+        for i in range(3):
+            matrix_vtk.SetElement(i, 3, offset[i])
+
+        transform = vtk.vtkTransform()
+        transform.SetMatrix(matrix_vtk)
+        return transform
+
+
+    def transform_numpy_points(self, points_np, transform):
+        import itk
+
+        mesh = itk.Mesh[itk.F, 3].New()
+        mesh.SetPoints(
+            itk.vector_container_from_array(points_np.flatten().astype("float32"))
+        )
+        transformed_mesh = itk.transform_mesh_filter(mesh, transform=transform)
+        points_tranformed = itk.array_from_vector_container(
+            transformed_mesh.GetPoints()
+        )
+        points_tranformed = np.reshape(points_tranformed, [-1, 3])
+        return points_tranformed
+
+
+    def final_iteration_icp(
+        self,
+        fixedPoints,
+        movingPoints,
+        distanceThreshold,
+        normalSearchRadius,
+        targetIndex=None,
+        rejectors=("distance",),
+        angleThreshold=20,
+        pyramidLevels=None,
+        voxelSize=None,
+        fixedNormals=None,
+    ):
+        """
+        Point-to-plane ICP of movingPoints onto fixedPoints, returned as an ITK rigid transform.
+        fixedNormals, if given, are the normals of fixedPoints and are used at the scale 1 level.
+        pyramidLevels enables coarse-to-fine refinement: a sequence of (scale, maxIterations)
+        pairs, coarsest first. Each level regrids both point sets with a voxel of scale * voxelSize,
+        multiplies distanceThreshold and normalSearchRadius by scale, and starts from the
+        previous level's transform. A level with scale 1 uses the points as they are.
+        """
+        import itk
+        if targetIndex is None:
+            targetIndex = NearestNeighborIndex(fixedPoints, workers=self.stageThreads("ICP"))
+        if pyramidLevels is None:
+            pyramidLevels = ((1, 30),)
+
+        finalT = np.identity(4)
+        for scale, maxIterations in pyramidLevels:
+            if scale == 1:
+                levelFixed, levelMoving, levelIndex = fixedPoints, movingPoints, targetIndex
+            else:
+                levelFixed = self.subsample_points_voxelgrid_numpy(fixedPoints, scale * voxelSize)
+                levelMoving = self.subsample_points_voxelgrid_numpy(movingPoints, scale * voxelSize)
+                levelIndex = NearestNeighborIndex(levelFixed, workers=self.stageThreads("ICP"))
+            levelMoving = levelMoving @ finalT[:3, :3].T + finalT[:3, 3]
+            print(
+                f"ICP level scale {scale}: {levelMoving.shape[0]} moving, "
+                f"{levelFixed.shape[0]} fixed points"
+            )
+
+            if scale == 1 and fixedNormals is not None:
+                fixedPointsNormal = fixedNormals
+            else:
+                fixedPointsNormal = self.extract_pca_normal_batched(
+                    levelFixed, scale * normalSearchRadius
+                )
+            movingPointsNormal = self.extract_pca_normal_batched(
+                levelMoving, scale * normalSearchRadius
+            )
+
+            _, (T, R, t) = self.point_to_plane_icp(
+                levelMoving,
+                levelFixed,
+                movingPointsNormal,
+                fixedPointsNormal,
+                scale * distanceThreshold,
+                max_iterations=maxIterations,
+                targetIndex=levelIndex,
+                rejectors=rejectors,
+                angle_threshold=angleThreshold,
+            )
+            finalT = T @ finalT
+
+        R = finalT[:3, :3]
+        t = finalT[:3, 3]
+        transform = itk.Rigid3DTransform.D.New()
+        transform.SetMatrix(itk.matrix_from_array(np.ascontiguousarray(R)), 0.000001)
+        transform.SetTranslation([t[0], t[1], t[2]])
+        return movingPoints, transform
+
+
+    def subsample_points_voxelgrid_numpy(self, points, leafSize):
+        """
+        Voxel grid subsampling of an Nx3 numpy array: one point per occupied voxel of
+        size leafSize, at the centroid of the points in that voxel.
+        """
+        points = np.asarray(points, dtype=np.float64)
+        cells = np.floor((points - points.min(axis=0)) / leafSize).astype(np.int64)
+        dims = cells.max(axis=0) + 1
+        keys = cells[:, 0] + dims[0] * (cells[:, 1] + dims[1] * cells[:, 2])
+        _, inverse, counts = np.unique(keys, return_inverse=True, return_counts=True)
+        inverse = inverse.ravel()
+        centroids = np.empty((counts.shape[0], 3))
+        for axis in range(3):
+            centroids[:, axis] = np.bincount(inverse, weights=points[:, axis]) / counts
+        return centroids
+
+    def point_to_plane_icp(
+        self,
+        src_pts,
+        dst_pts,
+        src_pt_normals,
+        dst_pt_normals,
+        dist_threshold=np.inf,
+        max_iterations=30,
+        tolerance=0.000001,
+        vectorized=True,
+        targetIndex=None,
+        rejectors=("distance",),
+        angle_threshold=20,
+    ):
+        """
+            The Iterative Closest Point method: finds best-fit transform that
+                maps points A on to points B
+            Input:
+                A: Nxm numpy array of source mD points
+                B: Nxm numpy array of destination mD point
+                max_iterations: exit algorithm after max_iterations
+                tolerance: convergence criteria
+                vectorized: use the batched point-to-plane solver; False runs the
+                    per-correspondence reference solver
+                targetIndex: NearestNeighborIndex over B; built here if not given
+                rejectors: correspondence rejectors to apply, see reject_correspondences
+                angle_threshold: maximum normal angle in degrees for the "angle" rejector
+            Output:
+                T: final homogeneous transformation that maps A on to B
+                MeanError: list, report each iteration's distance mean error
+        """
+        A = src_pts
+        A_normals = src_pt_normals
+        B = dst_pts
+        B_normals = dst_pt_normals
+
+        # get number of dimensions
+        m = A.shape[1]
+
+        # make points homogeneous, copy them to maintain the originals
+        src = np.ones((m + 1, A.shape[0]))
+        dst = np.ones((m + 1, B.shape[0]))
+        src[:m, :] = np.copy(A.T)
+        dst[:m, :] = np.copy(B.T)
+
+        stageStart = time.perf_counter()
+        prev_error = 0
+        MeanError = []
+
+        finalT = np.identity(4)
+
+        if targetIndex is None:
+            targetIndex = NearestNeighborIndex(B, workers=self.stageThreads("ICP"))
+
+        for i in range(max_iterations):
+            self.reportProgress("ICP", i / max_iterations)
+            # find the nearest neighbors between the current source and destination points
+            distances, indices = targetIndex.query(src[:m, :].T)
+
+            # match each point of source-set to closest point of destination-set,
+            matched_src_pts = src[:m, :].T.copy()
+            matched_dst_pts = dst[:m, indices].T
+
+            # source normals follow the rotation accumulated so far
+            matched_src_pt_normals = A_normals @ finalT[:3, :3].T
+            matched_dst_pt_normals = B_normals[indices, :]
+
+            # and reject the bad corresponding
+            reject_part_flag = self.reject_correspondences(
+                distances,
+                matched_src_pt_normals,
+                matched_dst_pt_normals,
+                dist_threshold,
+                angle_threshold,
+                rejectors,
+            )
+
+            # get matched vertices and dst_vertexes' normals
+            matched_src_pts = matched_src_pts[reject_part_flag, :]
+            matched_dst_pts = matched_dst_pts[reject_part_flag, :]
+            matched_dst_pt_normals = matched_dst_pt_normals[reject_part_flag, :]
+
+            # compute the transformation between the current source and nearest destination points
+            if vectorized:
+                T, _, _ = self.best_fit_transform_point2plane_vectorized(
+                    matched_src_pts, matched_dst_pts, matched_dst_pt_normals
+                )
+            else:
+                T, _, _ = self.best_fit_transform_point2plane(
+                    matched_src_pts, matched_dst_pts, matched_dst_pt_normals
+                )
+
+            finalT = np.dot(T, finalT)
+
+            # update the current source
+            src = np.dot(T, src)
+
+            # print iteration
+            # print('\ricp iteration: %d/%d ...' % (i+1, max_iterations), end='', flush=True)
+
+            # check error
+            mean_error = np.mean(distances[reject_part_flag])
+            MeanError.append(mean_error)
+            if tolerance is not None:
+                if np.abs(prev_error - mean_error) < tolerance:
+                    break
+            prev_error = mean_error
+        print("Refinement took ", i, " iterations")
+        self.metrics.record(
+            "point_to_plane_icp",
+            time.perf_counter() - stageStart,
+            sourcePoints=A.shape[0],
+            targetPoints=B.shape[0],
+            iterations=i + 1,
+            meanError=MeanError[-1] if MeanError else None,
+        )
+        # calculate final transformation
+        # T, R, t = self.best_fit_transform_point2point(A, src[:m, :].T)
+        # return MeanError, (T, R, t)
+        return MeanError, (finalT, finalT[:3, :3], finalT[:, 3])
+
+
+    def reject_correspondences(
+        self,
+        distances,
+        src_normals,
+        dst_normals,
+        dist_threshold=np.inf,
+        angle_threshold=20,
+        rejectors=("distance",),
+    ):
+        """
+        Batched correspondence rejection for point_to_plane_icp.
+        Input:
+            distances: N array of distances between matched points
+            src_normals: Nx3 normals of the source points
+            dst_normals: Nx3 normals of the matched destination points
+            dist_threshold: maximum distance for the "distance" rejector
+            angle_threshold: maximum angle in degrees between matched normals for the "angle" rejector
+            rejectors: any combination of "distance" and "angle"
+        Output:
+            N boolean array, True for the correspondences that are kept
+        """
+        keep = np.ones(distances.shape[0], dtype=bool)
+        for rejector in rejectors:
+            if rejector == "distance":
+                keep &= distances < dist_threshold
+            elif rejector == "angle":
+                cos_angle = np.einsum("ij,ij->i", src_normals, dst_normals) / (
+                    np.linalg.norm(src_normals, axis=1) * np.linalg.norm(dst_normals, axis=1)
+                )
+                keep &= cos_angle > np.cos(np.deg2rad(angle_threshold))
+            else:
+                raise ValueError(f"Unknown correspondence rejector: {rejector}")
+        return keep
+
+
+    def nearest_neighbor(self, src, dst):
+        """
+        Find the nearest (Euclidean) neighbor in dst for each point in src
+        Input:
+            src: Nxm array of points
+            dst: Nxm array of points
+        Output:
+            distances: Euclidean distances of the nearest neighbor
+            indices: dst indices of the nearest neighbor
+        """
+            # assert src.shape == dst.shape
+        from sklearn.neighbors import NearestNeighbors
+        neigh = NearestNeighbors(n_neighbors=1, algorithm="kd_tree")
+        neigh.fit(dst)
+        distances, indices = neigh.kneighbors(src, return_distance=True)
+        return distances.ravel(), indices.ravel()
+
+
+    def best_fit_transform_point2plane(self, A, B, normals):
+        """
+            reference: https://www.comp.nus.edu.sg/~lowkl/publications/lowk_point-to-plane_icp_techrep.pdf
+            Input:
+            A: Nx3 numpy array of corresponding points
+            B: Nx3 numpy array of corresponding points
+            normals: Nx3 numpy array of B's normal vectors
+            Returns:
+            T: (m+1)x(m+1) homogeneous transformation matrix that maps A on to B
+            R: mxm rotation matrix
+            t: mx1 translation vector
+        """
+        assert A.shape == B.shape
+        assert A.shape == normals.shape
+
+        H = []
+        b = []
+        for i in range(A.shape[0]):
+            dx = B[i, 0]
+            dy = B[i, 1]
+            dz = B[i, 2]
+            nx = normals[i, 0]
+            ny = normals[i, 1]
+            nz = normals[i, 2]
+            sx = A[i, 0]
+            sy = A[i, 1]
+            sz = A[i, 2]
+
+            _a1 = (nz * sy) - (ny * sz)
+            _a2 = (nx * sz) - (nz * sx)
+            _a3 = (ny * sx) - (nx * sy)
+
+            _a = np.array([_a1, _a2, _a3, nx, ny, nz])
+            _b = (nx * dx) + (ny * dy) + (nz * dz) - (nx * sx) - (ny * sy) - (nz * sz)
+
+            H.append(_a)
+            b.append(_b)
+
+        H = np.array(H)
+        b = np.array(b)
+
+        tr = np.dot(np.linalg.pinv(H), b)
+        T = self.euler_matrix(tr[0], tr[1], tr[2])
+        T[0, 3] = tr[3]
+        T[1, 3] = tr[4]
+        T[2, 3] = tr[5]
+
+        R = T[:3, :3]
+        t = T[:3, 3]
+
+        return T, R, t
+
+
+    def best_fit_transform_point2plane_vectorized(self, A, B, normals):
+        """
+            Batched version of best_fit_transform_point2plane.
+            The rows of the linear system are built as whole-array operations and
+            the 6x6 normal equations are solved directly instead of taking the
+            pseudo-inverse of the Nx6 matrix.
+            best_fit_transform_point2plane is kept as the reference implementation.
+            Input:
+            A: Nx3 numpy array of corresponding points
+            B: Nx3 numpy array of corresponding points
+            normals: Nx3 numpy array of B's normal vectors
+            Returns:
+            T: (m+1)x(m+1) homogeneous transformation matrix that maps A on to B
+            R: mxm rotation matrix
+            t: mx1 translation vector
+        """
+        assert A.shape == B.shape
+        assert A.shape == normals.shape
+
+        A = np.asarray(A, dtype=np.float64)
+        B = np.asarray(B, dtype=np.float64)
+        normals = np.asarray(normals, dtype=np.float64)
+
+        H = np.empty((A.shape[0], 6))
+        H[:, :3] = np.cross(A, normals)
+        H[:, 3:] = normals
+        b = np.einsum("ij,ij->i", normals, B - A)
+
+        HtH = H.T @ H
+        Htb = H.T @ b
+        try:
+            tr = np.linalg.solve(HtH, Htb)
+        except np.linalg.LinAlgError:
+            # Degenerate geometry (e.g. planar patch): fall back to the minimum norm solution
+            tr = np.linalg.lstsq(H, b, rcond=None)[0]
+
+        T = self.euler_matrix(tr[0], tr[1], tr[2])
+        T[0, 3] = tr[3]
+        T[1, 3] = tr[4]
+        T[2, 3] = tr[5]
+
+        R = T[:3, :3]
+        t = T[:3, 3]
+
+        return T, R, t
+
+
+    def euler_matrix(self, ai, aj, ak):
+        """Return homogeneous rotation matrix from Euler angles and axis sequence.
+        ai, aj, ak : Euler's roll, pitch and yaw angles
+        axes : One of 24 axis sequences as string or encoded tuple
+        >>> R = euler_matrix(1, 2, 3, 'syxz')
+        >>> numpy.allclose(numpy.sum(R[0]), -1.34786452)
+        True
+        >>> R = euler_matrix(1, 2, 3, (0, 1, 0, 1))
+        """
+
+        firstaxis, parity, repetition, frame = (0, 0, 0, 0)
+        _NEXT_AXIS = [1, 2, 0, 1]
+
+        i = firstaxis
+        j = _NEXT_AXIS[i + parity]
+        k = _NEXT_AXIS[i - parity + 1]
+
+        if frame:
+            ai, ak = ak, ai
+        if parity:
+            ai, aj, ak = -ai, -aj, -ak
+
+        si, sj, sk = math.sin(ai), math.sin(aj), math.sin(ak)
+        ci, cj, ck = math.cos(ai), math.cos(aj), math.cos(ak)
+        cc, cs = ci * ck, ci * sk
+        sc, ss = si * ck, si * sk
+
+        M = np.identity(4)
+        if repetition:
+            M[i, i] = cj
+            M[i, j] = sj * si
+            M[i, k] = sj * ci
+            M[j, i] = sj * sk
+            M[j, j] = -cj * ss + cc
+            M[j, k] = -cj * cs - sc
+            M[k, i] = -sj * ck
+            M[k, j] = cj * sc + cs
+            M[k, k] = cj * cc - ss
+        else:
+            M[i, i] = cj * ck
+            M[i, j] = sj * sc - cs
+            M[i, k] = sj * cc + ss
+            M[j, i] = cj * sk
+            M[j, j] = sj * ss + cc
+            M[j, k] = sj * cs - sc
+            M[k, i] = -sj
+            M[k, j] = cj * si
+            M[k, k] = cj * ci
+        return M
+
+
+    def extract_pca_normal_scikit(self, inputPoints, searchRadius):
+        from sklearn.neighbors import KDTree
+        from sklearn.decomposition import PCA
+
+        data = inputPoints
+        tree = KDTree(data, metric="minkowski")  # minkowki is p2 (euclidean)
+
+        # Get indices and distances:
+        ind, dist = tree.query_radius(data, r=searchRadius, return_distance=True)
+
+        def PCA_unit_vector(array, pca=PCA(n_components=3)):
+            pca.fit(array)
+            eigenvalues = pca.explained_variance_
+            return pca.components_[np.argmin(eigenvalues)]
+
+        def calc_angle_with_xy(vectors):
+            l = np.sum(vectors[:, :2] ** 2, axis=1) ** 0.5
+            return np.arctan2(vectors[:, 2], l)
+
+        normals2 = []
+        for i in range(data.shape[0]):
+            if len(ind[i]) < 3:
+                normal_vector = np.identity(3)
+            else:
+                normal_vector = data[ind[i]]
+            normals2.append(PCA_unit_vector(normal_vector))
+
+        n = np.array(normals2)
+        n[calc_angle_with_xy(n) < 0] *= -1
+        return n
+
+
+    def extract_pca_normal_batched(self, inputPoints, searchRadius):
+        """
+        Batched version of extract_pca_normal_scikit.
+        The covariance of every radius neighbourhood is accumulated in bulk and all
+        of them are solved with one stacked np.linalg.eigh call. Points with fewer
+        than 3 neighbours get the same fallback normal as the PCA of np.identity(3),
+        and normals are oriented with the same rule (non-negative angle with the xy plane).
+        """
+        from sklearn.neighbors import KDTree
+
+        data = np.asarray(inputPoints, dtype=np.float64)
+        tree = KDTree(data, metric="minkowski")
+        ind = tree.query_radius(data, r=searchRadius)
+
+        numberOfPoints = data.shape[0]
+        counts = np.fromiter((len(i) for i in ind), dtype=np.int64, count=numberOfPoints)
+        neighbors = np.concatenate(ind).astype(np.int64)
+        owners = np.repeat(np.arange(numberOfPoints), counts)
+
+        # Mean of every neighbourhood, then the centred second moments
+        means = np.empty((numberOfPoints, 3))
+        for axis in range(3):
+            means[:, axis] = np.bincount(
+                owners, weights=data[neighbors, axis], minlength=numberOfPoints
+            )
+        means /= np.maximum(counts, 1)[:, None]
+        centered = data[neighbors] - means[owners]
+        covariances = np.empty((numberOfPoints, 3, 3))
+        for row in range(3):
+            for col in range(row, 3):
+                moment = np.bincount(
+                    owners,
+                    weights=centered[:, row] * centered[:, col],
+                    minlength=numberOfPoints,
+                )
+                covariances[:, row, col] = moment
+                covariances[:, col, row] = moment
+
+        # eigh returns eigenvalues in ascending order, the first eigenvector is the normal
+        _, eigenvectors = np.linalg.eigh(covariances)
+        n = eigenvectors[:, :, 0]
+        n[counts < 3] = np.full(3, 1 / np.sqrt(3))
+
+        l = np.sqrt(np.sum(n[:, :2] ** 2, axis=1))
+        n[np.arctan2(n[:, 2], l) < 0] *= -1
+        return n
+
+
+    def CPDAffinePolyData(self, polyData, sourcePoints, targetPoints, parameters=None, initialAffine=None, initialSigma2=None):
+       """
+       Register sourcePoints to targetPoints with affine CPD and apply the result to polyData in place.
+       Returns the affine matrix B and translation t (TY = Y B + t) and the iteration trace,
+       a list of {"iteration", "objective", "sigma2", "relativeChange"} dicts.
+
+       By default cpdalp.AffineRegistration is used. ChunkedAffineCPD is used instead if any of
+       the following are given, all optional:
+         parameters["CPDMemoryBudget"]       bytes for the responsibilities (default 256 MB)
+         initialAffine                       (B, t) to start from, e.g. a previous result
+         initialSigma2                       initial GMM variance
+         parameters["CPDWarmStart"]          estimate the initial sigma2 from the nearest
+                                             neighbour distances of the (already rigidly
+                                             aligned) source points, instead of all pairs
+         parameters["CPDRelativeTolerance"]  stop when the relative objective change is below
+         parameters["CPDSigma2Tolerance"]    stop when the relative sigma2 change is below
+         parameters["CPDMaxIterations"]      iteration limit (default 100)
+       """
+       import vtk.util.numpy_support as nps
+
+       self.startMetricsRun("CPDAffine")
+       stageStart = time.perf_counter()
+       parameters = parameters or {}
+       self.applyThreadParameters(parameters)
+
+       points = polyData.GetPoints()
+       numpyModel = nps.vtk_to_numpy(points.GetData())
+
+       memoryBudget = parameters.get("CPDMemoryBudget")
+       warmStart = parameters.get("CPDWarmStart", False)
+       if warmStart and initialSigma2 is None:
+           B, t = initialAffine if initialAffine is not None else (np.identity(3), np.zeros(3))
+           distances, _ = NearestNeighborIndex(targetPoints, workers=self.stageThreads("CPD")).query(sourcePoints @ B + np.reshape(t, (1, 3)))
+           initialSigma2 = max(float(np.mean(distances**2)) / 3, np.finfo(float).eps)
+       chunked = (
+           memoryBudget
+           or initialAffine is not None
+           or initialSigma2 is not None
+           or any(key in parameters for key in ("CPDRelativeTolerance", "CPDSigma2Tolerance", "CPDMaxIterations"))
+       )
+       trace = []
+       if chunked:
+           B, t = initialAffine if initialAffine is not None else (None, None)
+           reg = ChunkedAffineCPD(
+               targetPoints,
+               sourcePoints,
+               memoryBudget=memoryBudget or 256 * 1024**2,
+               sigma2=initialSigma2,
+               max_iterations=parameters.get("CPDMaxIterations", 100),
+               B=B,
+               t=t,
+               relativeTolerance=parameters.get("CPDRelativeTolerance"),
+               sigma2Tolerance=parameters.get("CPDSigma2Tolerance"),
+           )
+           trace = reg.trace
+       else:
+           from cpdalp import AffineRegistration
+
+           reg = AffineRegistration(**{'X': targetPoints, 'Y': sourcePoints, 'low_rank':True})
+
+       def onIteration(**kwargs):
+           if not chunked:
+               previous = trace[-1]["objective"] if trace else np.inf
+               trace.append(
+                   {
+                       "iteration": kwargs["iteration"],
+                       "objective": float(kwargs["error"]),
+                       "sigma2": float(reg.sigma2),
+                       "relativeChange": float(abs(kwargs["error"] - previous) / max(abs(kwargs["error"]), np.finfo(float).tiny)),
+                   }
+               )
+           self.reportProgress("CPD", kwargs["iteration"] / reg.max_iterations)
+
+       self.reportProgress("CPD")
+       with self.getThreadBudget().limit("CPD"):
+           reg.register(onIteration)
+       TY = reg.transform_point_cloud(numpyModel)
+       vtkArray = nps.numpy_to_vtk(TY)
+       points.SetData(vtkArray)
+       polyData.Modified()
+
+       affine_matrix, translation = reg.get_registration_parameters()
+       self.metrics.record(
+           "CPDAffineTransform",
+           time.perf_counter() - stageStart,
+           sourcePoints=sourcePoints.shape[0],
+           targetPoints=targetPoints.shape[0],
+           iterations=reg.iteration,
+           sigma2=reg.sigma2,
+           memoryBudget=memoryBudget,
+           warmStart=initialAffine is not None or initialSigma2 is not None,
+           stopReason=getattr(reg, "stopReason", None),
+           trace=trace,
+       )
+       self.finishMetricsRun()
+
+       return affine_matrix, translation, trace
@@ -0,0 +1,5 @@
+"""
+Helpers of the MirrorOrbitRecon module that Slicer must not load as modules of their own:
+the scene independent registration pipeline (MirrorOrbitReconCore), the headless batch
+runner (MirrorOrbitReconBatch) and the benchmark (MirrorOrbitReconBenchmark).
+"""